@@ -0,0 +1,82 @@
+'''Compare the single-pass multi-algorithm hasher with the old 8 KiB loop.
+
+    python benchmarks/bench_hashing.py --size 1024 --count 2
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from mmedit.footage.hashing import ALGORITHMS, hash_file
+
+
+def old_hash_file(path, name='md5'):
+    hasher = getattr(hashlib, name)()
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(8192)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def make_files(root, count, size):
+    paths = []
+    block = os.urandom(1024 * 1024)
+    for i in range(count):
+        path = os.path.join(root, 'clip_%03d.mov' % i)
+        with open(path, 'wb') as fh:
+            for _ in range(size):
+                fh.write(block)
+        paths.append(path)
+    return paths
+
+
+def timeit(label, func, paths, total):
+    start = time.time()
+    for path in paths:
+        func(path)
+    elapsed = time.time() - start
+    print('{:<40} {:8.2f}s {:8.1f} MB/s'.format(label, elapsed, total / elapsed / 1e6))
+    return elapsed
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=512, help="Size of each file in MiB.")
+    parser.add_argument('--count', type=int, default=2)
+    parser.add_argument('--dir', help="Where to write the files (e.g. on the NAS).")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir=args.dir)
+    try:
+        paths = make_files(root, args.count, args.size)
+        total = args.count * args.size * 1024 * 1024
+
+        # Warm the page cache so we are comparing CPU rather than the disk.
+        for path in paths:
+            hash_file(path)
+
+        timeit('old md5 (8 KiB reads)', old_hash_file, paths, total)
+        timeit('new md5', hash_file, paths, total)
+
+        names = [name for name in ALGORITHMS if hasattr(hashlib, name)]
+        timeit('old %s (one pass each)' % '+'.join(names),
+            lambda p: [old_hash_file(p, name) for name in names], paths, total)
+        timeit('new %s (one pass)' % '+'.join(names),
+            lambda p: hash_file(p, names), paths, total)
+
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''Compare the PathMap trie with a linear scan of prefixes.
+
+    python benchmarks/bench_pathmap.py --paths 1000000 --rules 50
+
+The paths are spread over a few thousand directories (like real cards), which
+is what the per-directory memo is counting on.
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import random
+import time
+
+from mmedit.footage.pathmap import PathMap
+
+
+def linear_map(rules):
+    # What we did before: check every prefix in turn.
+    rules = sorted(rules, key=lambda rule: len(rule[0]), reverse=True)
+    def map_(path):
+        for src, dst in rules:
+            if path == src or path.startswith(src + '/'):
+                return dst + path[len(src):]
+        return path
+    return map_
+
+
+def make_paths(count, rules, dirs):
+    random.seed(1234)
+    roots = [src for src, _ in rules] + ['/Volumes/Unmapped']
+    dir_paths = [
+        '%s/CARD%03d/DCIM/%03dMEDIA' % (random.choice(roots), i % 100, i)
+        for i in range(dirs)
+    ]
+    return ['%s/C%04d.MP4' % (random.choice(dir_paths), i % 10000) for i in range(count)]
+
+
+def timeit(label, func, paths):
+    start = time.time()
+    for path in paths:
+        func(path)
+    elapsed = time.time() - start
+    print('{:<24} {:8.3f}s {:10.0f} paths/s'.format(label, elapsed, len(paths) / elapsed))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths', type=int, default=1000000)
+    parser.add_argument('--rules', type=int, default=50)
+    parser.add_argument('--dirs', type=int, default=2000)
+    args = parser.parse_args()
+
+    rules = [
+        ('/Volumes/EditOnline/PROJ%02d/%02d_Source' % (i // 4, i % 4), '/mnt/nas%d/proj%02d/source%d' % (i % 3, i // 4, i % 4))
+        for i in range(args.rules)
+    ]
+    paths = make_paths(args.paths, rules, args.dirs)
+
+    trie = PathMap(rules)
+    linear = linear_map(rules)
+    assert all(trie(path) == linear(path) for path in paths[:10000])
+
+    timeit('linear prefix scan', linear, paths)
+    timeit('PathMap (cold)', PathMap(rules), paths)
+    timeit('PathMap (warm)', trie, paths)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''Compare the PathPlanner with planning one Element at a time.
+
+    python benchmarks/bench_planner.py --paths 1000000 --dirs 5000
+
+The relative paths mimic cards (DCIM, XDROOT, URSA, etc.), so most of them
+share a few thousand directories, and --collide of them share a name and the
+first 8 characters of their checksum.
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import hashlib
+import os
+import random
+import re
+import time
+
+from mmedit.footage.utils import REDUCTIONS, PathPlanner
+
+
+class Element(dict):
+
+    def fetch(self, name):
+        return self.get(name)
+
+
+def old_plan(elements):
+    # What we did before: re.sub with uncompiled patterns for every Element.
+    out = []
+    for element in elements:
+        rel_path = element['sg_relative_path']
+        for pattern, replacement in REDUCTIONS:
+            rel_path = re.sub(pattern, replacement, rel_path, flags=re.IGNORECASE)
+        rel_path = os.path.sep.join(re.sub(r'[^\w,\.]+', '-', part).strip('-') for part in rel_path.split(os.path.sep))
+        base, ext = os.path.splitext(rel_path)
+        out.append((element, '%s_X%s%s' % (base, element['sg_checksum'].split(':')[-1][:8].upper(), ext)))
+    return out
+
+
+LAYOUTS = (
+    'CARD%02d/DCIM/%03dMEDIA/DJI_%04d.MP4',
+    'CAM%d-URSA/Day %03d/Blackmagic URSA_1_2016-04-08_1453_C%04d.mov',
+    'A7S/A7S-CARD%d/Shogun %03d/SHOGUN_S003_S001_T%04d.MOV',
+    'CARD%02d/XDROOT/Clip/%03d/DEC.4-ANNA%04d.MXF',
+    'CARD%02d/PRIVATE/AVCHD/BDMV/STREAM %03d/%05d.MTS',
+)
+
+
+def make_elements(count, dirs, collide):
+    random.seed(1234)
+    elements = []
+    for i in range(count):
+        checksum = hashlib.md5(str(i).encode('ascii')).hexdigest()
+        n = i
+        d = random.randrange(dirs)
+        if i < collide * 2:
+            # Pairs with the same name and 8-char prefix, but different content.
+            n = i // 2
+            d = 0
+            checksum = '0' * 8 + checksum[8:]
+        elements.append(Element(
+            sg_relative_path=LAYOUTS[n % len(LAYOUTS)] % (d % 100, d, n % 10000),
+            sg_checksum='md5:' + checksum,
+            sg_uuid=checksum,
+        ))
+    return elements
+
+
+def timeit(label, func, elements):
+    start = time.time()
+    out = func(elements)
+    elapsed = time.time() - start
+    print('{:<24} {:8.3f}s {:10.0f} paths/s {:10d} unique'.format(
+        label, elapsed, len(elements) / elapsed, len(set(path for _, path in out))))
+    return out
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paths', type=int, default=1000000)
+    parser.add_argument('--dirs', type=int, default=5000)
+    parser.add_argument('--collide', type=int, default=100)
+    args = parser.parse_args()
+
+    elements = make_elements(args.paths, args.dirs, args.collide)
+
+    old = timeit('per Element', old_plan, elements)
+    planner = PathPlanner()
+    new = timeit('PathPlanner', planner.plan, elements)
+    print('widened {} suffixes'.format(planner.widened))
+
+    differ = sum(1 for (_, a), (_, b) in zip(old, new) if a != b)
+    assert differ == planner.widened, (differ, planner.widened)
+
+
+if __name__ == '__main__':
+    main()
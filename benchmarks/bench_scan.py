@@ -0,0 +1,69 @@
+'''Compare the parallel scandir scanner with the old os.walk loop.
+
+    python benchmarks/bench_scan.py --dirs 200 --files 500
+
+Point --dir at an NFS/SMB mount to see the effect of parallel listing; on a
+local disk the win is mostly from not calling guess_type/relpath.
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from mmedit.footage.scanner import EXCLUDE_DIRS, scan
+from mmedit.footage.utils import guess_type
+
+
+def old_scan(root):
+    for dir_path, dir_names, file_names in os.walk(root, topdown=True):
+        dir_names[:] = [x for x in dir_names if x.lower() not in EXCLUDE_DIRS]
+        for name in file_names:
+            abs_path = os.path.join(dir_path, name)
+            type_ = guess_type(abs_path)
+            if not type_:
+                continue
+            yield abs_path, os.path.relpath(abs_path, root), type_
+
+
+def make_tree(root, dirs, files):
+    exts = ('.MOV', '.mp4', '.MXF', '.XML', '.wav', '.jpg', '.txt')
+    for i in range(dirs):
+        dir_ = os.path.join(root, 'CARD%03d' % (i // 20), 'DCIM', '%03dMEDIA' % i)
+        os.makedirs(dir_)
+        for j in range(files):
+            open(os.path.join(dir_, 'DJI_%04d%s' % (j, exts[j % len(exts)])), 'w').close()
+
+
+def timeit(label, func):
+    start = time.time()
+    count = sum(1 for _ in func())
+    elapsed = time.time() - start
+    print('{:<30} {:8d} files {:8.3f}s'.format(label, count, elapsed))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dirs', type=int, default=200)
+    parser.add_argument('--files', type=int, default=500)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--dir', help="Where to build the tree (e.g. on the NAS).")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir=args.dir)
+    try:
+        make_tree(root, args.dirs, args.files)
+        timeit('os.walk + guess_type', lambda: old_scan(root))
+        timeit('scan (1 thread)', lambda: scan(root, threads=1))
+        timeit('scan (%d threads)' % args.threads, lambda: scan(root, threads=args.threads))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
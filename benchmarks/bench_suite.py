@@ -0,0 +1,285 @@
+'''Time the main mmedit stages against a synthetic tree and a fake Shotgun.
+
+    python benchmarks/bench_suite.py --cards 4 --clips 100 --latency 20 --json before.json
+    python benchmarks/bench_suite.py --compare before.json after.json
+
+The stages run in the order they do in production, each on the output of the
+one before:
+
+- ``ingest``: scan and group the tree, then create the ElementSet and
+  Elements (as ``mmedit-ingest`` does);
+- ``checksum``: hash every Element and batch the results back (as
+  ``mmedit-checksum compute`` does);
+- ``plan``: ``iter_render_work`` for the ElementSet;
+- ``relink``: plan and make hardlinks for it (as ``mmedit-relink -H`` does).
+
+Each reports its wall time, how much it got through, and the Shotgun calls
+(and rows) it made; --latency is added to every call. Use --json to save the
+results, so runs from two commits can be compared with --compare.
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+
+from fake_shotgun import FakeShotgun, FakeSession, FakeSGFS
+from footage_tree import MB, add_tree_arguments, make_tree
+
+from mmedit.footage.checksum import BatchWriter, do_one
+from mmedit.footage.grouping import group_entries
+from mmedit.footage.ingest import create_element_set
+from mmedit.footage.relink import apply_plan, element_links, plan_relink
+from mmedit.footage.scanner import EXCLUDE_DIRS, scan
+from mmedit.footage.stats import Stats
+from mmedit.footage.utils import iter_render_work
+
+
+@contextlib.contextmanager
+def quiet(enabled=True):
+    '''Swallow the per-file printing of the tools.'''
+    if not enabled:
+        yield
+        return
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class Stage(object):
+
+    def __init__(self, name, server):
+        self.name = name
+        self.server = server
+        self.result = {}
+
+    def __enter__(self):
+        self.server.reset_counts()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0]:
+            return
+        self.result['seconds'] = time.time() - self.start
+        self.result['calls'] = dict(self.server.calls)
+        self.result['rows'] = dict(self.server.rows)
+
+
+def bench_ingest(server, root, args):
+
+    sgfs = FakeSGFS()
+    project = server.add('Project', {'name': 'Benchmark'})
+
+    with Stage('ingest', server) as stage:
+
+        scan_start = time.time()
+        entries = sorted(scan(root, EXCLUDE_DIRS, threads=args.scan_threads, stat=True, sidecars=True),
+            key=lambda entry: entry.rel_path)
+        scan_seconds = time.time() - scan_start
+
+        specs = []
+        for group in group_entries(entries):
+            entry = group.primary
+            spec = {
+                'sg_uuid': str(uuid.uuid4()),
+                'sg_type': entry.type,
+                'sg_path': entry.path,
+                'sg_relative_path': entry.rel_path,
+            }
+            spec.update(group.element_fields())
+            specs.append(spec)
+
+        element_set = create_element_set({
+            'code': os.path.basename(root),
+            'sg_path': root,
+            'project': project,
+        }, specs, sgfs, chunk_size=args.chunk_size, threads=args.create_threads)
+
+    stage.result.update(files=len(entries), elements=len(specs), scan_seconds=scan_seconds)
+    stage.result['rate'] = len(entries) / stage.result['seconds']
+    return stage.result, element_set
+
+
+def bench_checksum(server, element_set, args):
+
+    sg = FakeSession()
+
+    with Stage('checksum', server) as stage:
+
+        elements = sg.find('Element', [
+            ('sg_element_set', 'is', element_set),
+            ('sg_checksum', 'is', ''),
+        ], ['code', 'sg_path', 'sg_checksum'])
+
+        writer = BatchWriter(sg, elements, chunk_size=args.chunk_size)
+        writer.start()
+        pool = ThreadPoolExecutor(args.threads)
+        try:
+            bytes_read = sum(pool.map(lambda e: do_one(e['id'], e['sg_path'], writer), elements))
+        finally:
+            pool.shutdown(wait=True)
+        writer.close()
+
+    stage.result.update(elements=len(elements), bytes=bytes_read, written=writer.written)
+    stage.result['rate'] = bytes_read / stage.result['seconds'] / MB
+    return stage.result
+
+
+def bench_plan(server, element_set, dst_root, args):
+
+    sgfs = FakeSGFS()
+
+    with Stage('plan', server) as stage:
+        work = list(iter_render_work('CustomEntity27:%d' % element_set['id'], dst_root,
+            sgfs=sgfs, check_dst=False))
+
+    stage.result['elements'] = len(work)
+    stage.result['rate'] = len(work) / stage.result['seconds']
+    return stage.result, work
+
+
+def bench_relink(server, work, args):
+
+    stats = Stats()
+
+    with Stage('relink', server) as stage:
+        pairs = []
+        for element, path in work:
+            pairs.extend(element_links(element, path))
+        with stats.span('plan'):
+            plan = plan_relink(pairs, threads=args.threads, stats=stats)
+        made = apply_plan(plan, symlink=False, threads=args.threads, stats=stats)
+
+    stage.result.update(links=made, skips=len(plan.skips), stats=stats.as_dict())
+    stage.result['rate'] = made / stage.result['seconds']
+    return stage.result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+
+    server = FakeShotgun(latency=args.latency / 1000.0)
+    work_dir = tempfile.mkdtemp(prefix='mmedit-bench-', dir=args.dir)
+    src_root = os.path.join(work_dir, 'src')
+    dst_root = os.path.join(work_dir, 'dst')
+
+    try:
+
+        start = time.time()
+        files, bytes_ = make_tree(src_root, args.layouts, args.cards, args.clips,
+            int(args.size * MB), sparse=not args.dense)
+        print('Made {} files ({:.1f} MB) in {:.2f}s'.format(files, bytes_ / float(MB), time.time() - start))
+
+        results = {}
+        with quiet(not args.verbose):
+            results['ingest'], element_set = bench_ingest(server, src_root, args)
+            results['checksum'] = bench_checksum(server, element_set, args)
+            results['plan'], work = bench_plan(server, element_set, dst_root, args)
+            results['relink'] = bench_relink(server, work, args)
+
+    finally:
+        shutil.rmtree(work_dir)
+
+    return {
+        'commit': git_commit(),
+        'time': time.time(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'params': dict((k, v) for k, v in vars(args).items() if k not in ('json', 'compare')),
+        'results': results,
+    }
+
+
+UNITS = {
+    'ingest': 'files/s',
+    'checksum': 'MB/s',
+    'plan': 'elements/s',
+    'relink': 'links/s',
+}
+
+
+def report(out):
+    print('commit {} on {}, python {}'.format(out['commit'], out['host'], out['python']))
+    for name in ('ingest', 'checksum', 'plan', 'relink'):
+        result = out['results'].get(name)
+        if not result:
+            continue
+        calls = ', '.join('{}={}'.format(k, v) for k, v in sorted(result['calls'].items()))
+        print('{:<9} {:8.3f}s {:10.1f} {:<11} sg: {}'.format(name, result['seconds'],
+            result['rate'], UNITS[name], calls or 'none'))
+
+
+def compare(a_path, b_path):
+
+    with open(a_path) as fh:
+        a = json.load(fh)
+    with open(b_path) as fh:
+        b = json.load(fh)
+
+    print('{:<9} {:>10} {:>10} {:>8}   {:>8} {:>8}'.format('', a['commit'] or 'a', b['commit'] or 'b', 'speedup', 'sg a', 'sg b'))
+    for name in ('ingest', 'checksum', 'plan', 'relink'):
+        ra = a['results'].get(name)
+        rb = b['results'].get(name)
+        if not (ra and rb):
+            continue
+        print('{:<9} {:9.3f}s {:9.3f}s {:7.2f}x   {:8d} {:8d}'.format(name, ra['seconds'], rb['seconds'],
+            ra['seconds'] / rb['seconds'] if rb['seconds'] else float('inf'),
+            sum(ra['calls'].values()), sum(rb['calls'].values())))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    add_tree_arguments(parser)
+    parser.add_argument('--latency', type=float, default=0,
+        help="Milliseconds to add to every Shotgun call.")
+    parser.add_argument('-j', '--threads', type=int, default=4,
+        help="Threads for hashing and relinking.")
+    parser.add_argument('--scan-threads', type=int, default=16)
+    parser.add_argument('--create-threads', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=100)
+    parser.add_argument('--dir', help="Where to build the trees (e.g. on the NAS).")
+    parser.add_argument('-v', '--verbose', action='store_true',
+        help="Let the tools print as they go.")
+    parser.add_argument('--json', help="Write the results to this file.")
+    parser.add_argument('--compare', nargs=2, metavar=('A', 'B'),
+        help="Compare two earlier --json results, instead of running.")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    out = run(args)
+    report(out)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(out, fh, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
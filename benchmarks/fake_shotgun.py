@@ -0,0 +1,244 @@
+'''An in-memory stand-in for Shotgun, for benchmarks and tests.
+
+:class:`FakeShotgun` holds the entities, counts every call made against it,
+and can sleep for a ``latency`` on each one (to model a round trip to the
+server). :class:`FakeSession` and :class:`FakeSGFS` look enough like the
+sgsession/sgfs ones for mmedit; sessions made without arguments (as ingest
+does for each of its threads) talk to the most recently created
+:class:`FakeShotgun`.
+
+Only the filters mmedit uses are supported.
+
+'''
+
+import collections
+import copy
+import itertools
+import threading
+import time
+
+
+# sgsession lets us refer to custom entities by their display name.
+ALIASES = {
+    '$ElementSet': 'CustomEntity27',
+    'ElementSet': 'CustomEntity27',
+}
+
+def _type(entity_type):
+    return ALIASES.get(entity_type, entity_type)
+
+
+def _key(value):
+    '''Compare links by (type, id), and everything else by value.'''
+    if isinstance(value, dict) and 'id' in value:
+        return (_type(value.get('type')), value['id'])
+    return value
+
+
+def _link(value):
+    # Shotgun links carry the display name too.
+    if isinstance(value, dict) and 'id' in value:
+        link = {'type': _type(value.get('type')), 'id': value['id']}
+        name = value.get('name', value.get('code'))
+        if name is not None:
+            link['name'] = name
+        return link
+    return value
+
+
+class FakeShotgun(object):
+
+    current = None
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.entities = collections.defaultdict(collections.OrderedDict)
+        self.calls = collections.Counter()
+        self.rows = collections.Counter()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        FakeShotgun.current = self
+
+    def call(self, name, rows=0):
+        with self._lock:
+            self.calls[name] += 1
+            self.rows[name] += rows
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counts(self):
+        self.calls.clear()
+        self.rows.clear()
+
+    def add(self, entity_type, data):
+        '''Store an entity without counting a call; returns its data.'''
+        entity_type = _type(entity_type)
+        data = dict((k, _link(v)) for k, v in data.items())
+        with self._lock:
+            data['id'] = next(self._ids)
+        data['type'] = entity_type
+        self.entities[entity_type][data['id']] = data
+        return data
+
+    def get(self, entity_type, id_):
+        return self.entities[_type(entity_type)].get(id_)
+
+
+class FakeEntity(dict):
+
+    '''Fetches missing fields from the server (counting a call), like sgsession.'''
+
+    def __init__(self, data, session):
+        super(FakeEntity, self).__init__(data)
+        self.session = session
+
+    def fetch(self, fields, force=False):
+        single = not isinstance(fields, (list, tuple))
+        fields = [fields] if single else fields
+        missing = [field for field in fields if force or field not in self]
+        if missing:
+            self.session.server.call('fetch', 1)
+            stored = self.session.server.get(self['type'], self['id']) or {}
+            for field in missing:
+                self[field] = copy.deepcopy(stored.get(field))
+        values = [self.get(field) for field in fields]
+        return values[0] if single else values
+
+
+def _match(data, filters):
+    for filter_ in filters:
+        field, op, value = filter_
+        have = _key(data.get(field))
+        if op == 'is':
+            if value in ('', None):
+                if have:
+                    return False
+            elif have != _key(value):
+                return False
+        elif op == 'is_not':
+            if value in ('', None):
+                if not have:
+                    return False
+            elif have == _key(value):
+                return False
+        elif op == 'in':
+            if have not in set(_key(x) for x in value):
+                return False
+        elif op == 'not_in':
+            if have in set(_key(x) for x in value):
+                return False
+        elif op == 'greater_than':
+            if have is None or not have > value:
+                return False
+        elif op == 'less_than':
+            if have is None or not have < value:
+                return False
+        elif op == 'starts_with':
+            if not (have or '').startswith(value):
+                return False
+        else:
+            raise ValueError('Filter is not supported by the fake.', filter_)
+    return True
+
+
+class FakeSession(object):
+
+    def __init__(self, server=None):
+        self.server = server or FakeShotgun.current
+
+    def _entity(self, data, fields):
+        out = {'type': data['type'], 'id': data['id']}
+        for field in fields or ():
+            out[field] = copy.deepcopy(data.get(field))
+        return FakeEntity(out, self)
+
+    def _sort_key(self, data, field):
+        # Shotgun orders links by their display name, but can order by a
+        # field of the linked entity (e.g. "sg_element_set.CustomEntity27.id").
+        if '.' in field:
+            field, entity_type, linked_field = field.split('.', 2)
+            link = data.get(field)
+            linked = link and self.server.get(entity_type, link['id'])
+            return linked.get(linked_field) if linked else None
+        value = data.get(field)
+        if isinstance(value, dict) and 'id' in value:
+            return value.get('name')
+        return value
+
+    def _find(self, entity_type, filters, fields=None, order=None, limit=None, page=None):
+        found = [data for data in self.server.entities[_type(entity_type)].values() if _match(data, filters)]
+        for spec in reversed(order or ()):
+            # Nulls last, without comparing them to anything else.
+            found.sort(key=lambda data: (lambda v: (v is None, v))(self._sort_key(data, spec['field_name'])),
+                reverse=spec.get('direction') == 'desc')
+        if limit:
+            start = ((page or 1) - 1) * limit
+            found = found[start:start + limit]
+        return [self._entity(data, fields) for data in found]
+
+    def find(self, entity_type, filters, fields=None, order=None, limit=None, page=None, **_):
+        found = self._find(entity_type, filters, fields, order, limit, page)
+        self.server.call('find', len(found))
+        return found
+
+    def find_one(self, entity_type, filters, fields=None, order=None, **_):
+        found = self._find(entity_type, filters, fields, order, limit=1)
+        self.server.call('find_one', len(found))
+        return found[0] if found else None
+
+    def _create(self, entity_type, data):
+        data = self.server.add(entity_type, data)
+        return self._entity(data, data.keys())
+
+    def _update(self, entity_type, id_, data):
+        stored = self.server.get(entity_type, id_)
+        stored.update((k, _link(v)) for k, v in data.items())
+        return self._entity(stored, data.keys())
+
+    def create(self, entity_type, data, return_fields=None):
+        self.server.call('create', 1)
+        return self._create(entity_type, data)
+
+    def update(self, entity_type, id_, data):
+        self.server.call('update', 1)
+        return self._update(entity_type, id_, data)
+
+    def batch(self, requests):
+        self.server.call('batch', len(requests))
+        out = []
+        for request in requests:
+            if request['request_type'] == 'create':
+                out.append(self._create(request['entity_type'], request['data']))
+            elif request['request_type'] == 'update':
+                out.append(self._update(request['entity_type'], request['entity_id'], request['data']))
+            else:
+                raise ValueError('Request is not supported by the fake.', request)
+        return out
+
+    def fetch(self, entities, fields, force=False):
+        entities = list(entities)
+        self.server.call('fetch', len(entities))
+        for entity in entities:
+            stored = self.server.get(entity['type'], entity['id']) or {}
+            for field in fields:
+                if force or field not in entity:
+                    entity[field] = copy.deepcopy(stored.get(field))
+
+
+class FakeSGFS(object):
+
+    def __init__(self, session=None):
+        self.session = session or FakeSession()
+
+    def parse_user_input(self, spec, entity_types=None):
+        '''Parse an id, or "Type:id".'''
+        spec = str(spec)
+        if ':' in spec:
+            entity_type, spec = spec.split(':', 1)
+        else:
+            entity_type = (entity_types or ['Project'])[0]
+        return self.session.find_one(_type(entity_type), [('id', 'is', int(spec))], ['code', 'project'])
+
+    def entities_from_path(self, path, entity_types=None):
+        projects = self.session.find('Project', [], ['name'])
+        return projects[:1]
@@ -0,0 +1,121 @@
+'''Generate synthetic footage trees laid out like real cards.
+
+    python benchmarks/footage_tree.py /tmp/tree --cards 4 --clips 100 --size 1
+
+The layouts are those we've seen (see TODO.txt). Files are sparse by default,
+so big trees are cheap to make; use --dense when the content matters (e.g.
+for hashing throughput, where sparse files read as fast as memory).
+
+'''
+
+from __future__ import print_function
+
+import argparse
+import os
+
+
+MB = 1024 * 1024
+
+
+def _dji(card, i):
+    return [('CARD%02d/DCIM/100MEDIA/DJI_%04d.MP4' % (card, i), 1.0)]
+
+def _ursa(card, i):
+    return [('CAM%d-URSA/Blackmagic URSA_1_2016-04-08_1453_C%04d.mov' % (card, i), 1.0)]
+
+def _shogun(card, i):
+    return [('A7S/A7S-CARD%d/SHOGUN_S003_S001_T%03d.MOV' % (card, i), 1.0)]
+
+def _mts(card, i):
+    return [('CARD%02d/PRIVATE/AVCHD/BDMV/STREAM/%05d.MTS' % (card, i), 1.0)]
+
+def _xdcam(card, i):
+    base = 'CARD%02d/XDROOT/Clip/DEC.4-ANNA%04d' % (card, i)
+    return [
+        (base + '.MXF', 1.0),
+        (base + 'M01.XML', 0.0),
+        (base + 'R01.BIM', 0.0),
+    ]
+
+# Name -> function of (card, clip) returning [(rel_path, share of size)].
+LAYOUTS = {
+    'dji': _dji,
+    'ursa': _ursa,
+    'shogun': _shogun,
+    'mts': _mts,
+    'xdcam': _xdcam,
+}
+
+# The size of sidecars (which get a zero share above).
+SIDECAR_SIZE = 4096
+
+
+def iter_layout(layouts=None, cards=2, clips=50):
+    '''Yields ``(rel_path, share)`` for every file of the tree.'''
+    for name in sorted(layouts or LAYOUTS):
+        func = LAYOUTS[name]
+        for card in range(cards):
+            for i in range(clips):
+                for item in func(card, i):
+                    yield item
+
+
+def _write(path, size, sparse, block):
+    with open(path, 'wb') as fh:
+        if sparse:
+            fh.truncate(size)
+            return
+        remaining = size
+        while remaining > 0:
+            chunk = block[:remaining]
+            fh.write(chunk)
+            remaining -= len(chunk)
+
+
+def make_tree(root, layouts=None, cards=2, clips=50, size=MB, sparse=True):
+    '''Build a tree under ``root``; returns ``(files, bytes)`` written.'''
+
+    block = b'' if sparse else os.urandom(min(size, MB)) or b'\0'
+    made_dirs = set()
+    count = total = 0
+    for rel_path, share in iter_layout(layouts, cards, clips):
+        path = os.path.join(root, rel_path)
+        dir_ = os.path.dirname(path)
+        if dir_ not in made_dirs:
+            if not os.path.exists(dir_):
+                os.makedirs(dir_)
+            made_dirs.add(dir_)
+        file_size = int(size * share) if share else SIDECAR_SIZE
+        _write(path, file_size, sparse, block)
+        count += 1
+        total += file_size
+    return count, total
+
+
+def add_tree_arguments(parser):
+    parser.add_argument('-l', '--layout', action='append', dest='layouts', choices=sorted(LAYOUTS),
+        help="Only generate the given layouts (default: all of them).")
+    parser.add_argument('--cards', type=int, default=2,
+        help="Cards (or cameras) per layout.")
+    parser.add_argument('--clips', type=int, default=50,
+        help="Clips per card.")
+    parser.add_argument('--size', type=float, default=1,
+        help="Size of each clip in MB.")
+    parser.add_argument('--dense', action='store_true',
+        help="Write real (random) data instead of sparse files.")
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    add_tree_arguments(parser)
+    parser.add_argument('root')
+    args = parser.parse_args()
+
+    count, total = make_tree(args.root, args.layouts, args.cards, args.clips,
+        int(args.size * MB), sparse=not args.dense)
+    print('Made {} files ({:.1f} MB) under {}'.format(count, total / float(MB), args.root))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,56 +1,423 @@
+from __future__ import print_function
 
 import argparse
-import hashlib
 import os
+import sys
+import threading
 
-from concurrent.futures import ThreadPoolExecutor
+try:
+    import queue
+except ImportError: # Python 2.
+    import Queue as queue
 
 from sgsession import Session
 from sgfs import SGFS
 
+from .devices import group_by_device, run_per_device, print_summary
+from .hashcache import HashCache, stat_key
+from .mirror import MirrorSession, MirrorSGFS
+from .pathmap import map_path
+from .stats import add_stats_arguments, get_stats, instrument_session, setup_stats
+from .hashing import ALGORITHMS, hash_file, sample_fingerprint, parse_fingerprint, SAMPLE_BLOCKS, SAMPLE_BLOCK_SIZE
+
 #import farmsoup.queue
 
 
-def do_one(element_id, path, name='md5'):
+def format_checksums(digests, names):
+    '''Build the Shotgun fields for the given digests.
+
+    ``sg_checksum`` holds the first (primary) algorithm so that everything
+    that expects a single ``"md5:xxx"`` keeps working, and ``sg_checksums``
+    holds all of them separated by spaces.
+
+    '''
+    checksums = ['%s:%s' % (name, digests[name]) for name in names]
+    return {
+        'sg_checksum': checksums[0],
+        'sg_checksums': ' '.join(checksums),
+    }
+
+
+def do_one(element_id, path, writer, names=('md5', ), cache=None, st=None, sg_path=None):
+    '''Checksum a file, and queue the result to be written to Shotgun.
+
+    All of the requested algorithms are computed in a single pass over the
+    file. Returns the number of bytes read, which is zero on a cache hit.
+    ``sg_path`` is the Element's path if ``path`` is where it is mapped to.
+
+    '''
+
+    st = st or os.stat(path)
+
+    digests = {}
+    if cache:
+        for name in names:
+            digest = cache.get(st, name)
+            if digest is not None:
+                digests[name] = digest
+    missing = [name for name in names if name not in digests]
+
+    bytes_read = 0
+    if missing:
+        new_digests = hash_file(path, missing)
+        bytes_read = st.st_size
+        digests.update(new_digests)
+        # Only remember them if the file didn't change out from under us.
+        if cache and stat_key(os.stat(path)) == stat_key(st):
+            for name, digest in new_digests.items():
+                cache.set(st, name, digest)
+
+    # The sampled fingerprint used by `verify`; it mostly re-reads blocks
+    # which are still in the page cache.
+    sample_name = 'sample:%d:%d' % (SAMPLE_BLOCKS, SAMPLE_BLOCK_SIZE)
+    fingerprint = cache.get(st, sample_name) if cache else None
+    if fingerprint is None:
+        fingerprint = sample_fingerprint(path, size=st.st_size)
+        if cache and stat_key(os.stat(path)) == stat_key(st):
+            cache.set(st, sample_name, fingerprint)
+
+    data = format_checksums(digests, names)
+    data['sg_fingerprint'] = fingerprint
+    print('{} {}'.format(data['sg_checksums'], path))
+    writer.put(element_id, sg_path or path, data)
+
+    return bytes_read
+
+
+class BatchWriter(object):
+
+    '''Collects checksums from the hashing threads, and writes them to Shotgun
+    in batches from a single thread.
+
+    The Elements given are those we already fetched to build the work list;
+    the safety checks that used to be done per file (that the path hasn't
+    changed, and that we aren't clobbering an existing checksum) are done
+    against them in bulk when each batch is flushed.
+
+    A batch which Shotgun rejects is counted in ``failed`` (with the error in
+    ``errors``), and the writer carries on with the next one.
+
+    '''
 
-    hasher = getattr(hashlib, name)()
-    with open(path, 'rb') as fh:
+    def __init__(self, sg, elements, chunk_size=100, dry_run=False):
+        self.sg = sg
+        self.elements = dict((e['id'], e) for e in elements)
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.queue = queue.Queue()
+        self.pending = []
+        self.written = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+        self._thread = None
+
+    def put(self, element_id, path, data):
+        self.queue.put((element_id, path, data))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        '''Flush what is left, and return how many checksums failed to write.'''
+        self.queue.put(None)
+        if self._thread:
+            self._thread.join()
+        return self.failed
+
+    def run(self):
         while True:
-            chunk = fh.read(8192)
-            if not chunk:
+            item = self.queue.get()
+            if item is None:
                 break
-            hasher.update(chunk)
+            self.pending.append(item)
+            if len(self.pending) >= self.chunk_size:
+                self.flush()
+        self.flush()
 
-    sg = Session()
-    element = sg.find_one('Element', [('id', 'is', element_id)], ['sg_path', 'sg_checksum'])
-    assert element['sg_path'] == path
-    assert not element['sg_checksum']
+    def flush(self):
 
-    print '{} {}'.format(hasher.hexdigest(), path)
-    sg.update('Element', element_id, {'sg_checksum': '%s:%s' % (name, hasher.hexdigest())})
+        pending, self.pending = self.pending, []
 
+        requests = []
+        for element_id, path, data in pending:
+            element = self.elements.get(element_id)
+            if element is None or element['sg_path'] != path:
+                print('Path for Element {} changed from {}; skipping it.'.format(element_id, path))
+                self.skipped += 1
+                continue
+            if element.get('sg_checksum'):
+                print('Element {} already has a checksum; skipping it.'.format(element_id))
+                self.skipped += 1
+                continue
+            element.update(data)
+            requests.append({
+                'request_type': 'update',
+                'entity_type': 'Element',
+                'entity_id': element_id,
+                'data': data,
+            })
 
-def main():
+        if requests and not self.dry_run:
+            try:
+                self.sg.batch(requests)
+            except Exception as e:
+                print('Could not write {} checksums: {}: {}'.format(len(requests), e.__class__.__name__, e))
+                self.failed += len(requests)
+                self.errors.append(e)
+                return
+        self.written += len(requests)
 
-    parser = argparse.ArgumentParser()
+
+def verify_one(element, path, full=False):
+    '''Verify a file against its stored checksums.
+
+    Tiers are tried cheapest first: the size and sampled fingerprint (from
+    ``sg_fingerprint``), and then a full hash against ``sg_checksum`` only if
+    the sample does not match, there isn't one, or ``full`` is set.
+
+    Returns ``(ok, tier, bytes_read)``, where ``tier`` is the check which
+    decided the result. A sample mismatch is always confirmed by the full
+    hash, but is still reported as caught by the sample.
+
+    '''
+
+    st = os.stat(path)
+    bytes_read = 0
+    sample_failed = False
+
+    fingerprint = element.get('sg_fingerprint')
+    if fingerprint:
+        size, blocks, block_size, _ = parse_fingerprint(fingerprint)
+        if st.st_size != size:
+            return False, 'size', bytes_read
+        if not full:
+            sample = sample_fingerprint(path, blocks, block_size, size=st.st_size)
+            bytes_read += min(st.st_size, (blocks + 2) * block_size)
+            if sample == fingerprint:
+                return True, 'sample', bytes_read
+            sample_failed = True
+
+    name, expected = element['sg_checksum'].split(':', 1)
+    digest = hash_file(path, [name])[name]
+    bytes_read += st.st_size
+    ok = digest == expected
+    return ok, 'sample' if sample_failed and not ok else 'full', bytes_read
+
+
+def _add_io_arguments(parser):
     parser.add_argument('-t', '--threads', type=int, default=8)
-    args = parser.parse_args()
+    parser.add_argument('-d', '--per-device', type=int, default=2,
+        help="Maximum number of threads reading from any one device.")
+    parser.add_argument('--order', choices=('inode', 'path'), default='inode',
+        help="How to order the reads on each device.")
+    parser.add_argument('-c', '--chunk-size', type=int, default=100,
+        help="How many Elements to write to Shotgun in each batch.")
+    parser.add_argument('-n', '--dry-run', action='store_true')
+    parser.add_argument('--offline', '--cached', dest='offline', action='store_true',
+        help="Read Elements from the local mirror (see mmedit-sync) instead of "
+             "Shotgun, and don't write anything back to it.")
+    add_stats_arguments(parser)
+
+
+def main(argv=None):
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+
+    # A bare `mmedit-checksum [options]` predates the subcommands.
+    if not argv or argv[0] not in ('compute', 'verify', '-h', '--help'):
+        argv.insert(0, 'compute')
 
-    sg = Session()
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='_command')
+
+    compute_parser = commands.add_parser('compute')
+    _add_io_arguments(compute_parser)
+    compute_parser.add_argument('-a', '--algorithm', action='append', dest='algorithms', choices=ALGORITHMS,
+        help="Hash algorithm(s) to compute in the same pass; the first is stored in sg_checksum. Defaults to md5.")
+    compute_parser.add_argument('--cache',
+        help="Path to the local hash cache; defaults to $MMEDIT_HASH_CACHE or ~/.cache/mmedit/hashes.sqlite.")
+    compute_parser.add_argument('--cache-size', type=int, default=1000000,
+        help="Maximum number of entries in the hash cache.")
+    compute_parser.add_argument('--no-cache', action='store_true',
+        help="Always read the files, and don't remember their hashes.")
+
+    verify_parser = commands.add_parser('verify')
+    _add_io_arguments(verify_parser)
+    verify_parser.add_argument('--full', action='store_true',
+        help="Always compare the full hash, even if the sampled fingerprint matches.")
+    verify_parser.add_argument('--fingerprint', action='store_true',
+        help="Store sampled fingerprints on Elements which don't have one yet, once their full hash is verified.")
+    verify_parser.add_argument('--all', action='store_true',
+        help="Verify all element sets in the given project.")
+    verify_parser.add_argument('entity',
+        help="$ElementSet or Project (if --all).")
+
+    args = parser.parse_args(argv)
+    setup_stats(args, 'checksum ' + args._command)
+
+    if args._command == 'compute':
+        exit(main_compute(args) or 0)
+    elif args._command == 'verify':
+        exit(main_verify(args) or 0)
+    else:
+        raise RuntimeError('Unknown command.', args._command)
+
+
+def main_compute(args):
+
+    args.algorithms = args.algorithms or ['md5']
+
+    stats = get_stats()
+
+    # Offline, the hashes still go into the cache for the next online run.
+    sg = instrument_session(MirrorSession() if args.offline else Session())
+    elements = []
     work = []
-    for element in sg.find('Element', [('sg_checksum', 'is', '')], ['code', 'sg_path']):
-        path = element['sg_path']
-        if path and os.path.exists(path):
+    with stats.span('query'):
+        for element in sg.find('Element', [('sg_checksum', 'is', '')], ['code', 'sg_path', 'sg_checksum']):
+            if not element['sg_path']:
+                continue
+            path = map_path(element['sg_path'])
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
             # print element['code'], element['sg_path']
-            work.append((element['id'], element['sg_path']))
+            elements.append(element)
+            work.append((path, st, element))
 
-    print 'Calculating checksums for {} files...'.format(len(work))
-    
-    executor = ThreadPoolExecutor(args.threads)
-    executor.map(do_one, *zip(*work))
+        queues = group_by_device(work, order=args.order)
 
+    print('Calculating checksums for {} files on {} devices...'.format(len(elements), len(queues)))
+
+    cache = None if args.no_cache else HashCache(args.cache, max_entries=args.cache_size)
+
+    writer = BatchWriter(sg, elements, chunk_size=args.chunk_size, dry_run=args.dry_run or args.offline)
+    writer.start()
+
+    with stats.span('hash'):
+        failures = run_per_device(queues,
+            lambda path, st, element: do_one(element['id'], path, writer, names=args.algorithms, cache=cache, st=st,
+                sg_path=element['sg_path']),
+            threads=args.threads,
+            per_device=args.per_device,
+        )
+
+    with stats.span('write'):
+        write_failed = writer.close()
+    stats.count('checksum.written', writer.written)
+    if cache:
+        print('Hash cache: {} hits, {} misses.'.format(cache.hits, cache.misses))
+        stats.count('hashcache.hits', cache.hits)
+        stats.count('hashcache.misses', cache.misses)
+        cache.close()
+
+    for path, _, error in failures:
+        print('Could not checksum {}: {}'.format(path, error))
+
+    print_summary(queues)
+    print('Wrote {} checksums ({} skipped, {} failed).'.format(writer.written, writer.skipped, len(failures) + write_failed))
+    if write_failed:
+        print('{} checksums could not be written to Shotgun; run again to retry them.'.format(write_failed))
+        return 1
 
-if __name__ == '__main__':
-    main()
 
+def main_verify(args):
 
+    stats = get_stats()
+
+    sgfs = MirrorSGFS() if args.offline else SGFS()
+    sg = instrument_session(sgfs.session)
+
+    if args.all:
+        project = sgfs.parse_user_input(args.entity, ['Project'])
+        if not project:
+            print("Could not parse project:", args.entity)
+            return 1
+        filters = [('project', 'is', project)]
+    else:
+        element_set = sgfs.parse_user_input(args.entity, ['CustomEntity27'])
+        if not element_set or element_set['type'] != 'CustomEntity27':
+            print("Could not parse element set:", args.entity)
+            return 1
+        filters = [('sg_element_set', 'is', element_set)]
+
+    filters.append(('sg_checksum', 'is_not', ''))
+
+    results = []
+    missing = []
+    work = []
+    with stats.span('query'):
+        elements = sg.find('Element', filters, ['code', 'sg_path', 'sg_checksum', 'sg_fingerprint'])
+        for element in elements:
+            if not element['sg_path'] or not element['sg_checksum']:
+                continue
+            path = map_path(element['sg_path'])
+            try:
+                st = os.stat(path)
+            except OSError:
+                missing.append(element)
+                continue
+            work.append((path, st, element))
+
+        queues = group_by_device(work, order=args.order)
+
+    print('Verifying {} files on {} devices...'.format(len(work), len(queues)))
+
+    def verify(path, st, element):
+        ok, tier, bytes_read = verify_one(element, path, full=args.full)
+        if not ok:
+            print('MISMATCH [{}] {}'.format(tier, path))
+        results.append((element, path, ok, tier))
+        return bytes_read
+
+    with stats.span('verify'):
+        failures = run_per_device(queues, verify,
+            threads=args.threads,
+            per_device=args.per_device,
+        )
+
+    for element in missing:
+        print('MISSING {}'.format(element['sg_path']))
+    for path, _, error in failures:
+        print('ERROR {}: {}'.format(path, error))
+
+    counts = {}
+    for _, _, ok, tier in results:
+        key = ('ok' if ok else 'mismatch', tier)
+        counts[key] = counts.get(key, 0) + 1
+
+    print_summary(queues)
+    print('Verified {} files:'.format(len(results)))
+    for key in sorted(counts):
+        print('    {:<8} by {:<6} {:6d}'.format(key[0], key[1], counts[key]))
+    if missing:
+        print('    {:<18} {:6d}'.format('missing', len(missing)))
+    if failures:
+        print('    {:<18} {:6d}'.format('errors', len(failures)))
+
+    if args.fingerprint and not (args.dry_run or args.offline):
+        # Backfill fingerprints for files which just passed a full hash.
+        requests = []
+        for element, path, ok, tier in results:
+            if ok and tier == 'full' and not element.get('sg_fingerprint'):
+                requests.append({
+                    'request_type': 'update',
+                    'entity_type': 'Element',
+                    'entity_id': element['id'],
+                    'data': {'sg_fingerprint': sample_fingerprint(path)},
+                })
+        for i in range(0, len(requests), args.chunk_size):
+            sg.batch(requests[i:i + args.chunk_size])
+        print('Stored {} new fingerprints.'.format(len(requests)))
+
+    mismatched = sum(count for (status, _), count in counts.items() if status == 'mismatch')
+    if mismatched or missing or failures:
+        return 1
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+'''Copy files as cheaply as the filesystems allow.
+
+In order of preference: a reflink (``FICLONE``, which shares the blocks on
+Btrfs/XFS and friends), then a zero-copy ``copy_file_range`` or ``sendfile``
+within the kernel, and only then a buffered copy through Python.
+
+'''
+
+import errno
+import os
+import sys
+
+try:
+    import fcntl
+except ImportError: # Windows.
+    fcntl = None
+
+
+# From linux/fs.h: _IOW(0x94, 9, int).
+FICLONE = 0x40049409
+
+BUFFER_SIZE = 8 * 1024 * 1024
+
+# Errors which mean "this method doesn't work here", rather than "this copy failed".
+_UNSUPPORTED = set(getattr(errno, name) for name in (
+    'EBADF', 'EINVAL', 'ENOSYS', 'ENOTSOCK', 'ENOTSUP', 'ENOTTY', 'EOPNOTSUPP', 'EPERM', 'EXDEV',
+) if hasattr(errno, name))
+
+
+def _reflink(src_fd, dst_fd, size):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, 'No fcntl.')
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+
+
+def _zero_copy(func):
+    def copy(src_fd, dst_fd, size):
+        offset = 0
+        while offset < size:
+            count = func(src_fd, dst_fd, offset, size - offset)
+            if not count:
+                break
+            offset += count
+    return copy
+
+if hasattr(os, 'copy_file_range'):
+    _copy_file_range = _zero_copy(lambda src, dst, offset, count: os.copy_file_range(src, dst, count, offset, offset))
+else:
+    _copy_file_range = None
+
+# Elsewhere (e.g. macOS) sendfile only writes to sockets.
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    _sendfile = _zero_copy(lambda src, dst, offset, count: os.sendfile(dst, src, offset, count))
+else:
+    _sendfile = None
+
+
+def _buffered(src_fd, dst_fd, size):
+    while True:
+        chunk = os.read(src_fd, BUFFER_SIZE)
+        if not chunk:
+            break
+        while chunk:
+            chunk = chunk[os.write(dst_fd, chunk):]
+
+
+METHODS = [(name, func) for name, func in (
+    ('reflink', _reflink),
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _sendfile),
+    ('copy', _buffered),
+) if func is not None]
+
+
+def _discard(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def clone_file(src, dst, methods=None):
+    '''Copy ``src`` to ``dst`` by the cheapest method which works.
+
+    The copy is made beside ``dst`` and renamed into place once its size is
+    verified, and it keeps the source's mode and mtime. Returns the name of
+    the method used (one of ``"reflink"``, ``"copy_file_range"``,
+    ``"sendfile"``, or ``"copy"``).
+
+    '''
+
+    st = os.stat(src)
+    tmp = '%s.cloning-%d' % (dst, os.getpid())
+
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, st.st_mode & 0o777)
+        # Clean up on the way out (but let the original error carry on).
+        copied = False
+        try:
+            try:
+                for name, func in methods or METHODS:
+                    try:
+                        func(src_fd, dst_fd, st.st_size)
+                    except (IOError, OSError) as e:
+                        if e.errno not in _UNSUPPORTED or name == 'copy':
+                            raise
+                        # Start over with the next method.
+                        os.ftruncate(dst_fd, 0)
+                        os.lseek(src_fd, 0, os.SEEK_SET)
+                        os.lseek(dst_fd, 0, os.SEEK_SET)
+                        error = e
+                        continue
+                    break
+                else:
+                    raise error
+            finally:
+                os.close(dst_fd)
+            copied = True
+        finally:
+            if not copied:
+                _discard(tmp)
+    finally:
+        os.close(src_fd)
+
+    size = os.path.getsize(tmp)
+    if size != st.st_size:
+        _discard(tmp)
+        raise IOError(errno.EIO, 'Cloned size %d does not match source size %d.' % (size, st.st_size), src)
+
+    if hasattr(st, 'st_mtime_ns'):
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+    else: # Python 2, which only has microseconds.
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+    os.rename(tmp, dst)
+    return name
@@ -0,0 +1,131 @@
+from __future__ import print_function
+
+import collections
+import os
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def find_mount(path):
+    path = os.path.realpath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class DeviceQueue(object):
+
+    '''The work for a single device, and how quickly we got through it.'''
+
+    def __init__(self, dev, mount):
+        self.dev = dev
+        self.mount = mount
+        self.items = collections.deque()
+        self.files = 0
+        self.bytes = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, bytes_read, start, end, failed=False):
+        with self._lock:
+            self.files += 1
+            self.bytes += bytes_read
+            self.failed += int(failed)
+            self.started = start if self.started is None else min(self.started, start)
+            self.finished = end if self.finished is None else max(self.finished, end)
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return self.finished - self.started
+
+    @property
+    def rate(self):
+        '''Throughput in MB/s.'''
+        elapsed = self.elapsed
+        return self.bytes / elapsed / 1e6 if elapsed else 0.0
+
+
+def group_by_device(work, order='inode'):
+    '''Group ``(path, stat, payload)`` tuples by the device they live on.
+
+    Each device's work is ordered by inode (or path) so that reads stay close
+    to sequential on spinning disks.
+
+    '''
+
+    by_dev = collections.OrderedDict()
+    for path, st, payload in work:
+        queue = by_dev.get(st.st_dev)
+        if queue is None:
+            queue = by_dev[st.st_dev] = DeviceQueue(st.st_dev, find_mount(path))
+        queue.items.append((path, st, payload))
+
+    key = (lambda x: x[1].st_ino) if order == 'inode' else (lambda x: x[0])
+    for queue in by_dev.values():
+        queue.items = collections.deque(sorted(queue.items, key=key))
+
+    return list(by_dev.values())
+
+
+def run_per_device(queues, func, threads=8, per_device=2):
+    '''Call ``func(path, stat, payload)`` for all work in the given queues.
+
+    At most ``per_device`` threads work on any one device at a time, and
+    devices are interleaved so that they all get going in parallel. ``func``
+    should return the number of bytes it read.
+
+    Returns a list of ``(path, payload, exception)`` for the failures.
+
+    '''
+
+    failures = []
+
+    def drain(queue):
+        while True:
+            try:
+                path, st, payload = queue.items.popleft()
+            except IndexError:
+                return
+            start = time.time()
+            try:
+                bytes_read = func(path, st, payload)
+            except Exception as e:
+                failures.append((path, payload, e))
+                queue.record(0, start, time.time(), failed=True)
+            else:
+                queue.record(bytes_read or 0, start, time.time())
+
+    lanes = []
+    for i in range(per_device):
+        for queue in queues:
+            if i < len(queue.items):
+                lanes.append(queue)
+
+    executor = ThreadPoolExecutor(max(1, min(threads, len(lanes))))
+    for queue in lanes:
+        executor.submit(drain, queue)
+    executor.shutdown(wait=True)
+
+    return failures
+
+
+def print_summary(queues):
+    print('Per-device throughput:')
+    for queue in queues:
+        print('    {:<30} {:6d} files {:10.1f} MB {:8.1f}s {:8.1f} MB/s{}'.format(
+            queue.mount,
+            queue.files,
+            queue.bytes / 1e6,
+            queue.elapsed,
+            queue.rate,
+            ' ({} failed)'.format(queue.failed) if queue.failed else '',
+        ))
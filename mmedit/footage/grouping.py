@@ -0,0 +1,261 @@
+'''Collapse image sequences and multi-file clips into single Elements.
+
+The scanner yields one entry per file; this groups them so that a 10,000
+frame TIFF sequence, or a spanned clip on a camera card, becomes a single
+Element which knows about all of its files.
+
+'''
+
+import collections
+import json
+import os
+import re
+
+
+# FAT32 cameras split long clips just under these sizes.
+SPAN_LIMITS = (2 ** 31, 2 ** 32)
+SPAN_TOLERANCE = 0.05
+
+# Image formats which we treat as frames of a sequence (rather than stills)
+# when there are at least MIN_SEQUENCE_LENGTH of them in a row.
+SEQUENCE_EXTS = set(('.dpx', '.exr', '.jpg', '.jpeg', '.png', '.tif', '.tiff'))
+MIN_SEQUENCE_LENGTH = 3
+
+
+class Group(object):
+
+    '''One Element's worth of files.
+
+    ``kind`` is one of ``"file"``, ``"sequence"``, or ``"clip"``. Sequences
+    have ``frames`` (a sorted list of ints); clips have ``members`` (every
+    file in the clip, primary first).
+
+    '''
+
+    def __init__(self, kind, primary, members=None, frames=None, code=None):
+        self.kind = kind
+        self.primary = primary
+        self.members = members or [primary]
+        self.frames = frames
+        self.code = code or os.path.splitext(primary.name)[0]
+
+    @property
+    def rel_paths(self):
+        return [m.rel_path for m in self.members]
+
+    def element_fields(self):
+        '''Extra Shotgun fields for this group, on top of the primary's.'''
+        fields = {'code': self.code}
+        if self.kind == 'sequence':
+            fields['sg_frames'] = format_frames(self.frames)
+        elif self.kind == 'clip':
+            fields['sg_members'] = json.dumps(self.rel_paths)
+        return fields
+
+
+def format_frames(frames):
+    '''Format a sorted list of frames as "1001-1100,1102-1200".'''
+    ranges = []
+    start = prev = frames[0]
+    for frame in frames[1:]:
+        if frame != prev + 1:
+            ranges.append((start, prev))
+            start = frame
+        prev = frame
+    ranges.append((start, prev))
+    return ','.join(str(a) if a == b else '%d-%d' % (a, b) for a, b in ranges)
+
+
+def parse_frames(spec):
+    '''The inverse of :func:`format_frames`.'''
+    frames = []
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            frames.extend(range(int(first), int(last) + 1))
+        else:
+            frames.append(int(part))
+    return frames
+
+
+_frame_re = re.compile(r'^(.*?)(\d+)(\.[^.]+)$')
+
+def sequence_pattern(path):
+    '''Turn the path to the first frame into a printf-style pattern.
+
+    Returns ``(pattern, first_frame)``; e.g. ``shot.1001.dpx`` becomes
+    ``("shot.%04d.dpx", 1001)``.
+
+    '''
+    dir_, name = os.path.split(path)
+    m = _frame_re.match(name)
+    if not m:
+        raise ValueError('Not a frame of a sequence.', path)
+    prefix, digits, ext = m.groups()
+    first = int(digits)
+    padded = len(digits) > len(str(first))
+    token = '%%0%dd' % len(digits) if padded else '%d'
+    return os.path.join(dir_, prefix + token + ext), first
+
+
+def _contiguous_runs(frames):
+    '''Split sorted ``(frame, entry)`` pairs wherever a frame is missing.'''
+    runs = []
+    for item in frames:
+        if runs and item[0] == runs[-1][-1][0] + 1:
+            runs[-1].append(item)
+        else:
+            runs.append([item])
+    return runs
+
+
+def _is_dcim(rel_path):
+    return 'dcim' in rel_path.lower().split(os.path.sep)
+
+
+def _near_span_limit(size):
+    if size is None:
+        return False
+    return any(limit * (1 - SPAN_TOLERANCE) <= size <= limit for limit in SPAN_LIMITS)
+
+
+def _group_sequences(entries):
+    '''Returns (groups, leftovers).'''
+
+    candidates = collections.defaultdict(list)
+    leftovers = []
+    for entry in entries:
+        ext = os.path.splitext(entry.name)[1].lower()
+        m = _frame_re.match(entry.name)
+        # Numbered stills on camera cards aren't sequences.
+        if ext not in SEQUENCE_EXTS or not m or _is_dcim(entry.rel_path):
+            leftovers.append(entry)
+            continue
+        prefix, digits, _ = m.groups()
+        key = (os.path.dirname(entry.rel_path), prefix, ext)
+        candidates[key].append((int(digits), entry))
+
+    groups = []
+    for (_, prefix, _), frames in candidates.items():
+        frames.sort(key=lambda x: x[0])
+        # Readers (ffmpeg included) stop at the first missing frame, so each
+        # contiguous run is its own sequence; short ones are just stills.
+        runs = []
+        for run in _contiguous_runs(frames):
+            if len(run) >= MIN_SEQUENCE_LENGTH:
+                runs.append(run)
+            else:
+                leftovers.extend(entry for _, entry in run)
+        for run in runs:
+            code = prefix.rstrip('._- ') or os.path.splitext(run[0][1].name)[0]
+            if len(runs) > 1:
+                code = '%s_%d' % (code, run[0][0])
+            groups.append(Group('sequence', run[0][1],
+                members=[entry for _, entry in run],
+                frames=[frame for frame, _ in run],
+                code=code,
+            ))
+
+    return groups, leftovers
+
+
+_xdcam_sidecar_re = re.compile(r'^(.+?)[MR]\d\d\.(xml|bim)$', re.IGNORECASE)
+_gopro_re = re.compile(r'^G([HXL])(\d\d)(\d{4})\.mp4$', re.IGNORECASE)
+_gopro_old_re = re.compile(r'^G(?:OPR|P(\d\d))(\d{4})\.mp4$', re.IGNORECASE)
+
+
+def _group_clips(entries):
+    '''Returns (groups, leftovers).'''
+
+    by_dir = collections.defaultdict(list)
+    for entry in entries:
+        by_dir[os.path.dirname(entry.rel_path)].append(entry)
+
+    groups = []
+    leftovers = []
+
+    for rel_dir, dir_entries in by_dir.items():
+
+        dir_entries.sort(key=lambda e: e.name)
+        claimed = set()
+
+        # XDCAM: DEC.4-ANNA0540.MXF with DEC.4-ANNA0540M01.XML and R01.BIM.
+        sidecars = collections.defaultdict(list)
+        for entry in dir_entries:
+            m = _xdcam_sidecar_re.match(entry.name)
+            if m:
+                sidecars[m.group(1).lower()].append(entry)
+        for entry in dir_entries:
+            base, ext = os.path.splitext(entry.name)
+            if ext.lower() == '.mxf' and base.lower() in sidecars:
+                members = [entry] + sidecars[base.lower()]
+                groups.append(Group('clip', entry, members=members))
+                claimed.update(m.path for m in members)
+
+        # GoPro chapters: GH010042.MP4, GH020042.MP4, ... or GOPR0042.MP4,
+        # GP010042.MP4, ...
+        chapters = collections.defaultdict(list)
+        for entry in dir_entries:
+            m = _gopro_re.match(entry.name)
+            if m:
+                chapters[('new', m.group(1).upper(), m.group(3))].append((int(m.group(2)), entry))
+                continue
+            m = _gopro_old_re.match(entry.name)
+            if m:
+                chapters[('old', m.group(2))].append((int(m.group(1) or 0), entry))
+        for parts in chapters.values():
+            if len(parts) < 2:
+                continue
+            parts.sort(key=lambda x: x[0])
+            members = [entry for _, entry in parts]
+            groups.append(Group('clip', members[0], members=members))
+            claimed.update(m.path for m in members)
+
+        # Split MTS (AVCHD) and DCIM clips: consecutively numbered files where
+        # each one but the last stopped just short of the FAT32 limits.
+        spannable = rel_dir.lower().split(os.path.sep)[-1:] == ['stream'] or _is_dcim(rel_dir)
+        if spannable:
+            run = []
+            for entry in dir_entries:
+                if entry.path in claimed or entry.type != 'footage':
+                    continue
+                m = _frame_re.match(entry.name)
+                if run:
+                    prev = run[-1]
+                    pm = _frame_re.match(prev.name)
+                    if (m and pm and m.group(1) == pm.group(1) and m.group(3).lower() == pm.group(3).lower()
+                        and int(m.group(2)) == int(pm.group(2)) + 1 and _near_span_limit(prev.size)
+                    ):
+                        run.append(entry)
+                        continue
+                    if len(run) > 1:
+                        groups.append(Group('clip', run[0], members=run))
+                        claimed.update(x.path for x in run)
+                run = [entry] if m else []
+            if len(run) > 1:
+                groups.append(Group('clip', run[0], members=run))
+                claimed.update(x.path for x in run)
+
+        leftovers.extend(e for e in dir_entries if e.path not in claimed)
+
+    return groups, leftovers
+
+
+def group_entries(entries):
+    '''Group scanned entries into :class:`Group` objects, one per Element.
+
+    Sidecar files (type ``"sidecar"``) which don't belong to a clip are
+    dropped. Returns groups sorted by the primary's relative path.
+
+    '''
+
+    groups, leftovers = _group_sequences(entries)
+    clip_groups, leftovers = _group_clips(leftovers)
+    groups.extend(clip_groups)
+
+    for entry in leftovers:
+        if entry.type != 'sidecar':
+            groups.append(Group('file', entry))
+
+    groups.sort(key=lambda g: g.primary.rel_path)
+    return groups
@@ -0,0 +1,107 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+def default_path():
+    return os.environ.get('MMEDIT_HASH_CACHE') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'mmedit', 'hashes.sqlite'
+    )
+
+
+def stat_key(st):
+    '''The identity of a file's content, as far as we can tell without reading it.
+
+    Hardlinks share their inode, so the relink trees and multiple Elements
+    registered against the same bytes all resolve to the same key.
+
+    '''
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None: # Python 2.
+        mtime_ns = int(st.st_mtime * 1e9)
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns)
+
+
+class HashCache(object):
+
+    '''On-disk cache of file digests, keyed by device, inode, size, mtime, and
+    hash algorithm.
+
+    Least-recently-used entries are evicted once there are more than
+    ``max_entries`` of them; we only check every ``evict_interval`` writes
+    so that counting the table doesn't dominate.
+
+    '''
+
+    def __init__(self, path=None, max_entries=1000000, evict_interval=1000):
+
+        self.path = path or default_path()
+        self.max_entries = max_entries
+        self.evict_interval = evict_interval
+        self._writes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        dir_ = os.path.dirname(self.path)
+        if dir_ and not os.path.exists(dir_):
+            os.makedirs(dir_)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS hashes (
+                dev INTEGER NOT NULL,
+                ino INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                algorithm TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                used_at REAL NOT NULL,
+                PRIMARY KEY (dev, ino, size, mtime_ns, algorithm)
+            )''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS hashes_used_at ON hashes (used_at)')
+
+    def close(self):
+        with self._lock:
+            self._evict()
+            self._db.close()
+
+    def get(self, st, algorithm):
+        key = stat_key(st) + (algorithm, )
+        with self._lock:
+            row = self._db.execute('''SELECT digest FROM hashes WHERE
+                dev = ? AND ino = ? AND size = ? AND mtime_ns = ? AND algorithm = ?
+            ''', key).fetchone()
+            if row is None:
+                self.misses += 1
+                return
+            self.hits += 1
+            with self._db:
+                self._db.execute('''UPDATE hashes SET used_at = ? WHERE
+                    dev = ? AND ino = ? AND size = ? AND mtime_ns = ? AND algorithm = ?
+                ''', (time.time(), ) + key)
+        return str(row[0])
+
+    def set(self, st, algorithm, digest):
+        key = stat_key(st) + (algorithm, )
+        with self._lock:
+            with self._db:
+                self._db.execute('''INSERT OR REPLACE INTO hashes
+                    (dev, ino, size, mtime_ns, algorithm, digest, used_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', key + (digest, time.time()))
+            self._writes += 1
+            if self._writes % self.evict_interval == 0:
+                self._evict()
+
+    def _evict(self):
+        count = self._db.execute('SELECT COUNT(*) FROM hashes').fetchone()[0]
+        excess = count - self.max_entries
+        if excess <= 0:
+            return
+        with self._db:
+            self._db.execute('''DELETE FROM hashes WHERE rowid IN (
+                SELECT rowid FROM hashes ORDER BY used_at LIMIT ?
+            )''', (excess, ))
@@ -0,0 +1,106 @@
+import hashlib
+import threading
+
+from .stats import get_stats
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+BUFFER_SIZE = 4 * 1024 * 1024
+
+ALGORITHMS = ['md5', 'sha1', 'sha256']
+if xxhash is not None:
+    ALGORITHMS.append('xxh64')
+
+
+def new_hasher(name):
+    if name == 'xxh64':
+        if xxhash is None:
+            raise ValueError('xxhash is not installed.')
+        return xxhash.xxh64()
+    return hashlib.new(name)
+
+
+_buffers = threading.local()
+
+def _get_buffer(size):
+    # One buffer per thread, reused for every file that thread reads.
+    buf = getattr(_buffers, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = _buffers.buf = bytearray(size)
+    return buf
+
+
+def hash_file(path, names=('md5', ), buffer_size=BUFFER_SIZE):
+    '''Hash a file with several algorithms in a single read pass.
+
+    Returns a dict mapping algorithm name to hex digest.
+
+    '''
+
+    hashers = [(name, new_hasher(name)) for name in names]
+
+    buf = _get_buffer(buffer_size)
+    view = memoryview(buf)
+
+    total = 0
+    with open(path, 'rb', 0) as fh:
+        while True:
+            size = fh.readinto(buf)
+            if not size:
+                break
+            total += size
+            chunk = view[:size] if size < buffer_size else view
+            for _, hasher in hashers:
+                hasher.update(chunk)
+
+    stats = get_stats()
+    stats.count('hash.files')
+    stats.count('hash.bytes', total)
+
+    return dict((name, hasher.hexdigest()) for name, hasher in hashers)
+
+
+SAMPLE_BLOCKS = 16
+SAMPLE_BLOCK_SIZE = 1024 * 1024
+
+def sample_fingerprint(path, blocks=SAMPLE_BLOCKS, block_size=SAMPLE_BLOCK_SIZE, size=None):
+    '''A cheap fingerprint of a file from its size, head, tail, and ``blocks``
+    evenly strided blocks between them.
+
+    Returns ``"size:blocks:block_size:md5"``, so that the parameters used are
+    stored alongside the digest.
+
+    '''
+
+    with open(path, 'rb', 0) as fh:
+
+        if size is None:
+            fh.seek(0, 2)
+            size = fh.tell()
+
+        hasher = hashlib.md5()
+        hasher.update(str(size).encode('ascii'))
+
+        if size <= (blocks + 2) * block_size:
+            offsets = [0]
+            read_size = size
+        else:
+            stride = (size - block_size) // (blocks + 1)
+            offsets = [i * stride for i in range(blocks + 1)] + [size - block_size]
+            read_size = block_size
+
+        for offset in offsets:
+            fh.seek(offset)
+            hasher.update(fh.read(read_size))
+
+    return '%d:%d:%d:%s' % (size, blocks, block_size, hasher.hexdigest())
+
+
+def parse_fingerprint(fingerprint):
+    '''Returns ``(size, blocks, block_size, digest)``.'''
+    size, blocks, block_size, digest = fingerprint.split(':')
+    return int(size), int(blocks), int(block_size), digest
@@ -1,18 +1,29 @@
 from __future__ import print_function 
 
+import calendar
 import os
 import re
+import threading
+import time
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor
 from sgfs import SGFS
 
-from .utils import guess_type
+from .grouping import Group, group_entries
+from .manifest import Manifest
+from .pathmap import map_path
+from .probe import ProbeCache, probe_many, dumps as dump_probe
+from .scanner import EXCLUDE_DIRS, scan
+from .stats import add_stats_arguments, instrument_session, setup_stats
 
 
-EXCLUDE_DIRS = set('''
-    __junk__
-'''.strip().split())
+# The code of an ElementSet while its Elements are still being created.
+PLACEHOLDER_CODE = '__creating__'
 
+# A placeholder which has had Elements added to it more recently than this
+# is assumed to belong to an ingest which is still running.
+LIVE_INGEST_SECONDS = 10 * 60
 
 
 def create_element(element_set, data, sg, verbose=False):
@@ -36,8 +47,15 @@ def create_element(element_set, data, sg, verbose=False):
     sg.create('Element', data)
 
 
-def create_element_set(set_data, element_data, sgfs, verbose=False):
-    '''Creates an ElementSet with a set of Elements on Shotgun.'''
+def create_element_set(set_data, element_data, sgfs, verbose=False,
+    element_set=None, **kwargs
+):
+    '''Creates an ElementSet with a set of Elements on Shotgun.
+
+    If an ``element_set`` is given, it is a placeholder left by a previous
+    run which did not finish, and we carry on populating it.
+
+    '''
 
     sg = sgfs.session
 
@@ -45,23 +63,158 @@ def create_element_set(set_data, element_data, sgfs, verbose=False):
         print('Creating ElementSet:', set_data.get('code'))
 
     # Create a placeholder; we need something to link our Element(s) against,
-    # but want it to look incomplete until it is not.
-    element_set = sg.create('$ElementSet', { 
-        'sg_path': '',
-        'code': '__creating__',
-        'project': set_data['project'],
-    })
+    # but want it to look incomplete until it is not. It does get the real
+    # path, so that an interrupted ingest can find it again to resume.
+    if not element_set:
+        element_set = sg.create('$ElementSet', {
+            'sg_path': set_data['sg_path'],
+            'code': PLACEHOLDER_CODE,
+            'project': set_data['project'],
+        })
 
-    _create_elements_in_set(sg, element_set, element_data, verbose=verbose)
+    _create_elements_in_set(sg, element_set, element_data, verbose=verbose, **kwargs)
 
     sg.update('$ElementSet', element_set['id'], set_data)
 
     return element_set
 
 
-def _create_elements_in_set(sg, element_set, element_data, verbose=False):
-    for item in element_data: 
-        create_element(element_set, item, sg, verbose=verbose)
+def _create_elements_in_set(sg, element_set, element_data, verbose=False,
+    chunk_size=100, threads=1, retries=2
+):
+    '''Create Elements via batched requests of ``chunk_size`` at a time.
+
+    Chunks are submitted from ``threads`` threads, each with their own
+    Session. A chunk which fails is retried after checking which of its
+    Elements (by ``sg_uuid``) made it; if it still fails we raise, and the
+    ingest can be resumed by running it again.
+
+    '''
+
+    chunks = [element_data[i:i + chunk_size] for i in range(0, len(element_data), chunk_size)]
+
+    if threads <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            _create_chunk(sg, element_set, chunk, verbose=verbose, retries=retries)
+        return
+
+    local = threading.local()
+    def create_chunk(chunk):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = instrument_session(type(sg)())
+        _create_chunk(session, element_set, chunk, verbose=verbose, retries=retries)
+
+    executor = ThreadPoolExecutor(threads)
+    futures = [executor.submit(create_chunk, chunk) for chunk in chunks]
+    executor.shutdown(wait=True)
+    for future in futures:
+        future.result()
+
+
+def _create_chunk(sg, element_set, chunk, verbose=False, retries=2):
+
+    for attempt in range(retries + 1):
+
+        if attempt:
+            # Shotgun batches are transactional, but we may have lost the
+            # response to one which went through.
+            existing = set(e['sg_uuid'] for e in sg.find('Element', [
+                ('sg_element_set', 'is', element_set),
+                ('sg_uuid', 'in', [item['sg_uuid'] for item in chunk]),
+            ], ['sg_uuid']))
+            chunk = [item for item in chunk if item['sg_uuid'] not in existing]
+            if not chunk:
+                return
+
+        requests = []
+        for item in chunk:
+            data = item.copy()
+            data['sg_element_set'] = element_set
+            data['project'] = element_set['project']
+            if verbose:
+                print('Creating Element:', data.get('code'))
+            requests.append({
+                'request_type': 'create',
+                'entity_type': 'Element',
+                'data': data,
+            })
+
+        try:
+            sg.batch(requests)
+            return
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print('Batch of {} Elements failed ({}); retrying.'.format(len(chunk), e))
+
+
+def _probe_specs(element_specs, processes=None):
+    '''Fill in sg_metadata from ffprobe (via the probe cache).'''
+
+    # Probe (and so cache) the mapped path, as proxy does, so that it finds
+    # these probes in the cache instead of running ffprobe again.
+    specs_by_path = {}
+    for spec in element_specs:
+        if spec['sg_type'] in ('footage', 'audio') and not spec.get('sg_frames'):
+            specs_by_path[map_path(spec['sg_path'])] = spec
+    if not specs_by_path:
+        return
+
+    print("Probing {} files...".format(len(specs_by_path)))
+
+    cache = ProbeCache()
+    errors = 0
+    for path, probe, error in probe_many(list(specs_by_path), cache=cache, processes=processes):
+        if error:
+            errors += 1
+            continue
+        specs_by_path[path]['sg_metadata'] = dump_probe(probe)
+    cache.close()
+
+    print("Probed {} files ({} from cache, {} failed).".format(len(specs_by_path), cache.hits, errors))
+
+
+def find_element_sets(sg, root):
+    '''Find the ElementSets already at the given root.
+
+    Returns ``(element_set, placeholder)``: the newest completed set, and the
+    newest placeholder left by an ingest which has not finished (or either
+    is None).
+
+    '''
+    order = [{'field_name': 'id', 'direction': 'desc'}]
+    element_set = sg.find_one('$ElementSet', [
+        ('sg_path', 'is', root),
+        ('code', 'is_not', PLACEHOLDER_CODE),
+    ], ['project', 'code'], order=order)
+    placeholder = sg.find_one('$ElementSet', [
+        ('sg_path', 'is', root),
+        ('code', 'is', PLACEHOLDER_CODE),
+    ], ['project', 'code', 'created_at'], order=order)
+    return element_set, placeholder
+
+
+def seconds_since_activity(sg, element_set):
+    '''Seconds since an Element was last added to the set (or it was created).
+
+    Returns None if Shotgun doesn't say.
+
+    '''
+    latest = sg.find_one('Element', [
+        ('sg_element_set', 'is', element_set),
+    ], ['created_at'], order=[{'field_name': 'created_at', 'direction': 'desc'}])
+    created_at = (latest or element_set).get('created_at')
+    if created_at is None:
+        return
+    return time.time() - calendar.timegm(created_at.utctimetuple())
+
+
+def _save_manifest(root, entries, dirs, element_set):
+    try:
+        Manifest.from_scan(root, entries, dirs, element_set['id']).save()
+    except (IOError, OSError) as e:
+        print("Could not save scan manifest:", e)
 
 
 def main():
@@ -79,23 +232,42 @@ def main():
         help="Force creating a new ElementSet if this has already been ingested.")
     parser.add_argument('-u', '--update', action='store_true',
         help="Update this element set instead of creating a new one.")
+    parser.add_argument('--no-group', action='store_true',
+        help="Don't collapse image sequences and multi-file clips into single Elements.")
+    parser.add_argument('--no-probe', action='store_true',
+        help="Don't run ffprobe to fill in sg_metadata.")
+    parser.add_argument('--probe-processes', type=int,
+        help="How many ffprobes to run at once; defaults to the number of CPUs.")
+    parser.add_argument('--rescan', action='store_true',
+        help="Ignore the manifest from the last scan, and check every file against Shotgun.")
+    parser.add_argument('--resume', action='store_true',
+        help="Resume an interrupted ingest even if it looks like it is still running.")
 
     parser.add_argument('-y', '--yes', action='store_true',
         help="Don't ask for permission.")
     parser.add_argument('-n', '--dry-run', action='store_true',
         help="Don't actually do anything; preview in the ingest.")
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-j', '--scan-threads', type=int, default=16,
+        help="How many directories to list in parallel.")
+    parser.add_argument('--chunk-size', type=int, default=100,
+        help="How many Elements to create in each batch request.")
+    parser.add_argument('--create-threads', type=int, default=1,
+        help="How many batches to submit in parallel.")
+
+    add_stats_arguments(parser)
 
     parser.add_argument('root',
         help="Directory of footage to ingest.")
 
     args = parser.parse_args()
+    stats = setup_stats(args, 'ingest')
 
     # Normalize arguments.
     args.root = os.path.abspath(args.root)
 
     sgfs = SGFS()
-    sg = sgfs.session
+    sg = instrument_session(sgfs.session)
 
     existing_elements = set()
     element_specs = []
@@ -115,16 +287,34 @@ def main():
             exit(2)
         project = projects[0]
 
-    # Find an existing ElementSet.
-    element_set = sg.find_one('$ElementSet', [
-        ('sg_path', 'is', args.root),
-    ], ['project'])
-    if args.update:
+    # Find an existing ElementSet, or the placeholder of an interrupted ingest
+    # to resume (unless we're updating a complete one).
+    element_set, placeholder = find_element_sets(sg, args.root)
+    resuming = bool(placeholder and not args.force and not (args.update and element_set))
+    if resuming:
+        age = seconds_since_activity(sg, placeholder)
+        if age is not None and age < LIVE_INGEST_SECONDS and not args.resume:
+            print("ElementSet {} is still being ingested (an Element was added {:.0f}s ago).".format(
+                placeholder['id'], age))
+            print("Wait for that to finish, or resume it with --resume if it has died.")
+            exit(6)
+        element_set = placeholder
+    manifest = None
+    if args.update or resuming:
         if not element_set:
             print("Could not find existing ElementSet at:", args.root)
             exit(4)
-        for element in sg.find('Element', [('sg_element_set', 'is', element_set)], ['sg_relative_path']):
-            existing_elements.add(element['sg_relative_path'])
+        if resuming:
+            print("Resuming interrupted ingest into ElementSet", element_set['id'])
+        # With a manifest from the last scan we only need to ask Shotgun
+        # about what changed since then.
+        if args.update and not args.rescan:
+            manifest = Manifest.load(args.root)
+            if manifest and manifest.element_set_id != element_set['id']:
+                manifest = None
+        if not manifest:
+            for element in sg.find('Element', [('sg_element_set', 'is', element_set)], ['sg_relative_path']):
+                existing_elements.add(element['sg_relative_path'])
     else:
         if element_set and not args.force:
             print("There is already an ElementSet here!")
@@ -133,37 +323,79 @@ def main():
 
     print("Scanning for footage...")
 
-    for dir_path, dir_names, file_names in os.walk(args.root, topdown=True):
-
-        # Exclude some dirs (just __junk__ at this point).
-        dir_names[:] = [x for x in dir_names if x.lower() not in EXCLUDE_DIRS]
-
-        for name in file_names:
-            abs_path = os.path.join(dir_path, name)
-            
-            type_ = guess_type(abs_path)
-            if not type_:
-                continue
-
-            rel_path = os.path.relpath(abs_path, args.root)
-            filename, _ = os.path.splitext(name)  
+    scanned_dirs = {}
+    scan_stats = {}
+    with stats.span('scan'):
+        entries = list(scan(args.root, EXCLUDE_DIRS,
+            threads=args.scan_threads,
+            stat=True,
+            sidecars=not args.no_group,
+            previous=manifest.dir_records() if manifest else None,
+            dirs=scanned_dirs,
+            stats=scan_stats,
+        ))
+
+    # The scan finishes directories in whatever order they come back.
+    entries.sort(key=lambda entry: entry.rel_path)
+
+    if scan_stats['errors']:
+        print("Could not scan {} directories; their footage will not be ingested.".format(scan_stats['errors']))
+
+    candidates = None
+    if manifest:
+        added, changed, removed = manifest.diff(entries)
+        print("Since the last scan: {} added, {} changed, {} removed ({} directories listed, {} unchanged).".format(
+            len(added), len(changed), len(removed), scan_stats['listed'], scan_stats['reused'],
+        ))
+        for rel_path in changed:
+            print('[changed] %s' % rel_path)
+        for rel_path in removed:
+            print('[removed] %s' % rel_path)
+        candidates = set(added + changed)
+        candidate_list = sorted(candidates)
+        for i in range(0, len(candidate_list), 500):
+            for element in sg.find('Element', [
+                ('sg_element_set', 'is', element_set),
+                ('sg_relative_path', 'in', candidate_list[i:i + 500]),
+            ], ['sg_relative_path']):
+                existing_elements.add(element['sg_relative_path'])
+
+    with stats.span('group'):
+        if args.no_group:
+            groups = [Group('file', entry) for entry in entries]
+        else:
+            groups = group_entries(entries)
 
-            # If we are updating, and already have this one, skip it.
-            if rel_path in existing_elements:
-                continue
+    for group in groups:
 
-            print('[%7s] %s' % (type_, rel_path))
+        entry = group.primary
 
-            element_specs.append({
-                'code': filename,
-                'sg_uuid': str(uuid.uuid4()), # uuid4 is the random one.
-                'sg_type': type_,
-                'sg_path': abs_path,
-                'sg_relative_path': rel_path,
-            })
+        # If we are updating, and already have this one, skip it.
+        if candidates is not None and candidates.isdisjoint(group.rel_paths):
+            continue
+        if entry.rel_path in existing_elements:
+            continue
 
-    if not element_specs:
+        if group.kind == 'sequence':
+            print('[%7s] %s (%d frames)' % (entry.type, entry.rel_path, len(group.frames)))
+        elif group.kind == 'clip':
+            print('[%7s] %s (+%d files)' % (entry.type, entry.rel_path, len(group.members) - 1))
+        else:
+            print('[%7s] %s' % (entry.type, entry.rel_path))
+
+        spec = {
+            'sg_uuid': str(uuid.uuid4()), # uuid4 is the random one.
+            'sg_type': entry.type,
+            'sg_path': entry.path,
+            'sg_relative_path': entry.rel_path,
+        }
+        spec.update(group.element_fields())
+        element_specs.append(spec)
+
+    if not element_specs and not resuming:
         print("Nothing to ingest.")
+        if element_set and args.update and not args.dry_run:
+            _save_manifest(args.root, entries, scanned_dirs, element_set)
         exit(0)
 
     # Get the user's permission to go ahead.
@@ -174,15 +406,29 @@ def main():
 
     if not args.dry_run:
 
-        if args.update:
-            _create_elements_in_set(sgfs.session, element_set, element_specs, verbose=args.verbose)
-        else:
-            element_set = create_element_set({
-                'code': args.name or os.path.basename(args.root),
-                'sg_path': args.root,
-                'project': project,
-            }, element_specs, sgfs, verbose=args.verbose)
-            print(element_set['id'])
+        if not args.no_probe:
+            with stats.span('probe'):
+                _probe_specs(element_specs, processes=args.probe_processes)
+
+        create_kwargs = dict(
+            verbose=args.verbose,
+            chunk_size=args.chunk_size,
+            threads=args.create_threads,
+        )
+
+        with stats.span('create'):
+            if args.update and not resuming:
+                _create_elements_in_set(sgfs.session, element_set, element_specs, **create_kwargs)
+            else:
+                element_set = create_element_set({
+                    'code': args.name or os.path.basename(args.root),
+                    'sg_path': args.root,
+                    'project': project,
+                }, element_specs, sgfs, element_set=element_set if resuming else None, **create_kwargs)
+                print(element_set['id'])
+        stats.count('ingest.elements', len(element_specs))
+
+        _save_manifest(args.root, entries, scanned_dirs, element_set)
 
 
 
@@ -0,0 +1,115 @@
+import collections
+import hashlib
+import json
+import os
+import time
+
+
+DirRecord = collections.namedtuple('DirRecord', 'mtime subdirs files')
+
+
+def default_manifest_dir():
+    return os.environ.get('MMEDIT_MANIFEST_DIR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'mmedit', 'manifests'
+    )
+
+
+def manifest_path(root):
+    # Not within the root, since writing it there would change the root's
+    # mtime, and so the next scan could never reuse the root's listing.
+    root = os.path.abspath(root)
+    if not isinstance(root, bytes):
+        root = root.encode('utf8')
+    key = hashlib.sha1(root).hexdigest()
+    return os.path.join(default_manifest_dir(), key + '.json')
+
+
+class Manifest(object):
+
+    '''What a scan of an ElementSet found, so that the next ``--update`` can
+    skip listing directories which haven't changed.
+
+    Stored as JSON in :func:`default_manifest_dir` (``$MMEDIT_MANIFEST_DIR``,
+    or ``~/.cache/mmedit/manifests``), named by a hash of the root.
+
+    '''
+
+    def __init__(self, root, element_set_id=None, files=None, dirs=None, scanned_at=None):
+        self.root = root
+        self.element_set_id = element_set_id
+        self.files = files or {} # rel_path -> (size, mtime)
+        self.dirs = dirs or {} # rel_dir -> (mtime, [subdir names])
+        self.scanned_at = scanned_at
+
+    @classmethod
+    def load(cls, root):
+        try:
+            with open(manifest_path(root)) as fh:
+                raw = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return
+        return cls(root,
+            element_set_id=raw.get('element_set_id'),
+            files=dict((k, tuple(v)) for k, v in raw['files'].items()),
+            dirs=dict((k, tuple(v)) for k, v in raw['dirs'].items()),
+            scanned_at=raw.get('scanned_at'),
+        )
+
+    @classmethod
+    def from_scan(cls, root, entries, dirs, element_set_id=None):
+        return cls(root,
+            element_set_id=element_set_id,
+            files=dict((e.rel_path, (e.size, e.mtime)) for e in entries),
+            dirs=dirs,
+            scanned_at=time.time(),
+        )
+
+    def save(self):
+        path = manifest_path(self.root)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = '%s.tmp-%d' % (path, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump({
+                'version': 1,
+                'root': os.path.abspath(self.root),
+                'element_set_id': self.element_set_id,
+                'scanned_at': self.scanned_at,
+                'dirs': self.dirs,
+                'files': self.files,
+            }, fh, sort_keys=True, separators=(',', ':'))
+        os.rename(tmp, path)
+
+    def dir_records(self):
+        '''Index for :func:`.scanner.scan`'s ``previous`` argument.'''
+
+        files_by_dir = collections.defaultdict(list)
+        for rel_path, (size, mtime) in self.files.items():
+            files_by_dir[os.path.dirname(rel_path)].append((os.path.basename(rel_path), size, mtime))
+
+        return dict(
+            (rel_dir, DirRecord(mtime, subdirs, files_by_dir.get(rel_dir, ())))
+            for rel_dir, (mtime, subdirs) in self.dirs.items()
+        )
+
+    def diff(self, entries):
+        '''Compare a new scan against this one.
+
+        Returns ``(added, changed, removed)`` lists of relative paths.
+
+        '''
+
+        added = []
+        changed = []
+        seen = set()
+        for entry in entries:
+            seen.add(entry.rel_path)
+            old = self.files.get(entry.rel_path)
+            if old is None:
+                added.append(entry.rel_path)
+            elif tuple(old) != (entry.size, entry.mtime):
+                changed.append(entry.rel_path)
+
+        removed = [x for x in self.files if x not in seen]
+
+        return sorted(added), sorted(changed), sorted(removed)
@@ -0,0 +1,400 @@
+'''A local SQLite mirror of $ElementSets and Elements.
+
+``mmedit-sync`` pulls whatever changed since the last sync (by
+``updated_at``), and the read-only paths of the other tools can then run
+against the mirror with ``--offline`` (a.k.a. ``--cached``), which is much
+faster, and works without Shotgun.
+
+Only the filters those tools use are supported by :class:`MirrorSession`.
+
+'''
+
+from __future__ import print_function
+
+import calendar
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+ELEMENT_SET_TYPE = 'CustomEntity27'
+
+ELEMENT_SET_FIELDS = ['code', 'project', 'sg_path', 'sg_type', 'updated_at']
+ELEMENT_FIELDS = [
+    'code', 'project', 'sg_element_set', 'sg_path', 'sg_relative_path', 'sg_uuid',
+    'sg_type', 'sg_checksum', 'sg_checksums', 'sg_fingerprint', 'sg_frames',
+    'sg_members', 'updated_at',
+]
+
+# Columns (beyond the JSON) that we filter on.
+_COLUMNS = {
+    ELEMENT_SET_TYPE: ('project_id', 'code'),
+    'Element': ('project_id', 'element_set_id', 'sg_path', 'sg_checksum'),
+}
+_TABLES = {
+    ELEMENT_SET_TYPE: 'element_sets',
+    'Element': 'elements',
+}
+
+
+def default_path():
+    return os.environ.get('MMEDIT_MIRROR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'mmedit', 'mirror.sqlite'
+    )
+
+
+def _timestamp(value):
+    '''Shotgun datetimes (which are timezone aware) to seconds since the epoch.'''
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return time.mktime(value.timetuple())
+        return calendar.timegm(value.utctimetuple())
+    return value
+
+
+def _plain(value):
+    '''Make a field value JSON-able (and drop the session from entities).'''
+    if isinstance(value, dict):
+        return dict((k, _plain(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_plain(x) for x in value]
+    if isinstance(value, datetime.datetime):
+        return _timestamp(value)
+    return value
+
+
+def _link_id(value):
+    return value['id'] if isinstance(value, dict) else value
+
+
+class MirrorEntity(dict):
+
+    '''Just enough of an sgsession Entity for the render work code.'''
+
+    def __init__(self, data, session=None):
+        super(MirrorEntity, self).__init__(data)
+        self.session = session
+
+    def fetch(self, fields, force=False):
+        if isinstance(fields, (list, tuple)):
+            return [self.get(field) for field in fields]
+        return self.get(fields)
+
+
+class Mirror(object):
+
+    def __init__(self, path=None):
+
+        self.path = path or default_path()
+
+        dir_ = os.path.dirname(self.path)
+        if dir_ and not os.path.exists(dir_):
+            os.makedirs(dir_)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS element_sets (
+                id INTEGER PRIMARY KEY,
+                project_id INTEGER,
+                code TEXT,
+                updated_at REAL,
+                data TEXT NOT NULL
+            )''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS elements (
+                id INTEGER PRIMARY KEY,
+                project_id INTEGER,
+                element_set_id INTEGER,
+                sg_path TEXT,
+                sg_checksum TEXT,
+                updated_at REAL,
+                data TEXT NOT NULL
+            )''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS projects (
+                id INTEGER PRIMARY KEY,
+                name TEXT
+            )''')
+            self._db.execute('''CREATE TABLE IF NOT EXISTS syncs (
+                entity_type TEXT NOT NULL,
+                project_id INTEGER NOT NULL,
+                updated_at REAL,
+                synced_at REAL,
+                PRIMARY KEY (entity_type, project_id)
+            )''')
+            self._db.execute('CREATE INDEX IF NOT EXISTS element_sets_project ON element_sets (project_id)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS elements_element_set ON elements (element_set_id)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS elements_path ON elements (sg_path)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS elements_checksum ON elements (sg_checksum)')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def last_sync(self, entity_type, project_id=None):
+        '''Returns ``(updated_at, synced_at)`` of the last sync (or Nones).'''
+        with self._lock:
+            row = self._db.execute('SELECT updated_at, synced_at FROM syncs WHERE entity_type = ? AND project_id = ?',
+                (entity_type, project_id or 0)).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def store(self, entity_type, entities):
+        '''Insert or replace (plain, i.e. JSON-able) entities; returns the latest ``updated_at``.'''
+
+        table = _TABLES[entity_type]
+        columns = _COLUMNS[entity_type]
+        latest = None
+        rows = []
+        projects = {}
+        for entity in entities:
+            project = entity.get('project')
+            if isinstance(project, dict):
+                projects[project['id']] = project.get('name')
+            values = {
+                'project_id': _link_id(project),
+                'element_set_id': _link_id(entity.get('sg_element_set')),
+                'code': entity.get('code'),
+                'sg_path': entity.get('sg_path'),
+                'sg_checksum': entity.get('sg_checksum') or None,
+            }
+            rows.append([entity['id']] + [values[c] for c in columns] + [entity.get('updated_at'), json.dumps(entity)])
+            if entity.get('updated_at') is not None and (latest is None or entity['updated_at'] > latest):
+                latest = entity['updated_at']
+
+        sql = 'INSERT OR REPLACE INTO %s (id, %s, updated_at, data) VALUES (%s)' % (
+            table, ', '.join(columns), ', '.join('?' * (len(columns) + 3)))
+        with self._lock:
+            with self._db:
+                self._db.executemany(sql, rows)
+                self._db.executemany('INSERT OR REPLACE INTO projects (id, name) VALUES (?, ?)', projects.items())
+        return latest
+
+    def mark_synced(self, entity_type, project_id, updated_at):
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO syncs (entity_type, project_id, updated_at, synced_at) VALUES (?, ?, ?, ?)',
+                    (entity_type, project_id or 0, updated_at, time.time()))
+
+    def delete_missing(self, entity_type, project_id, keep_ids):
+        '''Delete entities (of a project) which aren't in ``keep_ids``; returns how many.'''
+        table = _TABLES[entity_type]
+        where, params = ('WHERE project_id = ?', [project_id]) if project_id else ('', [])
+        with self._lock:
+            ids = [row[0] for row in self._db.execute('SELECT id FROM %s %s' % (table, where), params)]
+            gone = [(id_, ) for id_ in ids if id_ not in keep_ids]
+            with self._db:
+                self._db.executemany('DELETE FROM %s WHERE id = ?' % table, gone)
+        return len(gone)
+
+    def query(self, entity_type, where=(), params=(), order='id', limit=None, offset=None):
+        sql = 'SELECT data FROM %s' % _TABLES[entity_type]
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + order
+        if limit:
+            sql += ' LIMIT %d OFFSET %d' % (limit, offset or 0)
+        with self._lock:
+            return [json.loads(row[0]) for row in self._db.execute(sql, list(params))]
+
+    def project_by_name(self, name):
+        with self._lock:
+            row = self._db.execute('SELECT id, name FROM projects WHERE name = ?', (name, )).fetchone()
+        return {'type': 'Project', 'id': row[0], 'name': row[1]} if row else None
+
+
+class MirrorSession(object):
+
+    '''Answers (some of) ``find`` from a :class:`Mirror`, like an sgsession Session.'''
+
+    def __init__(self, mirror=None):
+        self.mirror = mirror or Mirror()
+
+    def _where(self, entity_type, filters):
+        where = []
+        params = []
+        for field, op, value in filters:
+            if field == 'id' and op == 'is':
+                where.append('id = ?')
+                params.append(value)
+            elif field == 'project' and op == 'is':
+                where.append('project_id = ?')
+                params.append(_link_id(value))
+            elif field == 'code' and op == 'is' and entity_type == ELEMENT_SET_TYPE:
+                where.append('code = ?')
+                params.append(value)
+            elif field == 'sg_element_set' and op == 'is':
+                where.append('element_set_id = ?')
+                params.append(_link_id(value))
+            elif field == 'sg_element_set' and op == 'in':
+                ids = [_link_id(x) for x in value]
+                where.append('element_set_id IN (%s)' % ', '.join('?' * len(ids)) if ids else '0')
+                params.extend(ids)
+            elif field == 'sg_path' and op == 'is':
+                where.append('sg_path = ?')
+                params.append(value)
+            elif field == 'sg_checksum' and op == 'is' and not value:
+                where.append('sg_checksum IS NULL')
+            elif field == 'sg_checksum' and op == 'is_not' and not value:
+                where.append('sg_checksum IS NOT NULL')
+            else:
+                raise ValueError('Filter is not supported offline.', (field, op, value))
+        return where, params
+
+    def find(self, entity_type, filters, fields=None, order=None, limit=None, page=None, **_):
+        if entity_type not in _TABLES:
+            raise ValueError('Entity type is not mirrored.', entity_type)
+        where, params = self._where(entity_type, filters)
+        rows = self.mirror.query(entity_type, where, params,
+            order='element_set_id, id' if entity_type == 'Element' else 'id',
+            limit=limit,
+            offset=(page - 1) * limit if limit and page else None,
+        )
+        return [MirrorEntity(row, self) for row in rows]
+
+    def find_one(self, entity_type, filters, fields=None, **kwargs):
+        found = self.find(entity_type, filters, fields, limit=1, page=1)
+        return found[0] if found else None
+
+    def fetch(self, entities, fields, force=False):
+        pass # Everything we mirror is already there.
+
+
+class MirrorSGFS(object):
+
+    '''Stands in for SGFS in ``iter_render_work`` (and friends) when offline.'''
+
+    def __init__(self, mirror=None):
+        self.session = MirrorSession(mirror)
+
+    def parse_user_input(self, spec, entity_types=None):
+        '''Parse an id, "Type:id", or a Project name or ElementSet code.'''
+
+        entity_types = entity_types or [ELEMENT_SET_TYPE, 'Project']
+        spec = spec.strip()
+
+        type_ = None
+        if ':' in spec:
+            type_, spec = spec.split(':', 1)
+            type_ = ELEMENT_SET_TYPE if type_.strip('$') in ('ElementSet', ELEMENT_SET_TYPE) else type_
+
+        for entity_type in ([type_] if type_ else entity_types):
+            if spec.isdigit():
+                if entity_type == 'Project':
+                    return MirrorEntity({'type': 'Project', 'id': int(spec)}, self.session)
+                found = self.session.find_one(entity_type, [('id', 'is', int(spec))])
+            elif entity_type == 'Project':
+                found = self.session.mirror.project_by_name(spec)
+                found = found and MirrorEntity(found, self.session)
+            else:
+                found = self.session.find_one(entity_type, [('code', 'is', spec)])
+            if found:
+                return found
+
+
+def _iter_pages(sg, entity_type, filters, fields, page_size):
+    page = 1
+    while True:
+        entities = sg.find(entity_type, filters, fields,
+            order=[
+                {'field_name': 'updated_at', 'direction': 'asc'},
+                {'field_name': 'id', 'direction': 'asc'},
+            ],
+            limit=page_size,
+            page=page,
+        )
+        for entity in entities:
+            yield entity
+        if len(entities) < page_size:
+            return
+        page += 1
+
+
+def sync(sg, mirror, project=None, full=False, page_size=500, verbose=False):
+    '''Bring the mirror up to date with Shotgun.
+
+    Only entities updated since the last sync are fetched, unless ``full``,
+    in which case everything is fetched and anything no longer in Shotgun is
+    dropped from the mirror. Returns a dict of counts.
+
+    '''
+
+    project_id = project['id'] if project else None
+    counts = {}
+
+    for entity_type, fields in ((ELEMENT_SET_TYPE, ELEMENT_SET_FIELDS), ('Element', ELEMENT_FIELDS)):
+
+        filters = [('project', 'is', project)] if project else []
+        since, _ = (None, None) if full else mirror.last_sync(entity_type, project_id)
+        if since is not None:
+            # A second of overlap, since Shotgun's times are to the second.
+            filters.append(('updated_at', 'greater_than', datetime.datetime.fromtimestamp(since - 1)))
+
+        start = time.time()
+        latest = [since]
+        seen = set()
+        batch = []
+        def flush():
+            stored = mirror.store(entity_type, batch)
+            latest[0] = stored if latest[0] is None else max(latest[0], stored)
+            del batch[:]
+        for entity in _iter_pages(sg, entity_type, filters, fields, page_size):
+            entity = _plain(entity)
+            seen.add(entity['id'])
+            batch.append(entity)
+            if len(batch) >= page_size:
+                flush()
+        if batch:
+            flush()
+        latest = latest[0]
+
+        deleted = mirror.delete_missing(entity_type, project_id, seen) if full else 0
+        mirror.mark_synced(entity_type, project_id, latest)
+
+        counts[entity_type] = dict(updated=len(seen), deleted=deleted)
+        if verbose:
+            print('{}: {} updated, {} deleted in {:.1f}s.'.format(entity_type, len(seen), deleted, time.time() - start))
+
+    return counts
+
+
+def main():
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mirror',
+        help="Path to the mirror; defaults to $MMEDIT_MIRROR or ~/.cache/mmedit/mirror.sqlite.")
+    parser.add_argument('--full', action='store_true',
+        help="Fetch everything (rather than what changed), and drop what was deleted.")
+    parser.add_argument('--page-size', type=int, default=500)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('project', nargs='?',
+        help="Only sync this Project (which is much faster for big sites).")
+    args = parser.parse_args()
+
+    from sgfs import SGFS
+
+    sgfs = SGFS()
+    project = None
+    if args.project:
+        project = sgfs.parse_user_input(args.project, ['Project'])
+        if not project:
+            print("Could not parse project:", args.project)
+            return 1
+
+    mirror = Mirror(args.mirror)
+    start = time.time()
+    counts = sync(sgfs.session, mirror, project=project, full=args.full, page_size=args.page_size, verbose=args.verbose)
+    mirror.close()
+
+    print('Synced {} ElementSets and {} Elements ({} deleted) in {:.1f}s.'.format(
+        counts[ELEMENT_SET_TYPE]['updated'], counts['Element']['updated'],
+        counts[ELEMENT_SET_TYPE]['deleted'] + counts['Element']['deleted'],
+        time.time() - start,
+    ))
+
+
+if __name__ == '__main__':
+    exit(main() or 0)
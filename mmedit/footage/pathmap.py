@@ -0,0 +1,162 @@
+'''Map paths as Shotgun knows them to where they are mounted here.
+
+Rules are ``(src, dst)`` prefixes, loaded (in increasing priority) from:
+
+- ``/etc/mmedit/pathmap.json`` and ``~/.config/mmedit/pathmap.json``, or the
+  file named by ``$MMEDIT_PATH_MAP`` instead;
+- ``$MMEDIT_PATH_RULES``, as ``src=dst`` pairs separated by semicolons.
+
+Each file looks like::
+
+    {
+        "rules": [["/Volumes/EditOnline/XXX", "/mnt/editonline/XXX"]],
+        "projects": {"XXX": [["/Volumes/EDsource", "/mnt/edsource"]]},
+        "hosts": {"render*": [["/Volumes", "/mnt"]]}
+    }
+
+where project rules apply to the project named by ``$MMEDIT_PROJECT`` (or
+given to :func:`load_rules`), and host rules to hosts matching the pattern.
+Later rules win for the same prefix, and the longest prefix wins otherwise.
+
+'''
+
+import fnmatch
+import json
+import os
+import socket
+
+
+DEFAULT_CONFIGS = (
+    '/etc/mmedit/pathmap.json',
+    os.path.join(os.path.expanduser('~'), '.config', 'mmedit', 'pathmap.json'),
+)
+
+
+def _split(path):
+    return [x for x in os.path.normpath(path).split(os.path.sep) if x]
+
+
+class PathMap(object):
+
+    '''Longest-prefix path mapping, compiled into a trie of path components.
+
+    Results are memoized per directory, so mapping many files in the same
+    few directories only walks the trie once for each directory.
+
+    '''
+
+    def __init__(self, rules=()):
+        self._root = {}
+        self._count = 0
+        self._cache = {}
+        for src, dst in rules:
+            self.add(src, dst)
+
+    def __len__(self):
+        return self._count
+
+    def add(self, src, dst):
+        node = self._root
+        for part in _split(src):
+            node = node.setdefault(part, {})
+        if None not in node:
+            self._count += 1
+        # None can't be a path component, so it holds the target.
+        node[None] = dst.rstrip(os.path.sep) or os.path.sep
+        self._cache.clear()
+
+    def _lookup(self, path):
+        '''Returns ``(mapped, node)``, where node is where the walk stopped.'''
+
+        parts = _split(path)
+        node = self._root
+        best = None
+        for i, part in enumerate(parts):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                best = (node[None], i + 1)
+        if best is None:
+            return path, node
+        dst, used = best
+        return os.path.join(dst, *parts[used:]) if parts[used:] else dst, node
+
+    def __call__(self, path):
+
+        if not self._count or not path.startswith(os.path.sep):
+            return path
+
+        dir_, sep, name = path.rpartition(os.path.sep)
+        try:
+            mapped_dir, node = self._cache[dir_]
+        except KeyError:
+            mapped_dir, node = self._lookup(dir_ or sep)
+            if mapped_dir == (dir_ or sep):
+                mapped_dir = None # Unchanged.
+            self._cache[dir_] = mapped_dir, node
+
+        # A rule for this very file (rather than one of its directories).
+        if node and name in node:
+            return self._lookup(path)[0]
+
+        if mapped_dir is None:
+            return path
+        return mapped_dir.rstrip(sep) + sep + name
+
+
+def _parse_env_rules(value):
+    rules = []
+    for pair in value.split(';'):
+        pair = pair.strip()
+        if pair:
+            src, dst = pair.split('=', 1)
+            rules.append((src.strip(), dst.strip()))
+    return rules
+
+
+def load_rules(paths=None, project=None, host=None, environ=None):
+    '''Load rules from config files and the environment (see the module docs).'''
+
+    environ = os.environ if environ is None else environ
+    project = project or environ.get('MMEDIT_PROJECT')
+    host = host or socket.gethostname()
+
+    if paths is None:
+        paths = [environ['MMEDIT_PATH_MAP']] if environ.get('MMEDIT_PATH_MAP') else DEFAULT_CONFIGS
+
+    # Later wins, so general rules go first, then project, then host.
+    general = []
+    by_project = []
+    by_host = []
+    for path in paths:
+        try:
+            with open(path) as fh:
+                config = json.load(fh)
+        except (IOError, OSError):
+            continue
+        general.extend(config.get('rules', ()))
+        if project:
+            by_project.extend(config.get('projects', {}).get(project, ()))
+        for pattern, rules in sorted(config.get('hosts', {}).items()):
+            if fnmatch.fnmatch(host, pattern) or fnmatch.fnmatch(host.split('.')[0], pattern):
+                by_host.extend(rules)
+
+    rules = [tuple(x) for x in general + by_project + by_host]
+    rules.extend(_parse_env_rules(environ.get('MMEDIT_PATH_RULES', '')))
+    return rules
+
+
+_default = None
+
+def get_path_map():
+    '''The :class:`PathMap` for this process (loaded once).'''
+    global _default
+    if _default is None:
+        _default = PathMap(load_rules())
+    return _default
+
+
+def map_path(path):
+    '''Map a single path with the default rules.'''
+    return get_path_map()(path)
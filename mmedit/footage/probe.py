@@ -0,0 +1,169 @@
+from __future__ import print_function
+
+import json
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+def default_cache_path():
+    return os.environ.get('MMEDIT_PROBE_CACHE') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'mmedit', 'probes.sqlite'
+    )
+
+
+def run_ffprobe(inputs, verbose=False):
+    '''Run ffprobe on the given input arguments (or a single path).'''
+
+    if not isinstance(inputs, (list, tuple)):
+        inputs = [inputs]
+
+    cmd = [
+        'ffprobe',
+        '-v', 'quiet',
+        '-print_format', 'json',
+        '-show_streams',
+        '-show_format',
+    ] + list(inputs)
+    if verbose:
+        print('$', ' '.join(cmd))
+    return json.loads(subprocess.check_output(cmd))
+
+
+STREAM_KEYS = (
+    'index', 'codec_type', 'codec_name', 'codec_tag_string', 'profile',
+    'width', 'height', 'pix_fmt', 'field_order', 'r_frame_rate', 'avg_frame_rate',
+    'sample_rate', 'channels', 'bit_rate', 'duration', 'nb_frames',
+)
+FORMAT_KEYS = ('format_name', 'start_time', 'duration', 'size', 'bit_rate')
+
+def compact(probe):
+    '''Reduce ffprobe output to what we want to keep (e.g. in sg_metadata).'''
+
+    out = {
+        'format': dict((k, v) for k, v in probe.get('format', {}).items() if k in FORMAT_KEYS),
+        'streams': [],
+    }
+
+    timecode = probe.get('format', {}).get('tags', {}).get('timecode')
+    for stream in probe.get('streams', ()):
+        out['streams'].append(dict((k, v) for k, v in stream.items() if k in STREAM_KEYS))
+        timecode = timecode or stream.get('tags', {}).get('timecode')
+    if timecode:
+        out['format']['timecode'] = timecode
+
+    return out
+
+
+def dumps(probe):
+    return json.dumps(probe, sort_keys=True, separators=(',', ':'))
+
+
+class ProbeCache(object):
+
+    '''On-disk cache of (compacted) ffprobe results, keyed by path, size, and mtime.'''
+
+    def __init__(self, path=None):
+
+        self.path = path or default_cache_path()
+
+        self.hits = 0
+        self.misses = 0
+
+        dir_ = os.path.dirname(self.path)
+        if dir_ and not os.path.exists(dir_):
+            os.makedirs(dir_)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db:
+            self._db.execute('''CREATE TABLE IF NOT EXISTS probes (
+                path TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                probe TEXT NOT NULL,
+                probed_at REAL NOT NULL,
+                PRIMARY KEY (path, size, mtime)
+            )''')
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, path, st=None):
+        st = st or os.stat(path)
+        with self._lock:
+            row = self._db.execute('SELECT probe FROM probes WHERE path = ? AND size = ? AND mtime = ?',
+                (path, st.st_size, st.st_mtime)).fetchone()
+        if row is None:
+            self.misses += 1
+            return
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, path, probe, st=None):
+        st = st or os.stat(path)
+        with self._lock:
+            with self._db:
+                self._db.execute('INSERT OR REPLACE INTO probes (path, size, mtime, probe, probed_at) VALUES (?, ?, ?, ?, ?)',
+                    (path, st.st_size, st.st_mtime, dumps(probe), time.time()))
+
+
+def probe(path, cache=None, verbose=False):
+    '''Compacted ffprobe results for a single file, via the cache if given.'''
+
+    st = os.stat(path)
+    if cache:
+        result = cache.get(path, st)
+        if result is not None:
+            return result
+
+    result = compact(run_ffprobe(path, verbose=verbose))
+    if cache:
+        cache.set(path, result, st)
+    return result
+
+
+def _probe_in_worker(path):
+    try:
+        return path, compact(run_ffprobe(path)), None
+    except Exception as e:
+        return path, None, '%s: %s' % (e.__class__.__name__, e)
+
+
+def probe_many(paths, cache=None, processes=None):
+    '''Probe many files, running ffprobe on cache misses from a process pool.
+
+    Yields ``(path, probe, error)`` tuples (in no particular order).
+
+    '''
+
+    misses = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            yield path, None, str(e)
+            continue
+        result = cache.get(path, st) if cache else None
+        if result is None:
+            misses.append((path, st))
+        else:
+            yield path, result, None
+
+    if not misses:
+        return
+
+    executor = ProcessPoolExecutor(processes)
+    try:
+        stats = dict(misses)
+        for path, result, error in executor.map(_probe_in_worker, [path for path, _ in misses]):
+            if cache and result is not None:
+                cache.set(path, result, stats[path])
+            yield path, result, error
+    finally:
+        executor.shutdown(wait=True)
@@ -0,0 +1,179 @@
+'''Follow ffmpeg's ``-progress`` output while it encodes.
+
+Each block of ``key=value`` lines becomes an event, which is (optionally)
+appended to a JSON-lines metrics file, and summarised on stdout every so
+often so that it shows up in the farm's task logs.
+
+'''
+
+from __future__ import print_function
+
+import json
+import os
+import socket
+import threading
+import time
+
+from .stats import get_stats
+
+
+_write_lock = threading.Lock()
+
+
+def default_metrics_path():
+    return os.environ.get('MMEDIT_PROXY_METRICS') or None
+
+
+def parse_time(value):
+    '''Parse ffmpeg's "HH:MM:SS.ffffff" into seconds (or None for "N/A").'''
+    try:
+        hours, minutes, seconds = value.strip().split(':')
+        return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+    except ValueError:
+        return
+
+
+def _number(value, type_=float):
+    try:
+        return type_(value.strip().rstrip('x'))
+    except ValueError:
+        return
+
+
+def iter_progress(lines):
+    '''Turn ffmpeg ``-progress`` lines into a dict per update.
+
+    Yields dicts with ``frame``, ``fps``, ``speed``, ``out_time`` (seconds),
+    ``total_size``, and ``progress`` (``"continue"`` or ``"end"``).
+
+    '''
+
+    block = {}
+    for line in lines:
+        key, _, value = line.strip().partition('=')
+        if not key:
+            continue
+        block[key] = value
+        if key != 'progress':
+            continue
+
+        out_time = parse_time(block.get('out_time', ''))
+        if out_time is None:
+            # Before the first frame this may be junk, or -INT64_MAX.
+            us = _number(block.get('out_time_us', ''), int)
+            if us is not None and us >= 0:
+                out_time = us / 1e6
+        yield {
+            'frame': _number(block.get('frame', ''), int),
+            'fps': _number(block.get('fps', '')),
+            'speed': _number(block.get('speed', '')),
+            'out_time': out_time,
+            'total_size': _number(block.get('total_size', ''), int),
+            'progress': value,
+        }
+        block = {}
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class ProgressReporter(object):
+
+    '''Turns progress updates into metrics events and status lines.
+
+    :param str name: What is being encoded (e.g. the first destination).
+    :param float duration: Seconds of media to encode, for ETAs.
+    :param str metrics_path: JSON-lines file to append events to.
+    :param float status_interval: Seconds between status lines; 0 for none.
+    :param dict extra: Extra fields for every event (e.g. the source codec).
+
+    '''
+
+    def __init__(self, name, duration=None, metrics_path=None, status_interval=10, extra=None):
+        self.name = name
+        self.duration = duration
+        self.metrics_path = metrics_path
+        self.status_interval = status_interval
+        self.extra = extra or {}
+        self.start_time = time.time()
+        self.last = {}
+        self._last_status = self.start_time
+
+    def _event(self, type_, **fields):
+        event = {
+            'event': type_,
+            'name': self.name,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'time': time.time(),
+            'elapsed': time.time() - self.start_time,
+            'duration': self.duration,
+        }
+        event.update(self.extra)
+        event.update(fields)
+        if self.metrics_path:
+            line = json.dumps(event, sort_keys=True) + '\n'
+            with _write_lock:
+                with open(self.metrics_path, 'a') as fh:
+                    fh.write(line)
+        return event
+
+    def start(self, cmd=None):
+        return self._event('start', cmd=cmd)
+
+    def update(self, progress):
+        '''Record one update from :func:`iter_progress`; returns the event.'''
+
+        self.last = progress
+        eta = fraction = None
+        out_time = progress.get('out_time')
+        if self.duration and out_time is not None:
+            fraction = min(1.0, out_time / self.duration)
+            if progress.get('speed'):
+                eta = max(0.0, (self.duration - out_time) / progress['speed'])
+
+        event = self._event('progress', fraction=fraction, eta=eta, **progress)
+
+        now = time.time()
+        if self.status_interval and now - self._last_status >= self.status_interval:
+            self._last_status = now
+            print('[progress] {}: {}frame={} fps={} speed={}x{}'.format(
+                self.name,
+                '{:.1f}% '.format(100 * fraction) if fraction is not None else '',
+                progress.get('frame'),
+                progress.get('fps'),
+                progress.get('speed'),
+                ' eta={}'.format(format_seconds(eta)) if eta is not None else '',
+            ))
+
+        return event
+
+    def finish(self, returncode):
+        '''Record the end of the encode, with its realtime factor.'''
+
+        elapsed = time.time() - self.start_time
+        out_time = self.last.get('out_time') or self.duration
+        realtime = out_time / elapsed if out_time and elapsed else None
+        fps = self.last.get('frame') / elapsed if self.last.get('frame') and elapsed else None
+
+        event = self._event('finish', returncode=returncode, realtime=realtime, avg_fps=fps,
+            frame=self.last.get('frame'), out_time=out_time)
+
+        stats = get_stats()
+        stats.add_time('encode', elapsed)
+        if out_time:
+            stats.count('encode.media_seconds', out_time)
+        if returncode:
+            stats.count('encode.failed')
+
+        if self.status_interval:
+            print('[progress] {}: {} in {}{}'.format(
+                self.name,
+                'failed ({})'.format(returncode) if returncode else 'done',
+                format_seconds(elapsed),
+                ' ({:.2f}x realtime)'.format(realtime) if realtime else '',
+            ))
+
+        return event
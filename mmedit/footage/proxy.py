@@ -4,75 +4,451 @@ import json
 import os
 import re
 import subprocess
+import threading
+import time
 
 import psutil
 
-from .utils import makedirs, reduce_path, clean_path, add_render_arguments, iter_render_work, guess_type
+from .grouping import parse_frames, sequence_pattern
+from .pathmap import map_path
+from .probe import ProbeCache, probe, probe_many, run_ffprobe, compact
+from .progress import ProgressReporter, default_metrics_path, format_seconds, iter_progress
+from .stats import add_stats_arguments, get_stats, setup_stats
+from .utils import makedirs, reduce_path, clean_path, add_render_arguments, iter_render_work, guess_type, element_members, \
+    dedupe_render_work, link_file
 
 
 
-def encode(src, dst, verbose=False, dry_run=False):
+def input_args(srcs, start_number=None, frame_rate=None, concat_list=None, frames=None):
+    '''FFmpeg/FFprobe arguments to read the given source(s).
+
+    A single source with a ``start_number`` is an image sequence pattern. If
+    it has gaps, ``frames`` (e.g. ``"1001-1004,1007"``) lists the frames which
+    exist, and they are read via the concat demuxer (as the image2 demuxer
+    stops at the first missing frame). Several sources are a spanned clip, which is read via the concat protocol
+    for MPEG-TS, or otherwise via the concat demuxer (with the list written to
+    ``concat_list``).
+
+    '''
+
+    if isinstance(srcs, basestring):
+        srcs = [srcs]
+
+    if frames:
+        duration = 1 / float(frame_rate or 24)
+        with open(concat_list, 'w') as fh:
+            for frame in parse_frames(frames):
+                fh.write("file '%s'\nduration %r\n" % ((srcs[0] % frame).replace("'", "'\\''"), duration))
+        return ['-f', 'concat', '-safe', '0', '-i', concat_list]
+
+    if start_number is not None:
+        return [
+            '-framerate', str(frame_rate or 24),
+            '-start_number', str(start_number),
+            '-i', srcs[0],
+        ]
+
+    if len(srcs) == 1:
+        return ['-i', srcs[0]]
+
+    if all(os.path.splitext(src)[1].lower() in ('.mts', '.m2ts', '.ts') for src in srcs):
+        return ['-i', 'concat:' + '|'.join(srcs)]
+
+    with open(concat_list, 'w') as fh:
+        for src in srcs:
+            fh.write("file '%s'\n" % src.replace("'", "'\\''"))
+    return ['-f', 'concat', '-safe', '0', '-i', concat_list]
+
+
+def element_sources(element):
+    '''The sources and extra ``encode`` keyword arguments to make a proxy of an Element.'''
+
+    if element.get('sg_frames'):
+        pattern, first = sequence_pattern(map_path(element['sg_path']))
+        frames = parse_frames(element['sg_frames'])
+        if frames[-1] - frames[0] + 1 != len(frames):
+            return [pattern], {'start_number': first, 'frames': element['sg_frames']}
+        return [pattern], {'start_number': first}
+
+    # Spanned clips concatenate their media, but not their sidecars.
+    srcs = [map_path(path) for path in element_members(element) if guess_type(path) == element['sg_type']]
+    return srcs or [map_path(element['sg_path'])], {}
+
+
+def encode_cli_args(options):
+    '''Turn ``encode`` keyword arguments into ``mmedit-proxy encode`` arguments.'''
+    args = []
+    for key in sorted(options):
+        if options[key] is not None:
+            args.extend(('--' + key.replace('_', '-'), str(options[key])))
+    return args
+
+
+class ProxyWork(object):
+
+    '''A single proxy to make; one source (or set of sources) into one or
+    more formats.'''
+
+    def __init__(self, element, srcs, options, dsts, links=None, duplicates=None):
+        self.element = element
+        self.srcs = srcs
+        self.options = options
+        self.dsts = dsts
+        self.links = links or [] # Destinations of duplicate Elements.
+        self.duplicates = duplicates or []
+        self.info = None
+        self.segments = None
+
+    def links_for(self, dst):
+        ext = os.path.splitext(dst)[1]
+        return [path for path in self.links if os.path.splitext(path)[1] == ext]
+
+    @property
+    def is_single_file(self):
+        return len(self.srcs) == 1 and not self.options
+
+    @property
+    def has_video(self):
+        return bool(self.info) and any(s['codec_type'] == 'video' for s in self.info['streams'])
+
+    @property
+    def duration(self):
+        return float(self.info['format'].get('duration') or 0) if self.info else 0.0
+
+    @property
+    def size(self):
+        if self.info and self.info['format'].get('size'):
+            return int(self.info['format']['size'])
+        size = 0
+        for path in self.srcs:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        return size
+
+
+def keyframe_times(src, verbose=False):
+    '''Timestamps of the video keyframes in a file (from packets, so nothing is decoded).'''
 
-    name, ext = os.path.splitext(dst)
-    salt = os.urandom(2).encode('hex')
-    tmp = name + '.encoding-' + salt + ext
-    
     cmd = [
         'ffprobe',
         '-v', 'quiet',
-        '-print_format', 'json',
-        '-show_streams',
-        src
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        src,
     ]
     if verbose:
         print('$', ' '.join(cmd))
-    probe = json.loads(subprocess.check_output(cmd))
-    has_video = any(s['codec_type'] == 'video' for s in probe['streams'])
-    has_audio = any(s['codec_type'] == 'audio' for s in probe['streams'])
+
+    times = []
+    for line in subprocess.check_output(cmd).splitlines():
+        parts = line.strip().split(',')
+        if len(parts) >= 2 and 'K' in parts[1] and parts[0] not in ('', 'N/A'):
+            times.append(float(parts[0]))
+    return sorted(times)
+
+
+def plan_segments(keyframes, duration, segment_length, start_time=0.0):
+    '''Split a clip into pieces of roughly ``segment_length`` seconds, cutting
+    only on keyframes.
+
+    Returns a list of ``(start, length)`` relative to the start of the clip,
+    where the last length is ``None`` (i.e. to the end).
+
+    '''
+
+    cuts = [0.0]
+    target = segment_length
+    for time in keyframes:
+        time -= start_time
+        if time >= target:
+            cuts.append(time)
+            target = time + segment_length
+
+    # Don't leave a tiny segment on the end.
+    if len(cuts) > 1 and duration - cuts[-1] < segment_length / 4.0:
+        cuts.pop()
+
+    return [
+        (start, cuts[i + 1] - start if i + 1 < len(cuts) else None)
+        for i, start in enumerate(cuts)
+    ]
+
+
+def segment_paths(dst, count):
+    '''Where the segments of a segmented encode live until they are concatenated.'''
+    dir_, name = os.path.split(dst)
+    base, ext = os.path.splitext(name)
+    segment_dir = os.path.join(dir_, '.%s.segments' % base)
+    return [os.path.join(segment_dir, '%03d%s' % (i, ext)) for i in range(count)]
+
+
+def open_probe_cache():
+    try:
+        return ProbeCache()
+    except Exception as e:
+        print('Could not open probe cache:', e)
+
+
+# How we encode each output format, keyed by extension.
+#
+# Sources which are already ``size`` (``None`` matches anything) skip the
+# scale, and if they also match ``copy_video`` (and their audio matches
+# ``copy_audio``) they are copied rather than transcoded; see plan_output.
+PROFILES = {
+    '.mov': dict( # ProRes Proxy.
+        filter='scale=1920:1080:force_original_aspect_ratio=increase',
+        size=(1920, 1080),
+        copy_video=dict(codec_name='prores', profile='Proxy'),
+        copy_audio={},
+        video=(
+            '-c:v', 'prores_ks',
+            '-profile:v', '0', # Proxy.
+            '-qscale:v', '9', # 0 is best, 32 is worst.
+            '-pix_fmt', 'yuv422p10le',
+            '-vendor', 'ap10', # Mimick QuickTime.
+        ),
+        audio=('-c:a', 'copy'),
+    ),
+    '.mxf': dict( # DNxHD 36.
+        filter='scale=1920:1080',
+        size=(1920, 1080),
+        copy_video=dict(codec_name='dnxhd', pix_fmt='yuv422p', bit_rate=36e6),
+        copy_audio={},
+        video=(
+            '-c:v', 'dnxhd',
+            '-pix_fmt', 'yuv422p',
+            '-b:v', '36M', # NOTE: This is only for 23.976.
+        ),
+        audio=('-c:a', 'copy'),
+    ),
+    '.mp4': dict( # H.264 for review.
+        filter='scale=-2:1080',
+        size=(None, 1080),
+        copy_video=dict(codec_name='h264', pix_fmt='yuv420p'),
+        copy_audio=dict(codec_name='aac'),
+        video=(
+            '-c:v', 'libx264',
+            '-preset', 'medium',
+            '-crf', '23',
+            '-pix_fmt', 'yuv420p',
+        ),
+        audio=('-c:a', 'aac', '-b:a', '192k'),
+    ),
+}
+
+FORMATS = tuple(sorted(ext[1:] for ext in PROFILES))
+
+
+# Ways to make an output, cheapest first.
+PLANS = ('copy', 'copy-video', 'no-scale', 'transcode')
+
+
+def _stream_matches(stream, spec):
+    for key, expected in spec.items():
+        value = stream.get(key)
+        if key == 'bit_rate':
+            # Bit rates wander a little from the nominal.
+            if not value or abs(float(value) - expected) > expected * 0.1:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+def plan_output(info, dst):
+    '''Choose the cheapest way to make ``dst`` from a source with the given probe.
+
+    Returns ``(plan, reason)``, where ``plan`` is one of :data:`PLANS`:
+
+    - ``copy``: the source already meets the spec; remux it.
+    - ``copy-video``: copy the video, but re-encode the audio.
+    - ``no-scale``: transcode the video, but it is already the right size.
+    - ``transcode``: scale and transcode everything.
+
+    '''
+
+    profile = PROFILES[os.path.splitext(dst)[1]]
+    videos = [s for s in info['streams'] if s['codec_type'] == 'video']
+    audios = [s for s in info['streams'] if s['codec_type'] == 'audio']
+    audio_ok = all(_stream_matches(s, profile['copy_audio']) for s in audios)
+
+    if not videos:
+        if audio_ok:
+            return 'copy', 'audio only, and it can be copied'
+        return 'transcode', 'audio only, but it must be re-encoded'
+
+    video = videos[0]
+    desc = '{} {}x{}'.format(video.get('codec_name'), video.get('width'), video.get('height'))
+    width, height = profile['size']
+    if (width and video.get('width') != width) or video.get('height') != height:
+        return 'transcode', desc + ' needs scaling'
+    if not _stream_matches(video, profile['copy_video']):
+        return 'no-scale', desc + ' is the right size, but not the right codec'
+    if audio_ok:
+        return 'copy', desc + ' already meets the spec'
+    return 'copy-video', desc + ' already meets the spec, but the audio does not'
+
+
+def summarize_plans(works):
+    '''Print how many outputs will be copied, downgraded, or fully encoded.'''
+
+    counts = dict((plan, 0) for plan in PLANS)
+    unknown = 0
+    for work in works:
+        if work.info is None:
+            unknown += len(work.dsts)
+            continue
+        for dst in work.dsts:
+            counts[plan_output(work.info, dst)[0]] += 1
+    parts = ['{} {}'.format(counts[plan], plan) for plan in PLANS if counts[plan]]
+    if unknown:
+        parts.append('{} decided at encode time'.format(unknown))
+    print('Plans: {}.'.format(', '.join(parts) or 'nothing'))
+
+
+def encode(src, dst, verbose=False, dry_run=False, start_number=None, frame_rate=None, frames=None,
+    start=None, duration=None, threads=None, metrics=None, status_interval=10, explain=False,
+    links=None
+):
+    '''Encode a source into one or more proxies.
+
+    ``dst`` may be a list, in which case the source is only read and decoded
+    once, and the decoded video is split in the filter graph to feed each
+    output (whose format is determined by its extension).
+
+    ``threads`` defaults to every core, which is right for one encode at a
+    time (e.g. on the farm), but not for several at once.
+
+    Progress is appended to the JSON-lines ``metrics`` file (if given), and
+    summarised on stdout every ``status_interval`` seconds.
+
+    Each output is made as cheaply as it can be (see :func:`plan_output`);
+    ``explain`` prints what was chosen and why.
+
+    ``links`` are more paths to link to the output of the same format once
+    it is done (e.g. for Elements with identical content).
+
+    '''
+
+    dsts = [dst] if isinstance(dst, basestring) else list(dst)
+    for path in dsts:
+        if os.path.splitext(path)[1] not in PROFILES:
+            raise ValueError('Extension not one of %s.' % ', '.join(FORMATS), path)
+    for path in links or ():
+        if os.path.splitext(path)[1] not in [os.path.splitext(x)[1] for x in dsts]:
+            raise ValueError('Link is not the same format as any output.', path)
+
+    # Segments go in a directory of their own, which any of them may be
+    # first to need (they run in parallel).
+    if not dry_run:
+        for path in dsts:
+            makedirs(os.path.dirname(path))
+
+    salt = os.urandom(2).encode('hex')
+    srcs = [src] if isinstance(src, basestring) else list(src)
+    concat_list = os.path.splitext(dsts[0])[0] + '.concat-' + salt + '.txt'
+    inputs = input_args(srcs, start_number, frame_rate, concat_list=concat_list, frames=frames)
+    try:
+        if start_number is None and len(srcs) == 1:
+            cache = open_probe_cache()
+            info = probe(srcs[0], cache=cache, verbose=verbose)
+            if cache:
+                cache.close()
+        else:
+            info = compact(run_ffprobe(inputs, verbose=verbose))
+        # Segments of a segmented encode seek (on a keyframe) and stop early.
+        if start is not None:
+            inputs = ['-ss', str(start)] + inputs
+        outputs = ['-t', str(duration)] if duration else []
+        if not duration:
+            duration = float(info['format'].get('duration') or 0) - (start or 0) or None
+        reporter = None
+        if not dry_run:
+            codecs = [s.get('codec_name') for s in info['streams'] if s['codec_type'] == 'video']
+            reporter = ProgressReporter(dsts[0], duration=duration,
+                metrics_path=metrics or default_metrics_path(),
+                status_interval=status_interval,
+                extra={'codec': codecs[0] if codecs else None, 'threads': threads},
+            )
+        plans = [plan_output(info, dst) for dst in dsts]
+        if explain:
+            for dst, (plan, reason) in zip(dsts, plans):
+                print('{}: {} ({})'.format(dst, plan, reason))
+        ret = _encode(inputs, outputs, info, dsts, [plan for plan, _ in plans], salt,
+            verbose=verbose, dry_run=dry_run, threads=threads, reporter=reporter)
+        if links and not ret and not dry_run:
+            link_outputs(dsts, links, verbose=verbose)
+        return ret
+    finally:
+        if os.path.exists(concat_list):
+            os.unlink(concat_list)
+
+
+def _tmp_paths(dst, salt):
+    name, ext = os.path.splitext(dst)
+    return name + '.encoding-' + salt + ext, name + '.failed-' + salt + ext
+
+
+def _encode(inputs, outputs, info, dsts, plans, salt, verbose=False, dry_run=False, threads=None, reporter=None):
+
+    has_video = any(s['codec_type'] == 'video' for s in info['streams'])
+    has_audio = any(s['codec_type'] == 'audio' for s in info['streams'])
 
     cmd = ['ffmpeg',
         '-y', # Overwrite.
-        '-i', src,
-        '-vendor', 'ap10', # Mimick QuickTime.
-        '-threads', str(psutil.cpu_count()), # All threads.
-    ]
-    if has_video:
-        if ext == '.mov':
-            cmd.extend((
-                '-map', '0:v',
-                '-c:v', 'prores_ks',
-                '-profile:v', '0', # Proxy.
-                '-qscale:v', '9', # 0 is best, 32 is worst.
-                '-pix_fmt', 'yuv422p10le',
-                '-vf', 'scale=1920:1080:force_original_aspect_ratio=increase',
-            ))
-        elif ext == '.mxf':
-            cmd.extend((
-                '-map', '0:v',
-                '-c:v', 'dnxhd',
-                '-pix_fmt', 'yuv422p',
-                '-b:v', '36M', # NOTE: This is only for 23.976.
-                '-s', '1920x1080',
-            ))
+        '-nostats', '-progress', 'pipe:1', # See run_ffmpeg.
+    ] + inputs
+
+    # One decode, split to each transcoded output's scaler.
+    labels = {}
+    transcoded = [i for i, plan in enumerate(plans) if plan in ('no-scale', 'transcode')]
+    if has_video and transcoded:
+        if len(transcoded) > 1:
+            graph = ['[0:v]split=%d%s' % (len(transcoded), ''.join('[s%d]' % i for i in transcoded))]
+            sources = ['[s%d]' % i for i in transcoded]
         else:
-            raise ValueError('Extension not mov or mxf.', container)
+            graph = []
+            sources = ['[0:v]']
+        for source, i in zip(sources, transcoded):
+            labels[i] = '[v%d]' % i
+            filter_ = PROFILES[os.path.splitext(dsts[i])[1]]['filter'] if plans[i] == 'transcode' else 'null'
+            graph.append('%s%s%s' % (source, filter_, labels[i]))
+        cmd.extend(('-filter_complex', ';'.join(graph)))
 
-    if has_audio:
+    for i, dst in enumerate(dsts):
+
+        profile = PROFILES[os.path.splitext(dst)[1]]
+
+        cmd.extend(outputs)
         cmd.extend((
+            '-threads', str(threads or psutil.cpu_count()),
+        ))
 
-            '-map', '0:a',
-            '-c:a', 'copy',
+        if has_video and i in labels:
+            cmd.extend(('-map', labels[i]))
+            cmd.extend(profile['video'])
+        elif has_video:
+            cmd.extend(('-map', '0:v:0', '-c:v', 'copy'))
 
-            # Premiere will only recognize tracks marked "default" if any are
-            # marked default. The footage has no tracks default, so it seems
-            # to work fine. FFmpeg appears to set the first one to default, and
-            # so it is the only one to be recognized. Apple's Compressor marks
-            # them ALL as default, which Premiere is also happy with. FFmpeg
-            # does not seem to let us have no default audio, so we set them all.
-            '-disposition:a', 'default',
+        if has_audio:
+            cmd.extend(('-map', '0:a'))
+            cmd.extend(('-c:a', 'copy') if plans[i] == 'copy' else profile['audio'])
+            cmd.extend((
 
-        ))
-    cmd.append(tmp)
+                # Premiere will only recognize tracks marked "default" if any are
+                # marked default. The footage has no tracks default, so it seems
+                # to work fine. FFmpeg appears to set the first one to default, and
+                # so it is the only one to be recognized. Apple's Compressor marks
+                # them ALL as default, which Premiere is also happy with. FFmpeg
+                # does not seem to let us have no default audio, so we set them all.
+                '-disposition:a', 'default',
+
+            ))
+
+        cmd.append(_tmp_paths(dst, salt)[0])
 
     if verbose:
         print('$', ' '.join(cmd))
@@ -80,15 +456,134 @@ def encode(src, dst, verbose=False, dry_run=False):
     if dry_run:
         return
     
-    ret = subprocess.call(cmd)
-    if ret and os.path.exists(tmp):
-        os.rename(tmp, name + '.failed-' + salt + ext)
-    else:
-        os.rename(tmp, dst)
+    ret = run_ffmpeg(cmd, reporter)
+    for dst in dsts:
+        tmp, failed = _tmp_paths(dst, salt)
+        if not ret:
+            os.rename(tmp, dst)
+        elif os.path.exists(tmp):
+            os.rename(tmp, failed)
 
     return ret
 
 
+def link_outputs(dsts, links, verbose=False):
+    '''Link each of ``links`` to the output in ``dsts`` with the same extension.'''
+    by_ext = dict((os.path.splitext(path)[1], path) for path in dsts)
+    for path in links:
+        method = link_file(by_ext[os.path.splitext(path)[1]], path)
+        if verbose:
+            print('{} -> {} ({})'.format(path, by_ext[os.path.splitext(path)[1]], method))
+
+
+def run_ffmpeg(cmd, reporter=None):
+    '''Run an ffmpeg command which has ``-progress pipe:1``, reporting as it goes.'''
+
+    if reporter:
+        reporter.start(cmd)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    for progress in iter_progress(iter(proc.stdout.readline, '')):
+        if reporter:
+            reporter.update(progress)
+    ret = proc.wait()
+    if reporter:
+        reporter.finish(ret)
+    return ret
+
+
+def concat(segments, dst, verbose=False, dry_run=False, links=None):
+    '''Losslessly join the segments of a segmented encode, and clean them up.'''
+
+    name, ext = os.path.splitext(dst)
+    salt = os.urandom(2).encode('hex')
+    tmp = name + '.encoding-' + salt + ext
+    concat_list = name + '.concat-' + salt + '.txt'
+
+    cmd = ['ffmpeg',
+        '-y', # Overwrite.
+    ] + input_args(segments, concat_list=concat_list) + [
+        '-map', '0',
+        '-c', 'copy',
+        '-disposition:a', 'default', # See encode.
+        tmp,
+    ]
+
+    if verbose:
+        print('$', ' '.join(cmd))
+
+    try:
+
+        if dry_run:
+            return
+
+        with get_stats().span('concat'):
+            ret = subprocess.call(cmd)
+        if not ret:
+            os.rename(tmp, dst)
+        elif os.path.exists(tmp):
+            os.rename(tmp, name + '.failed-' + salt + ext)
+
+        if not ret:
+            if links:
+                link_outputs([dst], links, verbose=verbose)
+            for path in segments:
+                os.unlink(path)
+            try:
+                os.rmdir(os.path.dirname(segments[0]))
+            except OSError:
+                pass
+
+        return ret
+
+    finally:
+        if os.path.exists(concat_list):
+            os.unlink(concat_list)
+
+
+# Codecs where every frame stands alone; decoding them doesn't scale much past
+# a couple of threads, so we would rather run more of them at once.
+INTRA_CODECS = set((
+    'dnxhd', 'dpx', 'exr', 'jpeg2000', 'mjpeg', 'png', 'prores', 'rawvideo',
+    'tiff', 'v210',
+))
+
+
+def threads_for(work):
+    '''How many threads to give the encode of a :class:`ProxyWork`.'''
+
+    if work.options.get('start_number') is not None:
+        return 2 # Image sequence.
+    codecs = [s.get('codec_name') for s in (work.info or {}).get('streams', ()) if s['codec_type'] == 'video']
+    if work.info and not codecs:
+        return 1 # Audio only.
+    if codecs and codecs[0] in INTRA_CODECS:
+        return 2
+    return 4 # Long-GOP (H.264, HEVC, MPEG-2), or we don't know.
+
+
+class CoreBudget(object):
+
+    '''Hands out a fixed number of cores to concurrent encodes.'''
+
+    def __init__(self, cores):
+        self.cores = cores
+        self.free = cores
+        self._cond = threading.Condition()
+
+    def acquire(self, count):
+        count = min(count, self.cores)
+        with self._cond:
+            while self.free < count:
+                self._cond.wait()
+            self.free -= count
+        return count
+
+    def release(self, count):
+        with self._cond:
+            self.free += count
+            self._cond.notify_all()
+
+
 def main():
 
     import argparse
@@ -99,17 +594,88 @@ def main():
     submit_parser = commands.add_parser('submit')
     submit_parser.add_argument('-p', '--postfix', default='',
         help='Extra text to add to end of name.')
-    submit_parser.add_argument('-f', '--format', choices=('mov', 'mxf'),
-        default='mov',
-        help='mov => ProRes, mxf => DNxHD')
+    submit_parser.add_argument('-f', '--format', action='append', dest='formats', choices=FORMATS,
+        help='mov => ProRes, mxf => DNxHD, mp4 => H.264; may be given several '
+             'times to make them all from one decode. Defaults to mov.')
+    submit_parser.add_argument('-S', '--segment-length', type=float, default=0,
+        help='Split clips longer than twice this many seconds into segments '
+             'which encode in parallel, and are then concatenated.')
+    submit_parser.add_argument('--metrics', default=default_metrics_path(),
+        help='Have the tasks append progress to this JSON-lines file (e.g. on the NAS).')
+    submit_parser.add_argument('--explain', action='store_true',
+        help='Print how each proxy will be made (copied, transcoded, etc.), and why.')
+    submit_parser.add_argument('--pack-under', type=float, default=30,
+        help='Pack encodes estimated to take less than this many seconds into '
+             'shared tasks; 0 to not pack.')
+    submit_parser.add_argument('--pack-target', type=float, default=300,
+        help='Estimated seconds of work to pack into each shared task.')
+    submit_parser.add_argument('--giant-size', type=float, default=100,
+        help='Flag sources larger than this many GB.')
+    submit_parser.add_argument('--giant-seconds', type=float, default=4 * 3600,
+        help='Flag sources estimated to take longer than this many seconds.')
     add_render_arguments(submit_parser)
 
+    run_parser = commands.add_parser('run',
+        help='Encode locally (instead of submitting to the farm).')
+    run_parser.add_argument('-p', '--postfix', default='',
+        help='Extra text to add to end of name.')
+    run_parser.add_argument('-f', '--format', action='append', dest='formats', choices=FORMATS,
+        help='As for submit.')
+    run_parser.add_argument('--cores', type=int,
+        help='How many cores to share between encodes. Defaults to all of them.')
+    run_parser.add_argument('--threads-per-job', type=int,
+        help='Threads for each encode; by default 2 for intra-frame sources '
+             '(ProRes, DNxHD, image sequences) and 4 for long-GOP ones.')
+    run_parser.add_argument('--metrics', default=default_metrics_path(),
+        help='Append progress to this JSON-lines file; defaults to $MMEDIT_PROXY_METRICS.')
+    run_parser.add_argument('--status-interval', type=float, default=0,
+        help='Seconds between progress lines for each encode; 0 for none.')
+    run_parser.add_argument('--explain', action='store_true',
+        help='Print how each proxy will be made (copied, transcoded, etc.), and why.')
+    add_render_arguments(run_parser)
+
     encode_parser = commands.add_parser('encode')
     encode_parser.add_argument('-v', '--verbose', action='store_true')
     encode_parser.add_argument('-n', '--dry-run', action='store_true')
-    encode_parser.add_argument('src')
+    encode_parser.add_argument('--start-number', type=int,
+        help='First frame; the source is an image sequence pattern.')
+    encode_parser.add_argument('--frame-rate', default='24',
+        help='Frame rate of image sequences.')
+    encode_parser.add_argument('--frames',
+        help='Frames which exist in an image sequence with gaps, e.g. "1001-1004,1007".')
+    encode_parser.add_argument('--start', type=float,
+        help='Seek to this time (in seconds) before encoding.')
+    encode_parser.add_argument('--duration', type=float,
+        help='Only encode this many seconds.')
+    encode_parser.add_argument('-o', '--output', action='append', dest='outputs',
+        help='Additional output(s), made from the same decode as dst.')
+    encode_parser.add_argument('--metrics', default=default_metrics_path(),
+        help='Append progress to this JSON-lines file; defaults to $MMEDIT_PROXY_METRICS.')
+    encode_parser.add_argument('--status-interval', type=float, default=10,
+        help='Seconds between progress lines on stdout; 0 for none.')
+    encode_parser.add_argument('--explain', action='store_true',
+        help='Print how each output will be made (copied, transcoded, etc.), and why.')
+    encode_parser.add_argument('--threads', type=int,
+        help='Threads for ffmpeg; defaults to every core.')
+    encode_parser.add_argument('-l', '--link', action='append', dest='links',
+        help='Link this path to the output of the same format once done.')
+    encode_parser.add_argument('src', nargs='+',
+        help='Source(s); several are concatenated (e.g. a spanned clip).')
     encode_parser.add_argument('dst')
 
+    pack_parser = commands.add_parser('pack',
+        help='Run several encodes (one after the other) in one task.')
+    pack_parser.add_argument('encodes', nargs='+',
+        help='Each is a JSON list of arguments to encode.')
+
+    concat_parser = commands.add_parser('concat')
+    concat_parser.add_argument('-v', '--verbose', action='store_true')
+    concat_parser.add_argument('-n', '--dry-run', action='store_true')
+    concat_parser.add_argument('-l', '--link', action='append', dest='links',
+        help='Link this path to dst once done.')
+    concat_parser.add_argument('dst')
+    concat_parser.add_argument('segments', nargs='+')
+
     swap_parser = commands.add_parser('swap')
     swap_parser.add_argument('-b', '--backup', help='Postfix for existing footage.')
     swap_parser.add_argument('-n', '--dry-run', action='store_true')
@@ -118,59 +684,414 @@ def main():
     swap_parser.add_argument('postfix')
     swap_parser.add_argument('root')
 
+    for command_parser in (submit_parser, run_parser, encode_parser, pack_parser, concat_parser, swap_parser):
+        add_stats_arguments(command_parser)
 
     args = parser.parse_args()
+    setup_stats(args, 'proxy ' + args._command)
 
-    if args._command == 'submit':
+    if args._command in ('submit', 'run'):
         args.types = args.types or ['footage']
-        exit(main_submit(args) or 0)
+        args.formats = args.formats or ['mov']
+        exit((main_submit if args._command == 'submit' else main_run)(args) or 0)
     elif args._command == 'encode':
         exit(main_encode(args) or 0)
+    elif args._command == 'pack':
+        failed = 0
+        for argv in args.encodes:
+            failed += bool(main_encode(parser.parse_args(['encode'] + json.loads(argv))))
+        exit(1 if failed else 0)
+    elif args._command == 'concat':
+        exit(concat(args.segments, args.dst, verbose=args.verbose, dry_run=args.dry_run, links=args.links) or 0)
     elif args._command == 'swap':
         exit(main_swap(args) or 0)
     else:
         raise RuntimeError('Unknown command.', args._command)
 
 
+def plan_work(args):
+    '''Figure out what proxies to make (for ``submit`` and ``run``).
+
+    Returns a list of :class:`ProxyWork`, with their probe info filled in.
+
+    '''
+
+    # All formats come out of the same encode.
+    formats = lambda path: [os.path.splitext(path)[0] + '.' + format_ for format_ in args.formats]
+
+    # Outputs which exist are only made again with --replace; any which are
+    # missing are made (without touching the others).
+    def needed(path):
+        paths = formats(path)
+        return paths if args.replace else [x for x in paths if not os.path.exists(x)]
+
+    # We check the destinations ourselves, since there is one per format.
+    rendered = iter_render_work(
+        generate_path=lambda el, dst_path: os.path.splitext(dst_path)[0] + args.postfix + '.' + args.formats[0],
+        check_dst=False,
+        **args.__dict__
+    )
+    stats = get_stats()
+    with stats.span('query'):
+        todo_rendered = []
+        for element, dst_path in rendered:
+            if needed(dst_path):
+                todo_rendered.append((element, dst_path))
+            elif args.verbose:
+                print('{}: already exists; skipping it.'.format(', '.join(formats(dst_path))))
+        if args.dedupe == 'off':
+            rendered = [(element, dst_path, []) for element, dst_path in todo_rendered]
+        else:
+            rendered = dedupe_render_work(todo_rendered)
+
+    todo = []
+    for element, dst_path, duplicates in rendered:
+        srcs, options = element_sources(element)
+        dst_paths = needed(dst_path)
+        links = []
+        if args.dedupe == 'link':
+            for _, path in duplicates:
+                links.extend(formats(path))
+        if args.verbose:
+            print(', '.join(dst_paths), '<-', ' + '.join(srcs))
+            for path in links:
+                print('    {} is a duplicate; it will be linked.'.format(path))
+        todo.append(ProxyWork(element, srcs, options, dst_paths, links,
+            duplicates=[element for element, _ in duplicates]))
+
+    # Skip sources without anything for us to encode; this is served from the
+    # probe cache that ingest fills, and only runs ffprobe on a miss.
+    cache = open_probe_cache()
+    by_src = dict((work.srcs[0], work) for work in todo if work.is_single_file)
+    unusable = set()
+    with stats.span('probe'):
+        for path, info, error in probe_many(list(by_src), cache=cache):
+            if error:
+                print('Could not probe {}: {}'.format(path, error))
+            elif not any(s['codec_type'] in ('video', 'audio') for s in info['streams']):
+                print('No audio or video in {}; skipping it.'.format(path))
+                unusable.add(path)
+            else:
+                by_src[path].info = info
+    if cache:
+        cache.close()
+
+    todo = [work for work in todo if work.srcs[0] not in unusable]
+    report_duplicates(todo)
+    return todo
+
+
+def report_duplicates(works):
+    '''Print how much work deduplicating by checksum saves.'''
+
+    count = size = duration = 0
+    for work in works:
+        count += len(work.duplicates)
+        size += work.size * len(work.duplicates)
+        duration += work.duration * len(work.duplicates)
+    if count:
+        print('Skipping {} encodes of duplicate content ({:.1f} GB of sources{}).'.format(
+            count, size / 1e9,
+            ', {} of media'.format(format_seconds(duration)) if duration else '',
+        ))
+
+
+# Rough realtime factors of each plan (for 1080p sources) on a farm node;
+# only used to estimate costs.
+PLAN_SPEEDS = {'copy': 20.0, 'copy-video': 8.0, 'no-scale': 2.0, 'transcode': 1.0}
+
+# What we assume of sources we haven't probed (sequences and spanned clips).
+UNPROBED_BANDWIDTH = 80e6 # Bytes per second.
+
+# Reservations are rounded up to one of these.
+BANDWIDTH_STEPS = (10, 20, 40, 80, 160) # MB/s of nx01.
+THREAD_STEPS = (1, 2, 4, 8)
+
+
+def _step_up(value, steps):
+    for step in steps:
+        if value <= step:
+            return step
+    return steps[-1]
+
+
+def estimate_cost(work):
+    '''Guess what a :class:`ProxyWork` will cost on the farm.
+
+    Returns a dict with ``size`` (bytes read), ``seconds`` (of wall time),
+    ``bandwidth`` (MB/s read), and ``threads``.
+
+    '''
+
+    size = work.size
+    threads = threads_for(work)
+
+    if not work.info:
+        seconds = size / UNPROBED_BANDWIDTH
+        return dict(size=size, seconds=seconds, bandwidth=UNPROBED_BANDWIDTH / 1e6, threads=threads)
+
+    plans = [plan_output(work.info, dst)[0] for dst in work.dsts]
+    speed = min(PLAN_SPEEDS[plan] for plan in plans)
+    if all(plan == 'copy' for plan in plans):
+        threads = 1
+    else:
+        videos = [s for s in work.info['streams'] if s['codec_type'] == 'video']
+        if videos and videos[0].get('width') and videos[0].get('height'):
+            speed /= max(1.0, videos[0]['width'] * videos[0]['height'] / float(1920 * 1080))
+
+    seconds = (work.duration or size / UNPROBED_BANDWIDTH) / speed
+    bandwidth = size / seconds / 1e6 if seconds else BANDWIDTH_STEPS[-1]
+    return dict(size=size, seconds=seconds, bandwidth=bandwidth, threads=threads)
+
+
+def reservations_for(cost):
+    return {
+        'nx01.bandwidth': _step_up(cost['bandwidth'], BANDWIDTH_STEPS),
+        'cpus': _step_up(cost['threads'], THREAD_STEPS),
+    }
+
+
 def main_submit(args):
 
     from farmsoup.client import Client
     from farmsoup.client.models import Job
 
-    todo = []
-    for element, dst_path in iter_render_work(
-        generate_path=lambda el, dst_path: os.path.splitext(dst_path)[0] + args.postfix + '.' + args.format,
-        **args.__dict__
-    ):
-        src_path = element['sg_path']
-        if args.verbose:
-            print(dst_path, '<-', src_path)
-        todo.append((src_path, dst_path))
+    todo = plan_work(args)
+
+    # Plan segments for long clips.
+    if args.segment_length:
+        for work in todo:
+            if not work.is_single_file or not work.has_video:
+                continue
+            if work.duration < 2 * args.segment_length:
+                continue
+            segments = plan_segments(
+                keyframe_times(work.srcs[0], verbose=args.verbose),
+                work.duration,
+                args.segment_length,
+                start_time=float(work.info['format'].get('start_time') or 0),
+            )
+            if len(segments) > 1:
+                work.segments = segments
+                print('{} will be encoded in {} segments.'.format(work.srcs[0], len(segments)))
+
+    if args.explain:
+        explain_work(todo)
+    summarize_plans(todo)
+
+    def encode_argv(options, srcs, dsts, cost, links=()):
+        argv = encode_cli_args(options)
+        argv.extend(('--threads', str(_step_up(cost['threads'], THREAD_STEPS))))
+        for path in links:
+            argv.extend(('-l', path))
+        if args.metrics:
+            argv.extend(('--metrics', args.metrics))
+        if args.explain:
+            argv.append('--explain')
+        for path in dsts[1:]:
+            argv.extend(('-o', path))
+        argv.extend(srcs)
+        argv.append(dsts[0])
+        return argv
+
+    # Each unit becomes an encode task (unless packed with others), and
+    # segments have their concats.
+    units = [] # (name, argv, cost, segmented work or None)
+    total = dict(size=0, seconds=0.0)
+    for work in todo:
+
+        cost = estimate_cost(work)
+        total['size'] += cost['size']
+        total['seconds'] += cost['seconds']
+
+        if cost['size'] > args.giant_size * 1e9 or cost['seconds'] > args.giant_seconds:
+            print('GIANT: {} ({:.1f} GB, about {} to encode){}.'.format(
+                work.srcs[0], cost['size'] / 1e9, format_seconds(cost['seconds']),
+                '' if work.segments else '; consider --segment-length',
+            ))
+
+        if not work.segments:
+            units.append((work.dsts[0], encode_argv(work.options, work.srcs, work.dsts, cost, work.links), cost, None))
+            continue
+
+        # Every segment task makes that segment of every format.
+        count = len(work.segments)
+        segment_cost = dict(cost, size=cost['size'] / count, seconds=cost['seconds'] / count)
+        paths_by_format = [segment_paths(dst, count) for dst in work.dsts]
+        for i, (start, duration) in enumerate(work.segments):
+            dsts = [paths[i] for paths in paths_by_format]
+            units.append((dsts[0], encode_argv({'start': start, 'duration': duration}, work.srcs, dsts, segment_cost),
+                segment_cost, (work, paths_by_format)))
+
+    # Pack small encodes together so they don't each pay for starting a task.
+    tasks = [] # (name, argvs, cost, segmented)
+    pack = []
+    def flush_pack():
+        if pack:
+            cost = dict(
+                size=sum(x[2]['size'] for x in pack),
+                seconds=sum(x[2]['seconds'] for x in pack),
+                bandwidth=max(x[2]['bandwidth'] for x in pack),
+                threads=max(x[2]['threads'] for x in pack),
+            )
+            name = pack[0][0] if len(pack) == 1 else '{} (+{} more)'.format(pack[0][0], len(pack) - 1)
+            tasks.append((name, [x[1] for x in pack], cost, None))
+            del pack[:]
+    for name, argv, cost, segmented in units:
+        if segmented or not args.pack_under or cost['seconds'] >= args.pack_under:
+            tasks.append((name, [argv], cost, segmented))
+            continue
+        pack.append((name, argv, cost))
+        if sum(x[2]['seconds'] for x in pack) >= args.pack_target:
+            flush_pack()
+    flush_pack()
+
+    packed = sum(len(argvs) for _, argvs, _, _ in tasks if len(argvs) > 1)
+    print('Estimated cost: {} of encoding, reading {:.1f} GB, in {} tasks{}.'.format(
+        format_seconds(total['seconds']), total['size'] / 1e9, len(tasks),
+        ' ({} small encodes packed together)'.format(packed) if packed else '',
+    ))
 
     if args.dry_run:
         return
 
-    client = Client()
-    job = client.job(
-        name='Proxies',
-        reservations={'nx01.bandwidth': 80},
-    ).setup_as_subprocess(['mmedit-proxy', 'encode'])
-    template = job.tasks.pop(0)
-
-    for src, dst in todo:
-        task = template.copy()
-        task.package['args'].extend((src, dst))
-        task.name = dst
-        job.tasks.append(task)
-
-    if not len(job.tasks):
+    if not tasks:
         print("Nothing to submit.")
         return
 
-    client.submit(name='Proxies', jobs=[job])
+    client = Client()
+
+    # One job per distinct reservation.
+    jobs = {}
+    templates = {}
+    def add_task(argv, name, reservations):
+        key = tuple(sorted(reservations.items()))
+        if key not in jobs:
+            jobs[key] = client.job(
+                name='Proxies ({})'.format(', '.join('{}={}'.format(*x) for x in key)),
+                reservations=reservations,
+            ).setup_as_subprocess(['mmedit-proxy'])
+            templates[key] = jobs[key].tasks.pop(0)
+        task = templates[key].copy()
+        task.package['args'].extend(argv)
+        task.name = name
+        jobs[key].tasks.append(task)
+        return task
+
+    segment_tasks = {} # id(work) -> tasks
+    for name, argvs, cost, segmented in tasks:
+        reservations = reservations_for(cost)
+        if len(argvs) == 1:
+            task = add_task(['encode'] + argvs[0], name, reservations)
+        else:
+            task = add_task(['pack'] + [json.dumps(argv) for argv in argvs], name, reservations)
+        if segmented:
+            segment_tasks.setdefault(id(segmented[0]), (segmented, []))[1].append(task)
+
+    # The concats for each clip only wait for that clip's segments.
+    for (work, paths_by_format), deps in segment_tasks.values():
+        for dst, paths in zip(work.dsts, paths_by_format):
+            argv = ['concat']
+            for path in work.links_for(dst):
+                argv.extend(('-l', path))
+            argv.append(dst)
+            argv.extend(paths)
+            task = add_task(argv, dst, {'nx01.bandwidth': 80, 'cpus': 1})
+            task.dependencies.extend(deps)
+
+    with get_stats().span('submit'):
+        client.submit(
+            name='Proxies (est. {}, {:.1f} GB)'.format(format_seconds(total['seconds']), total['size'] / 1e9),
+            jobs=[jobs[key] for key in sorted(jobs)],
+        )
+
+
+def explain_work(works):
+    for work in works:
+        for dst in work.dsts:
+            if work.info is None:
+                print('{}: decided at encode time (not a single file)'.format(dst))
+            else:
+                print('{}: {} ({})'.format(dst, *plan_output(work.info, dst)))
+
+
+def main_run(args):
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    todo = plan_work(args)
+    if not todo:
+        print("Nothing to encode.")
+        return
+
+    # Biggest first, so that the long tail is made of small ones.
+    todo.sort(key=lambda work: work.size, reverse=True)
+
+    if args.explain:
+        explain_work(todo)
+
+    cores = args.cores or psutil.cpu_count()
+    budget = CoreBudget(cores)
+    threads = dict((id(work), args.threads_per_job or threads_for(work)) for work in todo)
+
+    def run_one(work):
+        count = budget.acquire(threads[id(work)])
+        try:
+            if args.verbose:
+                print('Encoding {} with {} threads.'.format(work.dsts[0], count))
+            return encode(work.srcs, work.dsts, verbose=args.verbose, dry_run=args.dry_run,
+                threads=count, metrics=args.metrics, status_interval=args.status_interval,
+                links=work.links, **work.options)
+        finally:
+            budget.release(count)
+
+    start_time = time.time()
+    failed = []
+    pool = ThreadPoolExecutor(max(1, cores // min(threads.values())))
+    try:
+        futures = [(work, pool.submit(run_one, work)) for work in todo]
+        for work, future in futures:
+            try:
+                ret = future.result()
+            except Exception as e:
+                print('Error encoding {}: {}: {}'.format(work.dsts[0], e.__class__.__name__, e))
+                ret = 1
+            if ret:
+                failed.append(work)
+                print('Failed: {}'.format(work.dsts[0]))
+            else:
+                print('Done: {}'.format(work.dsts[0]))
+    finally:
+        pool.shutdown(wait=True)
+    elapsed = time.time() - start_time
+
+    done = [work for work in todo if work not in failed]
+    size = sum(work.size for work in done)
+    duration = sum(work.duration for work in done)
+    print('Encoded {} of {} in {:.1f}s on {} cores: {:.1f} MB at {:.1f} MB/s{}.'.format(
+        len(done), len(todo), elapsed, cores,
+        size / 1e6, size / 1e6 / elapsed if elapsed else 0,
+        ', {:.1f}x realtime'.format(duration / elapsed) if duration and elapsed else '',
+    ))
+    summarize_plans(todo)
+
+    saved = 0
+    for work in done:
+        for path in work.links:
+            if not args.dry_run and os.path.exists(path) and not os.path.islink(path):
+                saved += os.path.getsize(path)
+    if saved:
+        print('Hard links to duplicates saved {:.1f} MB of proxies.'.format(saved / 1e6))
+
+    return 1 if failed else 0
+
 
 def main_encode(args):
-    return encode(src=args.src, dst=args.dst, verbose=args.verbose, dry_run=args.dry_run)
+    return encode(src=args.src, dst=[args.dst] + (args.outputs or []), verbose=args.verbose, dry_run=args.dry_run,
+        start_number=args.start_number, frame_rate=args.frame_rate, frames=args.frames,
+        start=args.start, duration=args.duration,
+        metrics=args.metrics, status_interval=args.status_interval, explain=args.explain,
+        links=args.links, threads=args.threads)
 
 def main_swap(args):
 
@@ -1,66 +1,208 @@
-from __future__ import print_function 
+from __future__ import print_function
 
 import errno
+import json
 import os
 
-from dirmap import DirMap
+from concurrent.futures import ThreadPoolExecutor
 
-from .utils import makedirs, reduce_path, clean_path, add_render_arguments, iter_render_work
+from .clone import clone_file
+from .pathmap import map_path
+from .stats import Stats, add_stats_arguments, setup_stats
+from .utils import makedirs, reduce_path, clean_path, add_render_arguments, iter_render_work, is_grouped, element_members, \
+    dedupe_render_work
 
 
 
 def makedirs(path):
-    try: 
+    try:
         os.makedirs(path)
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise
 
-dir_map = DirMap()
-dir_map.add_one(
-    '/Volumes/EditOnline/CWAF_S3/01_Raw_Source',
-    '/Volumes/EDsource/Projects/ConfuciusWasAFoodieS3/footage/camera_originals',
-)
-dir_map.add_one(
-    '/Volumes/EditOnline/CWAF_S3/02_0ptimized_Source',
-    '/Volumes/EDsource/Projects/ConfuciusWasAFoodieS3/footage/source',
-)
 
+class RelinkPlan(object):
 
-def relink(element, dst_path, symlink, dry_run=False, update=False,
-    replace=False, verbose=False, **_
-):
+    '''Everything a relink will do, worked out before it does any of it.
 
-    src_path = element['sg_path']
-    src_path = dir_map(src_path)
+    ``dirs`` are the directories to create (parents first), ``links`` are
+    ``(src, dst, action)`` where action is ``"create"`` or ``"replace"``, and
+    ``skips`` are ``(src, dst, reason)``.
 
-    missing = not os.path.exists(src_path)
-    if verbose or missing:
-        print('%s -> %s' % (dst_path, src_path))
-        if missing:
-            print('    Source is missing; skipping it.')
-            return
+    '''
 
-    if dry_run:
-        return
+    def __init__(self):
+        self.dirs = []
+        self.links = []
+        self.skips = []
 
-    if os.path.exists(dst_path):
-        if replace:
-            os.unlink(dst_path)
-        elif update:
-            # Ignoring this file.
-            return
+    def as_dict(self):
+        return {
+            'dirs': self.dirs,
+            'links': [dict(src=src, dst=dst, action=action) for src, dst, action in self.links],
+            'skips': [dict(src=src, dst=dst, reason=reason) for src, dst, reason in self.skips],
+        }
 
-    try:
-        if symlink:
-            os.symlink(src_path, dst_path)
+
+def _list_dirs(paths, threads, stats):
+    '''Map each directory to a set of its names (or None if it doesn't exist).'''
+
+    def list_one(path):
+        stats.count('fs.listdir')
+        try:
+            return path, set(os.listdir(path))
+        except OSError as e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return path, None
+
+    if threads > 1 and len(paths) > 1:
+        pool = ThreadPoolExecutor(threads)
+        try:
+            return dict(pool.map(list_one, paths))
+        finally:
+            pool.shutdown(wait=True)
+    return dict(list_one(path) for path in paths)
+
+
+def element_links(element, dst_path):
+    '''The ``(src, dst)`` pairs to relink an Element to ``dst_path``.'''
+
+    if not is_grouped(element):
+        return [(map_path(element['sg_path']), dst_path)]
+
+    # Sequences and multi-file clips get a directory of all their files.
+    return [
+        (map_path(src_path), os.path.join(dst_path, os.path.basename(src_path)))
+        for src_path in element_members(element)
+    ]
+
+
+def plan_relink(pairs, replace=False, threads=8, stats=None):
+    '''Work out a :class:`RelinkPlan` for the given ``(src, dst)`` pairs.
+
+    Rather than checking each path, this lists every source and destination
+    directory once (in parallel). Existing destinations are replaced if
+    ``replace``, and otherwise skipped.
+
+    '''
+
+    stats = stats or Stats()
+    plan = RelinkPlan()
+
+    pairs = list(pairs)
+    src_dirs = set(os.path.dirname(src) for src, _ in pairs)
+    dst_dirs = set(os.path.dirname(dst) for _, dst in pairs)
+    listings = _list_dirs(sorted(src_dirs | dst_dirs), threads, stats)
+
+    # Every missing destination directory, and its missing parents.
+    missing = set()
+    for dir_ in dst_dirs:
+        while listings.get(dir_, ()) is None and dir_ not in missing:
+            missing.add(dir_)
+            parent = os.path.dirname(dir_)
+            if parent not in listings:
+                stats.count('fs.stat')
+                listings[parent] = set() if os.path.exists(parent) else None
+            dir_ = parent
+    plan.dirs = sorted(missing, key=lambda x: (x.count(os.path.sep), x))
+
+    seen = set()
+    for src, dst in pairs:
+        if dst in seen:
+            continue
+        seen.add(dst)
+        src_names = listings.get(os.path.dirname(src))
+        if not src_names or os.path.basename(src) not in src_names:
+            plan.skips.append((src, dst, 'missing source'))
+            continue
+        dst_names = listings.get(os.path.dirname(dst))
+        if dst_names and os.path.basename(dst) in dst_names:
+            if replace:
+                plan.links.append((src, dst, 'replace'))
+            else:
+                plan.skips.append((src, dst, 'exists'))
+            continue
+        plan.links.append((src, dst, 'create'))
+
+    return plan
+
+
+def apply_plan(plan, symlink, threads=8, verbose=False, stats=None, clone=False):
+    '''Create the directories of a :class:`RelinkPlan`, then its links (in parallel).
+
+    With ``clone``, the files are copied via :func:`.clone.clone_file` instead
+    of linked, and the method used for each is counted in the stats.
+
+    Returns how many links (or clones) were made.
+
+    '''
+
+    stats = stats or Stats()
+
+    with stats.span('mkdir'):
+        for dir_ in plan.dirs:
+            stats.count('fs.mkdir')
+            try:
+                os.mkdir(dir_)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def link_one(link):
+        src, dst, action = link
+        if clone:
+            # Replaces atomically, so there is no need to unlink.
+            method = clone_file(src, dst)
+            stats.count('clone.' + method)
+            if verbose:
+                print('%s -> %s (%s)' % (dst, src, method))
+            return True
+        if verbose:
+            print('%s -> %s' % (dst, src))
+        if action == 'replace':
+            stats.count('fs.unlink')
+            os.unlink(dst)
+        stats.count('fs.symlink' if symlink else 'fs.hardlink')
+        try:
+            if symlink:
+                os.symlink(src, dst)
+            else:
+                os.link(src, dst)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        return True
+
+    with stats.span('link'):
+        if threads > 1 and len(plan.links) > 1:
+            pool = ThreadPoolExecutor(threads)
+            try:
+                made = sum(pool.map(link_one, plan.links))
+            finally:
+                pool.shutdown(wait=True)
         else:
-            os.link(src_path, dst_path)
-    except OSError as e:
-        if errno != errno.EEXIST:
-            raise
+            made = sum(link_one(link) for link in plan.links)
+
+    return made
 
-    return True
+
+def relink(element, dst_path, symlink, dry_run=False, update=False,
+    replace=False, verbose=False, threads=1, clone=False, **_
+):
+    '''Relink a single Element; see :func:`plan_relink` for doing many at once.'''
+
+    plan = plan_relink(element_links(element, dst_path), replace=replace, threads=threads)
+    for src, dst, reason in plan.skips:
+        if verbose or reason == 'missing source':
+            print('%s -> %s' % (dst, src))
+            print('    Source is missing; skipping it.' if reason == 'missing source' else
+                  '    Destination already exists; skipping it.')
+    if dry_run:
+        return
+    return bool(apply_plan(plan, symlink, threads=threads, verbose=verbose, clone=clone))
 
 
 def main():
@@ -70,18 +212,80 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-s', '--symlink', action='store_true')
     parser.add_argument('-H', '--hardlink', action='store_true')
+    parser.add_argument('-C', '--clone', action='store_true',
+        help="Copy instead of linking (e.g. onto another volume); reflinks "
+             "where possible, then kernel copies, then plain ones.")
+    parser.add_argument('-j', '--threads', type=int, default=8,
+        help="Threads for listing directories and making links.")
+    parser.add_argument('--plan-only', action='store_true',
+        help="Print the plan as JSON, and don't do anything.")
     add_render_arguments(parser)
+    add_stats_arguments(parser)
     args = parser.parse_args()
 
-    if not args.dry_run and ((args.symlink and args.hardlink) or not (args.symlink or args.hardlink)):
-        print("Please pick one of --hardlink or --symlink.")
+    if not (args.dry_run or args.plan_only) and (args.symlink + args.hardlink + args.clone) != 1:
+        print("Please pick one of --hardlink, --symlink, or --clone.")
         exit(1)
 
-    for element, path in iter_render_work(**args.__dict__):
-        relink(element, path, **args.__dict__)
+    # The summaries below need the counts, so collect them privately unless
+    # --stats is already collecting them for the whole process.
+    stats = setup_stats(args, 'relink')
+    if not stats.enabled:
+        stats = Stats()
+
+    with stats.span('query'):
+        work = list(iter_render_work(check_dst=False, **args.__dict__))
+
+    # Identical content all links to the first Element's source.
+    pairs = []
+    duplicates = 0
+    if args.dedupe == 'off':
+        for element, path in work:
+            pairs.extend(element_links(element, path))
+    else:
+        for element, path, others in dedupe_render_work(work):
+            pairs.extend(element_links(element, path))
+            duplicates += len(others)
+            if args.dedupe == 'link':
+                for _, other_path in others:
+                    pairs.extend(element_links(element, other_path))
+
+    with stats.span('plan'):
+        plan = plan_relink(pairs, replace=args.replace, threads=args.threads, stats=stats)
+
+    if args.plan_only:
+        out = plan.as_dict()
+        out['stats'] = stats.as_dict()
+        print(json.dumps(out, indent=2, sort_keys=True))
+        return
+
+    for src, dst, reason in plan.skips:
+        if reason == 'missing source':
+            print('%s -> %s' % (dst, src))
+            print('    Source is missing; skipping it.')
+        elif args.verbose:
+            print('%s -> %s' % (dst, src))
+            print('    Destination already exists; skipping it.')
+
+    if duplicates:
+        print('{} Elements duplicated the content of others; {}.'.format(duplicates,
+            'linked them to the same sources' if args.dedupe == 'link' else 'dropped them'))
+
+    if args.dry_run:
+        if args.verbose:
+            for src, dst, action in plan.links:
+                print('%s -> %s' % (dst, src))
+        print('Would make {} directories and {} links; skipping {}.'.format(
+            len(plan.dirs), len(plan.links), len(plan.skips)))
+    else:
+        made = apply_plan(plan, args.symlink, threads=args.threads, verbose=args.verbose, stats=stats, clone=args.clone)
+        print('Made {} directories and {} {}; skipped {}.'.format(len(plan.dirs), made,
+            'clones' if args.clone else 'links', len(plan.skips)))
+        if args.clone:
+            print('Cloned by ' + ', '.join('{} {}'.format(stats.counters['clone.' + method], method)
+                for method in ('reflink', 'copy_file_range', 'sendfile', 'copy') if stats.counters['clone.' + method]) + '.')
 
 
 
 if __name__ == '__main__':
     main()
-
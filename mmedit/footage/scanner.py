@@ -0,0 +1,165 @@
+from __future__ import print_function
+
+import collections
+import os
+
+try:
+    from os import scandir
+except ImportError: # Python 2.
+    from scandir import scandir
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .stats import get_stats
+from .utils import EXT_TO_TYPE, SIDECAR_EXTS
+
+
+EXCLUDE_DIRS = set('''
+    __junk__
+'''.strip().split())
+
+
+ScanEntry = collections.namedtuple('ScanEntry', 'path rel_path name type size mtime')
+
+
+def type_for_name(name, sidecars=False):
+    '''A faster :func:`.utils.guess_type` for bare file names.
+
+    If ``sidecars`` is set, files in :data:`.utils.SIDECAR_EXTS` are typed
+    as ``"sidecar"``.
+
+    '''
+    if name.startswith('.'):
+        return
+    dot = name.rfind('.')
+    if dot <= 0:
+        return
+    ext = name[dot:].lower()
+    type_ = EXT_TO_TYPE.get(ext)
+    if type_ is None and sidecars and ext in SIDECAR_EXTS:
+        return 'sidecar'
+    return type_
+
+
+def _scan_dir(path, rel_path, exclude_dirs, stat, sidecars, previous):
+    try:
+        return _scan_dir_inner(path, rel_path, exclude_dirs, stat, sidecars, previous)
+    except OSError as e:
+        # One unreadable directory shouldn't lose the rest of the scan (but
+        # we still want to hear about the root).
+        if not rel_path:
+            raise
+        print('Could not scan {}: {}'.format(path, e))
+        return rel_path, [], [], None, False
+
+
+def _scan_dir_inner(path, rel_path, exclude_dirs, stat, sidecars, previous):
+
+    mtime = os.stat(path).st_mtime
+
+    # If the directory's mtime hasn't changed then nothing has been added,
+    # removed, or renamed within it, and the previous listing still holds.
+    record = previous.get(rel_path) if previous else None
+    if record and record.mtime == mtime:
+        files = []
+        for name, size, file_mtime in record.files:
+            files.append(ScanEntry(
+                os.path.join(path, name),
+                os.path.join(rel_path, name) if rel_path else name,
+                name,
+                type_for_name(name, sidecars),
+                size,
+                file_mtime,
+            ))
+        dirs = [(
+            os.path.join(path, name),
+            os.path.join(rel_path, name) if rel_path else name,
+        ) for name in record.subdirs]
+        return rel_path, files, dirs, mtime, True
+
+    files = []
+    dirs = []
+
+    for entry in scandir(path):
+
+        # DirEntry caches the d_type from readdir, so this usually doesn't
+        # cost a stat.
+        if entry.is_dir():
+            # Like os.walk, don't follow symlinks to directories.
+            if entry.name.lower() not in exclude_dirs and not entry.is_symlink():
+                dirs.append((entry.path, os.path.join(rel_path, entry.name) if rel_path else entry.name))
+            continue
+
+        type_ = type_for_name(entry.name, sidecars)
+        if not type_:
+            continue
+
+        size = file_mtime = None
+        if stat:
+            st = entry.stat()
+            size = st.st_size
+            file_mtime = st.st_mtime
+
+        files.append(ScanEntry(
+            entry.path,
+            os.path.join(rel_path, entry.name) if rel_path else entry.name,
+            entry.name,
+            type_,
+            size,
+            file_mtime,
+        ))
+
+    return rel_path, files, dirs, mtime, False
+
+
+def scan(root, exclude_dirs=EXCLUDE_DIRS, threads=16, stat=False,
+    sidecars=False, previous=None, dirs=None, stats=None
+):
+    '''Find footage under the given root, listing directories in parallel.
+
+    Yields :class:`ScanEntry` tuples as directories finish being listed (so
+    not in any particular order). ``size`` and ``mtime`` are only filled in
+    if ``stat`` is set. Sidecar files are only included if ``sidecars`` is set.
+
+    ``previous`` maps relative directory paths to :class:`.manifest.DirRecord`
+    from an earlier scan; directories whose mtime still matches are not
+    listed again. If given, ``dirs`` is filled with the mtime and subdirectory
+    names of every directory visited, and ``stats`` with counts of listed,
+    reused, and unreadable (``errors``) directories. Unreadable directories
+    below the root are skipped, and left out of ``dirs``.
+
+    '''
+
+    root = os.path.abspath(root)
+    exclude_dirs = set(x.lower() for x in exclude_dirs)
+    if stats is not None:
+        stats.setdefault('listed', 0)
+        stats.setdefault('reused', 0)
+        stats.setdefault('errors', 0)
+
+    counters = get_stats()
+
+    executor = ThreadPoolExecutor(threads)
+    try:
+        pending = set([executor.submit(_scan_dir, root, '', exclude_dirs, stat, sidecars, previous)])
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rel_dir, files, subdirs, mtime, reused = future.result()
+                if mtime is None:
+                    if stats is not None:
+                        stats['errors'] += 1
+                    counters.count('scan.errors')
+                    continue
+                for path, rel_path in subdirs:
+                    pending.add(executor.submit(_scan_dir, path, rel_path, exclude_dirs, stat, sidecars, previous))
+                if dirs is not None:
+                    dirs[rel_dir] = (mtime, [os.path.basename(p) for p, _ in subdirs])
+                if stats is not None:
+                    stats['reused' if reused else 'listed'] += 1
+                counters.count('scan.reused_dirs' if reused else 'scan.dirs')
+                counters.count('scan.files', len(files))
+                for entry in files:
+                    yield entry
+    finally:
+        executor.shutdown(wait=False)
@@ -0,0 +1,203 @@
+'''Span timers and counters shared by the mmedit tools.
+
+Every tool takes ``--stats`` (print where the time went on exit),
+``--stats-json FILE`` (write the same as JSON), and ``--profile FILE`` (run
+under cProfile, and save its stats for pstats/snakeviz). Without them the
+process-wide :func:`get_stats` is disabled, and counting or timing costs a
+single attribute check.
+
+Names are dotted by what they measure, e.g. ``scan.files``, ``hash.bytes``,
+``sg.find`` (a span per Shotgun call), ``fs.hardlink``, or ``encode``.
+
+'''
+
+from __future__ import print_function
+
+import atexit
+import collections
+import functools
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+
+class _Span(object):
+
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.name, time.time() - self.start)
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+
+class Stats(object):
+
+    '''Time spent in named spans, and named counters.
+
+    Both may be used from many threads; a span which is in several threads
+    at once adds up all of their time (so it can exceed the wall time).
+
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.spans = collections.OrderedDict() # name -> [count, seconds]
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] += n
+
+    def span(self, name):
+        '''A context manager which adds its time to the named span.'''
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def add_time(self, name, seconds, count=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.spans.get(name)
+            if entry is None:
+                entry = self.spans[name] = [0, 0.0]
+            entry[0] += count
+            entry[1] += seconds
+
+    def as_dict(self):
+        return {
+            'spans': dict((name, {'count': count, 'seconds': seconds}) for name, (count, seconds) in self.spans.items()),
+            'counters': dict(self.counters),
+        }
+
+    def report(self):
+        for name, (count, seconds) in self.spans.items():
+            if count > 1:
+                print('{:>20} {:9.3f}s {:8d}x {:9.1f}ms avg'.format(name, seconds, count, 1000 * seconds / count))
+            else:
+                print('{:>20} {:9.3f}s'.format(name, seconds))
+        for name, value in sorted(self.counters.items()):
+            if name.endswith('.bytes'):
+                print('{:>20} {:9.1f} MB'.format(name, value / 1e6))
+            else:
+                print('{:>20} {:9g}'.format(name, value))
+
+
+_stats = Stats(enabled=False)
+
+def get_stats():
+    '''The :class:`Stats` for this process (only enabled by :func:`setup_stats`).'''
+    return _stats
+
+
+SESSION_METHODS = ('find', 'find_one', 'create', 'update', 'delete', 'batch', 'fetch')
+
+def _timed_call(stats, name, func):
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stats.add_time(name, time.time() - start)
+    return call
+
+
+def instrument_session(session, stats=None):
+    '''Time every call the given Session makes to Shotgun (as ``sg.<method>``).
+
+    The session is wrapped in place (so Entities which refer to it are timed
+    too), and only if the stats are enabled. Returns the session.
+
+    '''
+
+    stats = stats or _stats
+    if not stats.enabled or getattr(session, '_mmedit_stats', None) is stats:
+        return session
+    for name in SESSION_METHODS:
+        func = getattr(session, name, None)
+        if func is not None:
+            setattr(session, name, _timed_call(stats, 'sg.' + name, func))
+    session._mmedit_stats = stats
+    return session
+
+
+def add_stats_arguments(parser):
+    parser.add_argument('--stats', action='store_true',
+        help="Print where the time went (and counts of files, bytes, Shotgun calls, etc.) on exit.")
+    parser.add_argument('--stats-json', metavar='FILE',
+        help="Write the same as --stats to FILE as JSON.")
+    parser.add_argument('--profile', metavar='FILE',
+        help="Run under cProfile (main thread only), and save its stats to FILE.")
+
+
+def setup_stats(args, name):
+    '''Enable the process stats if the args ask for them, and report at exit.
+
+    The whole run is timed as a span named ``name``. Returns the stats.
+
+    '''
+
+    stats = _stats
+    print_stats = getattr(args, 'stats', False)
+    json_path = getattr(args, 'stats_json', None)
+    profile_path = getattr(args, 'profile', None)
+    if not (print_stats or json_path or profile_path):
+        return stats
+
+    stats.enabled = bool(print_stats or json_path)
+
+    profiler = None
+    if profile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.time()
+
+    def finish():
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        stats.add_time(name, time.time() - start)
+        if print_stats:
+            print('--- {} stats ---'.format(name))
+            stats.report()
+        if json_path:
+            out = stats.as_dict()
+            out.update(
+                command=name,
+                argv=sys.argv,
+                host=socket.gethostname(),
+                pid=os.getpid(),
+                time=time.time(),
+            )
+            with open(json_path, 'w') as fh:
+                json.dump(out, fh, indent=2, sort_keys=True)
+
+    atexit.register(finish)
+    return stats
@@ -1,9 +1,15 @@
 import errno
+import itertools
+import json
 import os
 import re
 
 from sgfs import SGFS
 
+from .grouping import parse_frames, sequence_pattern
+from .mirror import MirrorSGFS
+from .stats import get_stats, instrument_session
+
 
 def makedirs(path):
     try: 
@@ -13,6 +19,30 @@ def makedirs(path):
             raise
 
 
+def link_file(src, dst, symlink=False):
+    '''Link ``dst`` to ``src``, replacing whatever is there.
+
+    Hard links fall back to symlinks if they can't be made (e.g. across
+    devices). Returns ``"hardlink"`` or ``"symlink"``.
+
+    '''
+
+    makedirs(os.path.dirname(dst))
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if not symlink:
+        try:
+            os.link(src, dst)
+            get_stats().count('fs.hardlink')
+            return 'hardlink'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    os.symlink(os.path.abspath(src), dst)
+    get_stats().count('fs.symlink')
+    return 'symlink'
+
+
 
 EXT_TO_TYPE = {
 
@@ -22,6 +52,8 @@ EXT_TO_TYPE = {
     '.mov':  'footage',
     '.mxf':  'footage',
 
+    '.dpx':  'image',
+    '.exr':  'image',
     '.jpg':  'image',
     '.jpeg': 'image',
     '.png':  'image',
@@ -34,6 +66,13 @@ EXT_TO_TYPE = {
 
 }
 
+# Files which aren't Elements on their own, but which belong to a clip (see
+# mmedit.footage.grouping).
+SIDECAR_EXTS = set((
+    '.bim',
+    '.xml',
+))
+
 def guess_type(path):
     """What type of element is this?
 
@@ -62,28 +101,145 @@ REDUCTIONS = (
     (r'/xdroot/', '/'),
 )
 
+_REDUCTIONS = [(re.compile(pattern, re.IGNORECASE), replacement) for pattern, replacement in REDUCTIONS]
+
 def reduce_path(path):
-    for pattern, replacement in REDUCTIONS:
-        path = re.sub(pattern, replacement, path, flags=re.IGNORECASE)
+    for pattern, replacement in _REDUCTIONS:
+        path = pattern.sub(replacement, path)
     return path
 
 
+_UNCLEAN = re.compile(r'[^\w,\.]+')
+
 def clean_path(path):
     parts = path.split(os.path.sep)
-    parts = [re.sub(r'[^\w,\.]+', '-', part).strip('-') for part in parts]
+    parts = [_UNCLEAN.sub('-', part).strip('-') for part in parts]
     return os.path.sep.join(parts)
 
 
-def unique_name(path, element, prefer_checksum=False):
+SUFFIX_LENGTH = 8
 
-        base, ext = os.path.splitext(path)
+def _suffix_key(element, prefer_checksum=False):
+    # "x" is for checksum, and "u" for UUID; wanted to uses non-hex letters.
+    if prefer_checksum and element.fetch('sg_checksum'):
+        # Checksums are assumed to look like "md5:xxx" or "sha256:xxx".
+        return 'X', element['sg_checksum'].split(':')[-1].upper()
+    else:
+        return 'U', element.fetch('sg_uuid').replace('-', '').upper()
+
+
+def unique_name(path, element, prefer_checksum=False, length=SUFFIX_LENGTH):
+    base, ext = os.path.splitext(path)
+    letter, key = _suffix_key(element, prefer_checksum)
+    return '%s_%s%s%s' % (base, letter, key[:length], ext)
+
+
+class PathPlanner(object):
+
+    '''Plans the relative destinations for many Elements at once.
+
+    Each directory is only reduced and cleaned once, and Elements whose
+    names would collide (same name, and the same first few characters of
+    their checksum/UUID) get suffixes just long enough to tell them apart.
+    Elements with identical content still share a name; see
+    :func:`dedupe_render_work`.
+
+    '''
+
+    def __init__(self, reduce_paths=True, prefer_uuid=False, suffix_length=SUFFIX_LENGTH):
+        self.reduce_paths = reduce_paths
+        self.prefer_checksum = not prefer_uuid
+        self.suffix_length = suffix_length
+        self.widened = 0
+        self._dirs = {}
+        self._names = {}
+
+    def clean_dir(self, dir_):
+        try:
+            return self._dirs[dir_]
+        except KeyError:
+            pass
+        out = dir_
+        if out and self.reduce_paths:
+            # The reductions need the trailing slash that the name would give.
+            out = reduce_path(out + os.path.sep)[:-1]
+        out = self._dirs[dir_] = clean_path(out)
+        return out
+
+    def split_path(self, element):
+        '''The relative destination of an Element as ``(base, ext)``, without its suffix.'''
+
+        dir_, _, name = element['sg_relative_path'].rpartition(os.path.sep)
+        if is_grouped(element):
+            # Sequences and multi-file clips become a directory holding all
+            # of their files (under their original names).
+            name = element['code'].replace('.', '_')
+        try:
+            base, ext = self._names[name]
+        except KeyError:
+            # Cards reuse names a lot (e.g. DJI_0001.MP4), so these are memoized too.
+            base, ext = self._names[name] = os.path.splitext(clean_path(name))
+        dir_ = self.clean_dir(dir_)
+        return (dir_ + os.path.sep + base if dir_ else base), ext
+
+    def plan(self, elements):
+        '''Returns a list of ``(element, rel_path)``, in the given order.'''
+
+        length = self.suffix_length
+        entries = []
+        by_name = {}
+        for element in elements:
+            base, ext = self.split_path(element)
+            letter, key = _suffix_key(element, self.prefer_checksum)
+            entry = [element, base, letter, key, ext, length]
+            entries.append(entry)
+            by_name.setdefault((base, letter, key[:length], ext), []).append(entry)
+
+        for group in by_name.values():
+            if len(group) < 2:
+                continue
+            keys = set(entry[3] for entry in group)
+            if len(keys) < 2:
+                continue
+            length = self.suffix_length
+            longest = max(len(key) for key in keys)
+            while length < longest and len(set(key[:length] for key in keys)) < len(keys):
+                length += 1
+            for entry in group:
+                entry[5] = length
+            self.widened += len(group)
 
-        # "x" is for checksum, and "u" for UUID; wanted to uses non-hex letters.
-        if prefer_checksum and element.fetch('sg_checksum'):
-            # Checksums are assumed to look like "md5:xxx" or "sha256:xxx".
-            return '%s_X%s%s' % (base, element['sg_checksum'].split(':')[-1][:8].upper(), ext)
-        else:
-            return '%s_U%s%s' % (base, element.fetch('sg_uuid')[:8].upper(), ext)
+        return [
+            (element, '%s_%s%s%s' % (base, letter, key[:length], ext))
+            for element, base, letter, key, ext, length in entries
+        ]
+
+
+def is_grouped(element):
+    '''Is this Element an image sequence or multi-file clip?'''
+    return bool(element.get('sg_frames') or element.get('sg_members'))
+
+
+def element_members(element):
+    '''All of the files which make up an Element, as absolute paths.
+
+    Sequences expand their ``sg_frames`` against the first frame in
+    ``sg_path``; clips resolve their ``sg_members`` (which are relative to
+    the ElementSet) against ``sg_path``.
+
+    '''
+
+    path = element['sg_path']
+
+    if element.get('sg_frames'):
+        pattern, _ = sequence_pattern(path)
+        return [pattern % frame for frame in parse_frames(element['sg_frames'])]
+
+    if element.get('sg_members'):
+        root = path[:-len(element['sg_relative_path'])]
+        return [os.path.join(root, rel_path) for rel_path in json.loads(element['sg_members'])]
+
+    return [path]
 
 
 def add_render_arguments(parser):
@@ -103,17 +259,61 @@ def add_render_arguments(parser):
     parser.add_argument('-U', '--replace', action='store_true',
         help="Allow updating over existing files.")
     parser.add_argument('-n', '--dry-run', action='store_true')
+    parser.add_argument('--offline', '--cached', dest='offline', action='store_true',
+        help="Read Elements from the local mirror (see mmedit-sync) instead of Shotgun.")
+    parser.add_argument('--dedupe', choices=('link', 'drop', 'off'), default='link',
+        help="What to do with Elements whose content (sg_checksum) is identical "
+             "to another's: link them to the first one's result (the default), "
+             "drop them, or treat them separately.")
 
     parser.add_argument('entity',
         help="$ElementSet or Project (if --all).")
     parser.add_argument('root')
 
 
+ELEMENT_FIELDS = [
+    'code', 'sg_path', 'sg_relative_path', 'sg_uuid', 'sg_checksum', 'sg_type',
+    'sg_frames', 'sg_members', 'sg_element_set',
+]
+
+
+def iter_elements(sg, element_sets, fields=ELEMENT_FIELDS, page_size=500):
+    '''Stream the Elements of the given ElementSets, a page at a time.
+
+    This is a single (paged) query however many sets there are; the Elements
+    come ordered by set id (not by the set's name, which may not be unique),
+    so they can be grouped as they arrive.
+
+    '''
+
+    if not element_sets:
+        return
+
+    page = 1
+    while True:
+        elements = sg.find('Element', [
+            ('sg_element_set', 'in', [{'type': x['type'], 'id': x['id']} for x in element_sets]),
+        ], fields,
+            order=[
+                {'field_name': 'sg_element_set.CustomEntity27.id', 'direction': 'asc'},
+                {'field_name': 'id', 'direction': 'asc'},
+            ],
+            limit=page_size,
+            page=page,
+        )
+        for element in elements:
+            yield element
+        if len(elements) < page_size:
+            return
+        page += 1
+
+
 def iter_render_work(entity, root, all=False, update=False, replace=False,
-    sgfs=None, **kwargs
+    sgfs=None, page_size=500, offline=False, **kwargs
 ):
 
-    sgfs = sgfs or SGFS()
+    sgfs = sgfs or (MirrorSGFS() if offline else SGFS())
+    instrument_session(sgfs.session)
 
     if all:
         project = sgfs.parse_user_input(entity, ['Project'])
@@ -141,11 +341,12 @@ def iter_render_work(entity, root, all=False, update=False, replace=False,
     if not can_continue:
         exit(1)
 
-    for element_set, root in todo:
-        elements = sgfs.session.find('Element', [
-            ('sg_element_set', 'is', element_set),
-        ], ['sg_path', 'sg_relative_path', 'sg_uuid', 'sg_checksum', 'sg_type'])
-        for x in _iter_render_work(elements, root,
+    roots = dict((element_set['id'], root) for element_set, root in todo)
+    elements = iter_elements(sgfs.session, [element_set for element_set, _ in todo], page_size=page_size)
+
+    # Each set comes back as one run (see iter_elements).
+    for set_id, group in itertools.groupby(elements, lambda e: e['sg_element_set']['id']):
+        for x in _iter_render_work(group, roots[set_id],
             update=update,
             replace=replace,
             **kwargs
@@ -155,7 +356,7 @@ def iter_render_work(entity, root, all=False, update=False, replace=False,
 
 def _iter_render_work(elements, root, reduce_paths=True, prefer_uuid=False,
     ignore_uuid=False, update=False, replace=False, generate_path=None, verbose=False,
-    dry_run=False, types=None, **_
+    dry_run=False, types=None, check_dst=True, **_
 ):
 
     root = os.path.abspath(root)
@@ -166,25 +367,21 @@ def _iter_render_work(elements, root, reduce_paths=True, prefer_uuid=False,
     if not os.path.exists(parent):
         raise ValueError('Parent does not exist.', parent)
 
-    if not elements:
-        return
-
-    sg = elements[0].session
-    sg.fetch(elements, ['sg_path', 'sg_relative_path', 'sg_uuid', 'sg_type', 'sg_checksum'])
-
+    todo = []
     for element in elements:
-
         if types and element['sg_type'] not in types:
             continue
-
         if ignore_uuid and not element['sg_checksum']:
-            return
-        
-        rel_path = element['sg_relative_path']
-        if reduce_paths:
-            rel_path = reduce_path(rel_path)
-        rel_path = clean_path(rel_path)
-        rel_path = unique_name(rel_path, element, prefer_checksum=not prefer_uuid)
+            break
+        todo.append(element)
+
+    planner = PathPlanner(reduce_paths=reduce_paths, prefer_uuid=prefer_uuid)
+    planned = planner.plan(todo)
+    if planner.widened:
+        print("Lengthened the suffixes of {} Elements whose names would collide.".format(planner.widened))
+
+    made = set()
+    for element, rel_path in planned:
 
         path = os.path.join(root, rel_path)
         if generate_path:
@@ -193,8 +390,14 @@ def _iter_render_work(elements, root, reduce_paths=True, prefer_uuid=False,
                 continue
         dir_ = os.path.dirname(path)
 
-        if not dry_run:
+        # The caller will deal with the destination (e.g. in bulk).
+        if not check_dst:
+            yield element, path
+            continue
+
+        if not dry_run and dir_ not in made:
             makedirs(dir_)
+            made.add(dir_)
 
         if not os.path.exists(path):
             yield element, path
@@ -209,5 +412,29 @@ def _iter_render_work(elements, root, reduce_paths=True, prefer_uuid=False,
                 print('    Destination already exists; skipping it.')
 
 
+def dedupe_render_work(work):
+    '''Group the output of :func:`iter_render_work` by content.
 
+    Returns a list of ``(element, path, duplicates)``, in the order they were
+    first seen, where ``duplicates`` is a list of ``(element, path)`` with the
+    same ``sg_checksum``. Grouped Elements (whose checksum only covers their
+    first file) and those without a checksum are never merged.
 
+    '''
+
+    out = []
+    by_checksum = {}
+    for element, path in work:
+        checksum = None if is_grouped(element) else element.get('sg_checksum')
+        if checksum:
+            key = (element.get('sg_type'), checksum)
+            primary = by_checksum.get(key)
+            if primary is not None:
+                if path != primary[1]:
+                    primary[2].append((element, path))
+                continue
+        record = (element, path, [])
+        if checksum:
+            by_checksum[key] = record
+        out.append(record)
+    return out
@@ -20,6 +20,7 @@ setup(
             mmedit-relink = mmedit.footage.relink:main
             mmedit-checksum = mmedit.footage.checksum:main
             mmedit-proxy = mmedit.footage.proxy:main
+            mmedit-sync = mmedit.footage.mirror:main
             
         ''',
     },
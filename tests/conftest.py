@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The fake Shotgun lives with the benchmarks, which use it too.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
@@ -0,0 +1,60 @@
+import math
+
+from fake_shotgun import FakeShotgun, FakeSession
+
+from mmedit.footage.checksum import BatchWriter
+
+
+def make_elements(server, count):
+    return [
+        server.add('Element', {'code': 'clip%d' % i, 'sg_path': '/footage/clip%d.mov' % i, 'sg_checksum': None})
+        for i in range(count)
+    ]
+
+
+def write_all(writer, elements):
+    writer.start()
+    for element in elements:
+        writer.put(element['id'], element['sg_path'], {'sg_checksum': 'md5:%032x' % element['id']})
+    return writer.close()
+
+
+def test_batches_per_chunk():
+    server = FakeShotgun()
+    elements = make_elements(server, 250)
+    writer = BatchWriter(FakeSession(server), elements, chunk_size=100)
+    assert write_all(writer, elements) == 0
+    assert server.calls['batch'] == int(math.ceil(250 / 100.0))
+    assert server.rows['batch'] == 250
+    assert sum(server.calls.values()) == server.calls['batch']
+    assert writer.written == 250
+    assert all(server.get('Element', e['id'])['sg_checksum'] for e in elements)
+
+
+def test_skips_changed_paths_and_existing_checksums():
+    server = FakeShotgun()
+    elements = [dict(e) for e in make_elements(server, 3)]
+    writer = BatchWriter(FakeSession(server), elements, chunk_size=100)
+    elements[1]['sg_path'] = '/somewhere/else.mov' # Moved since it was hashed.
+    elements[2]['sg_checksum'] = 'md5:already'
+    write_all(writer, [server.get('Element', e['id']) for e in elements])
+    assert writer.written == 1
+    assert writer.skipped == 2
+    assert server.calls['batch'] == 1
+
+
+class FailingSession(FakeSession):
+
+    def batch(self, requests):
+        self.server.call('batch', len(requests))
+        raise RuntimeError('Shotgun is down.')
+
+
+def test_failed_batches_are_reported():
+    server = FakeShotgun()
+    elements = make_elements(server, 150)
+    writer = BatchWriter(FailingSession(server), elements, chunk_size=100)
+    assert write_all(writer, elements) == 150
+    assert writer.written == 0
+    assert len(writer.errors) == 2
+    assert server.calls['batch'] == 2
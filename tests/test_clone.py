@@ -0,0 +1,57 @@
+import errno
+import os
+
+import pytest
+
+from mmedit.footage import clone
+from mmedit.footage.clone import clone_file
+
+
+def make_src(tmpdir):
+    src = tmpdir.join('src.mov')
+    src.write('x' * 10000)
+    os.utime(str(src), (1500000000.123456, 1500000000.123456))
+    return str(src)
+
+
+def test_clone_keeps_content_and_mtime(tmpdir):
+    src = make_src(tmpdir)
+    dst = str(tmpdir.join('dst.mov'))
+    assert clone_file(src, dst)
+    assert open(dst).read() == open(src).read()
+    assert os.stat(dst).st_mtime == os.stat(src).st_mtime
+    if hasattr(os.stat(src), 'st_mtime_ns'):
+        assert os.stat(dst).st_mtime_ns == os.stat(src).st_mtime_ns
+
+
+def test_missing_dst_dir_raises_the_original_error(tmpdir):
+    src = make_src(tmpdir)
+    with pytest.raises(OSError) as info:
+        clone_file(src, str(tmpdir.join('missing', 'dst.mov')))
+    assert info.value.errno == errno.ENOENT
+    assert 'cloning' in info.value.filename
+
+
+def test_failed_copy_cleans_up(tmpdir):
+
+    def fail(src_fd, dst_fd, size):
+        os.write(dst_fd, b'partial')
+        raise IOError(errno.EIO, 'Disk on fire.')
+
+    src = make_src(tmpdir)
+    with pytest.raises(IOError) as info:
+        clone_file(src, str(tmpdir.join('dst.mov')), methods=[('copy', fail)])
+    assert info.value.errno == errno.EIO
+    assert sorted(os.listdir(str(tmpdir))) == ['src.mov']
+
+
+def test_sendfile_to_a_file_falls_back_to_copy(tmpdir):
+
+    # As on macOS, where sendfile only writes to sockets.
+    def sendfile(src_fd, dst_fd, size):
+        raise OSError(errno.ENOTSOCK, 'Socket operation on non-socket')
+
+    src = make_src(tmpdir)
+    dst = str(tmpdir.join('dst.mov'))
+    assert clone_file(src, dst, methods=[('sendfile', sendfile), ('copy', clone._buffered)]) == 'copy'
+    assert open(dst).read() == open(src).read()
@@ -0,0 +1,33 @@
+import os
+
+from mmedit.footage.grouping import group_entries
+from mmedit.footage.scanner import ScanEntry
+
+
+def entries(rel_dir, names):
+    return [
+        ScanEntry(os.path.join('/root', rel_dir, name), os.path.join(rel_dir, name), name, 'footage', 1, 0)
+        for name in names
+    ]
+
+
+def by_kind(groups):
+    return sorted((g.kind, g.code, g.element_fields().get('sg_frames')) for g in groups)
+
+
+def test_sequences_split_at_gaps():
+    names = ['shot.%04d.dpx' % i for i in (1001, 1002, 1003, 1004, 1007, 1010, 1011, 1012)]
+    assert by_kind(group_entries(entries('renders', names))) == [
+        ('file', 'shot.1007', None),
+        ('sequence', 'shot_1001', '1001-1004'),
+        ('sequence', 'shot_1010', '1010-1012'),
+    ]
+
+
+def test_short_runs_are_stills():
+    names = ['IMG_0001.jpg', 'IMG_0002.jpg', 'plate.0001.exr', 'plate.0002.exr', 'plate.0003.exr']
+    assert by_kind(group_entries(entries('stills', names))) == [
+        ('file', 'IMG_0001', None),
+        ('file', 'IMG_0002', None),
+        ('sequence', 'plate', '1-3'),
+    ]
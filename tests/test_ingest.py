@@ -0,0 +1,66 @@
+import datetime
+
+from fake_shotgun import FakeShotgun, FakeSession
+
+from mmedit.footage import ingest, pathmap
+
+
+def test_probe_specs_probes_mapped_paths(monkeypatch, tmpdir):
+
+    monkeypatch.setattr(pathmap, '_default', pathmap.PathMap([('/Volumes/EDsource', '/mnt/edsource')]))
+    monkeypatch.setattr(ingest, 'ProbeCache', lambda: type('Cache', (), {'hits': 0, 'close': lambda self: None})())
+
+    probed = []
+    def probe_many(paths, cache=None, processes=None):
+        for path in paths:
+            probed.append(path)
+            yield path, {'format': {'duration': '1.0'}, 'streams': []}, None
+    monkeypatch.setattr(ingest, 'probe_many', probe_many)
+
+    specs = [
+        {'sg_type': 'footage', 'sg_path': '/Volumes/EDsource/card/clip.mov'},
+        {'sg_type': 'image', 'sg_path': '/Volumes/EDsource/card/shot.1001.dpx', 'sg_frames': '1001-1010'},
+    ]
+    ingest._probe_specs(specs)
+
+    # The same key proxy will look the probe up by.
+    assert probed == ['/mnt/edsource/card/clip.mov']
+    assert specs[0]['sg_path'] == '/Volumes/EDsource/card/clip.mov'
+    assert 'sg_metadata' in specs[0]
+
+
+def test_find_element_sets_separates_placeholders():
+
+    server = FakeShotgun()
+    sg = FakeSession(server)
+    project = server.add('Project', {'name': 'Test'})
+    add = lambda code, root='/footage/A001': server.add('CustomEntity27', {
+        'code': code, 'sg_path': root, 'project': project})
+
+    assert ingest.find_element_sets(sg, '/footage/A001') == (None, None)
+
+    old = add('A001')
+    first_placeholder = add(ingest.PLACEHOLDER_CODE)
+    forced = add('A001') # After --force.
+    placeholder = add(ingest.PLACEHOLDER_CODE)
+    add('A002', root='/footage/A002')
+
+    element_set, found = ingest.find_element_sets(sg, '/footage/A001')
+    assert element_set['id'] == forced['id'] != old['id']
+    assert found['id'] == placeholder['id'] != first_placeholder['id']
+
+
+def test_seconds_since_activity():
+
+    server = FakeShotgun()
+    sg = FakeSession(server)
+    now = datetime.datetime.utcnow()
+    placeholder = server.add('CustomEntity27', {'code': ingest.PLACEHOLDER_CODE,
+        'created_at': now - datetime.timedelta(hours=1)})
+
+    assert 3590 < ingest.seconds_since_activity(sg, placeholder) < 3610
+
+    for minutes in (30, 2, 45):
+        server.add('Element', {'sg_element_set': placeholder, 'created_at': now - datetime.timedelta(minutes=minutes)})
+    assert 110 < ingest.seconds_since_activity(sg, placeholder) < 130
+    assert ingest.seconds_since_activity(sg, placeholder) < ingest.LIVE_INGEST_SECONDS
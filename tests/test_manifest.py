@@ -0,0 +1,31 @@
+import os
+
+from mmedit.footage.manifest import Manifest
+from mmedit.footage.scanner import scan
+
+
+def test_rescan_reuses_every_directory(tmpdir, monkeypatch):
+
+    monkeypatch.setenv('MMEDIT_MANIFEST_DIR', str(tmpdir.join('manifests')))
+    root = tmpdir.join('A001')
+    for rel_path in ('clip0.mov', 'CARD01/clip1.mov', 'CARD01/sub/clip2.mov'):
+        root.join(rel_path).ensure()
+    root = str(root)
+
+    dirs = {}
+    entries = list(scan(root, stat=True, dirs=dirs))
+    mtime = os.stat(root).st_mtime
+    Manifest.from_scan(root, entries, dirs, 123).save()
+
+    # Saving must not touch the tree, or the root would never be reused.
+    assert os.stat(root).st_mtime == mtime
+    assert sorted(os.listdir(root)) == ['CARD01', 'clip0.mov']
+
+    manifest = Manifest.load(root)
+    assert manifest.element_set_id == 123
+    stats = {}
+    rescanned = list(scan(root, stat=True, previous=manifest.dir_records(), stats=stats))
+    assert stats == {'listed': 0, 'reused': 3, 'errors': 0}
+    assert manifest.diff(rescanned) == ([], [], [])
+
+    assert Manifest.load(str(tmpdir.join('other'))) is None
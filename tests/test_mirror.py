@@ -0,0 +1,183 @@
+import datetime
+import hashlib
+import os
+
+import pytest
+
+from fake_shotgun import FakeShotgun, FakeSession
+
+from mmedit.footage import checksum
+from mmedit.footage.mirror import ELEMENT_SET_TYPE, Mirror, MirrorSession, MirrorSGFS, sync
+from mmedit.footage.utils import iter_render_work
+
+
+T0 = datetime.datetime(2017, 3, 1, 12, 0, 0)
+
+def at(seconds):
+    return T0 + datetime.timedelta(seconds=seconds)
+
+
+@pytest.fixture
+def server():
+    return FakeShotgun()
+
+
+@pytest.fixture
+def mirror(tmpdir):
+    mirror = Mirror(str(tmpdir.join('mirror.sqlite')))
+    yield mirror
+    mirror.close()
+
+
+def add_set(server, project, code='A001', updated=0):
+    return server.add(ELEMENT_SET_TYPE, {'code': code, 'project': project, 'sg_path': '/footage/' + code,
+        'updated_at': at(updated)})
+
+
+def add_element(server, element_set, rel_path, updated=0, root='/footage', **fields):
+    data = {
+        'code': os.path.splitext(os.path.basename(rel_path))[0],
+        'project': element_set['project'],
+        'sg_element_set': element_set,
+        'sg_path': os.path.join(root, rel_path),
+        'sg_relative_path': rel_path,
+        'sg_uuid': hashlib.md5(rel_path.encode('utf8')).hexdigest(),
+        'sg_type': 'footage',
+        'sg_checksum': None,
+        'updated_at': at(updated),
+    }
+    data.update(fields)
+    return server.add('Element', data)
+
+
+def test_incremental_sync_overlaps_a_second(server, mirror):
+
+    project = server.add('Project', {'name': 'Test'})
+    element_set = add_set(server, project)
+    e1 = add_element(server, element_set, 'a.mov', updated=0)
+    e2 = add_element(server, element_set, 'b.mov', updated=5)
+    add_element(server, element_set, 'c.mov', updated=10)
+
+    counts = sync(FakeSession(server), mirror)
+    assert counts['Element'] == {'updated': 3, 'deleted': 0}
+    assert counts[ELEMENT_SET_TYPE] == {'updated': 1, 'deleted': 0}
+
+    # Changed within the same second as the latest we saw, and a new one.
+    e2.update(sg_path='/footage/moved/b.mov', updated_at=at(10))
+    add_element(server, element_set, 'd.mov', updated=20)
+
+    counts = sync(FakeSession(server), mirror)
+    # b and d, plus c again (from the second of overlap); but not a.
+    assert counts['Element']['updated'] == 3
+
+    session = MirrorSession(mirror)
+    assert session.find_one('Element', [('id', 'is', e2['id'])])['sg_path'] == '/footage/moved/b.mov'
+    assert len(session.find('Element', [])) == 4
+
+    # Nothing changed, so only the overlap comes back.
+    counts = sync(FakeSession(server), mirror)
+    assert counts['Element']['updated'] == 1
+    assert session.find_one('Element', [('id', 'is', e1['id'])])['sg_relative_path'] == 'a.mov'
+
+
+def test_full_sync_drops_deleted(server, mirror):
+
+    project = server.add('Project', {'name': 'Test'})
+    element_set = add_set(server, project)
+    gone = add_element(server, element_set, 'a.mov')
+    add_element(server, element_set, 'b.mov')
+    sync(FakeSession(server), mirror)
+
+    del server.entities['Element'][gone['id']]
+    counts = sync(FakeSession(server), mirror)
+    assert counts['Element']['deleted'] == 0
+
+    counts = sync(FakeSession(server), mirror, full=True)
+    assert counts['Element'] == {'updated': 1, 'deleted': 1}
+    assert [e['sg_relative_path'] for e in MirrorSession(mirror).find('Element', [])] == ['b.mov']
+
+
+def test_filters(server, mirror):
+
+    p1 = server.add('Project', {'name': 'One'})
+    p2 = server.add('Project', {'name': 'Two'})
+    s1 = add_set(server, p1, 'A001')
+    s2 = add_set(server, p1, 'A002')
+    s3 = add_set(server, p2, 'B001')
+    e1 = add_element(server, s1, 'a.mov', sg_checksum='md5:aaa')
+    add_element(server, s1, 'b.mov')
+    add_element(server, s2, 'c.mov', sg_checksum='md5:ccc')
+    add_element(server, s3, 'd.mov')
+    sync(FakeSession(server), mirror)
+
+    session = MirrorSession(mirror)
+    names = lambda entities: sorted(e['sg_relative_path'] for e in entities)
+
+    assert session.find_one('Element', [('id', 'is', e1['id'])])['sg_checksum'] == 'md5:aaa'
+    assert names(session.find('Element', [('project', 'is', p1)])) == ['a.mov', 'b.mov', 'c.mov']
+    assert names(session.find('Element', [('sg_element_set', 'is', s1)])) == ['a.mov', 'b.mov']
+    assert names(session.find('Element', [('sg_element_set', 'in', [s1, s3])])) == ['a.mov', 'b.mov', 'd.mov']
+    assert names(session.find('Element', [('sg_element_set', 'in', [])])) == []
+    assert names(session.find('Element', [('sg_path', 'is', '/footage/c.mov')])) == ['c.mov']
+    assert names(session.find('Element', [('sg_checksum', 'is', '')])) == ['b.mov', 'd.mov']
+    assert names(session.find('Element', [('sg_checksum', 'is_not', '')])) == ['a.mov', 'c.mov']
+    assert names(session.find('Element', [('project', 'is', p1), ('sg_checksum', 'is', '')])) == ['b.mov']
+    assert session.find_one(ELEMENT_SET_TYPE, [('code', 'is', 'A002')])['id'] == s2['id']
+
+    # Paged, in set then id order.
+    pages = [names(session.find('Element', [], limit=3, page=page)) for page in (1, 2)]
+    assert pages == [['a.mov', 'b.mov', 'c.mov'], ['d.mov']]
+
+    with pytest.raises(ValueError):
+        session.find('Element', [('sg_type', 'is', 'footage')])
+
+    sgfs = MirrorSGFS(mirror)
+    assert sgfs.parse_user_input('Two', ['Project'])['id'] == p2['id']
+    assert sgfs.parse_user_input('A002')['id'] == s2['id']
+    assert sgfs.parse_user_input('$ElementSet:%d' % s3['id'])['code'] == 'B001'
+
+
+def test_offline_render_work(server, mirror, tmpdir):
+
+    project = server.add('Project', {'name': 'Test'})
+    element_set = add_set(server, project)
+    for rel_path in ('CARD01/DCIM/100MEDIA/DJI_0001.MP4', 'CARD01/DCIM/100MEDIA/DJI_0002.MP4', 'b.mov'):
+        add_element(server, element_set, rel_path, sg_checksum='md5:' + hashlib.md5(rel_path.encode('utf8')).hexdigest())
+    sync(FakeSession(server), mirror)
+    server.reset_counts()
+
+    root = str(tmpdir.join('out'))
+    work = list(iter_render_work('CustomEntity27:%d' % element_set['id'], root,
+        sgfs=MirrorSGFS(mirror), check_dst=False))
+
+    assert not server.calls
+    assert sorted(os.path.relpath(path, root).split('_X')[0] for _, path in work) == [
+        'CARD01/DJI_0001', 'CARD01/DJI_0002', 'b']
+
+
+def test_offline_verify(server, mirror, tmpdir, monkeypatch):
+
+    footage = tmpdir.mkdir('footage')
+    project = server.add('Project', {'name': 'Test'})
+    element_set = add_set(server, project)
+    for name, content in (('a.mov', b'a' * 1000), ('b.mov', b'b' * 1000)):
+        footage.join(name).write(content, 'wb')
+        add_element(server, element_set, name, root=str(footage),
+            sg_checksum='md5:' + hashlib.md5(content).hexdigest())
+    sync(FakeSession(server), mirror)
+    mirror.close()
+    server.reset_counts()
+
+    monkeypatch.setenv('MMEDIT_MIRROR', mirror.path)
+    argv = ['verify', '--offline', '--full', 'CustomEntity27:%d' % element_set['id']]
+
+    with pytest.raises(SystemExit) as info:
+        checksum.main(argv)
+    assert info.value.code == 0
+
+    footage.join('b.mov').write(b'c' * 1000, 'wb')
+    with pytest.raises(SystemExit) as info:
+        checksum.main(argv)
+    assert info.value.code == 1
+
+    assert not server.calls
@@ -0,0 +1,31 @@
+from mmedit.footage.progress import iter_progress
+
+
+def events(text):
+    return list(iter_progress(text.strip().splitlines()))
+
+
+def test_out_time():
+    assert events('''
+frame=10
+out_time_us=1500000
+out_time=00:00:01.500000
+progress=continue
+''')[0]['out_time'] == 1.5
+    assert events('''
+out_time_us=2000000
+out_time=N/A
+progress=continue
+''')[0]['out_time'] == 2.0
+
+
+def test_junk_out_time_is_unknown():
+    for value in ('N/A', 'garbage', '-9223372036854775807', ''):
+        event, = events('''
+frame=0
+out_time_us={0}
+out_time=N/A
+progress=continue
+'''.format(value))
+        assert event['out_time'] is None
+        assert event['frame'] == 0
@@ -0,0 +1,67 @@
+import argparse
+import os
+
+from fake_shotgun import FakeShotgun, FakeSGFS
+
+from mmedit.footage import proxy
+
+
+def make_args(tmpdir, element_set, **kwargs):
+    args = argparse.Namespace(
+        entity='CustomEntity27:%d' % element_set['id'],
+        root=str(tmpdir.join('out')),
+        formats=['mov', 'mxf'],
+        postfix='',
+        types=['footage'],
+        dedupe='off',
+        all=False,
+        update=True,
+        replace=False,
+        prefer_uuid=False,
+        ignore_uuid=False,
+        verbose=False,
+        dry_run=False,
+        offline=False,
+        sgfs=FakeSGFS(),
+    )
+    vars(args).update(kwargs)
+    return args
+
+
+def test_missing_format_is_made(tmpdir, monkeypatch):
+
+    monkeypatch.setattr(proxy, 'open_probe_cache', lambda: None)
+    monkeypatch.setattr(proxy, 'probe_many', lambda paths, cache=None: [
+        (path, {'format': {}, 'streams': [{'codec_type': 'video'}]}, None) for path in paths])
+
+    server = FakeShotgun()
+    project = server.add('Project', {'name': 'Test'})
+    element_set = server.add('CustomEntity27', {'code': 'A001', 'project': project})
+    for name in ('a.mov', 'b.mov'):
+        server.add('Element', {
+            'code': os.path.splitext(name)[0],
+            'sg_element_set': element_set,
+            'sg_path': '/footage/A001/' + name,
+            'sg_relative_path': name,
+            'sg_uuid': name,
+            'sg_type': 'footage',
+            'sg_checksum': None,
+        })
+
+    def plan(**kwargs):
+        return dict((os.path.basename(work.srcs[0]), [os.path.basename(x) for x in work.dsts])
+            for work in proxy.plan_work(make_args(tmpdir, element_set, **kwargs)))
+
+    tmpdir.join('out').ensure(dir=True)
+    first = plan()
+    assert sorted(first) == ['a.mov', 'b.mov']
+
+    # a has its .mov already, but not its .mxf; b has both.
+    work = proxy.plan_work(make_args(tmpdir, element_set))
+    dsts = dict((os.path.basename(w.srcs[0]), w.dsts) for w in work)
+    open(dsts['a.mov'][0], 'w').close()
+    for path in dsts['b.mov']:
+        open(path, 'w').close()
+
+    assert plan() == {'a.mov': [os.path.basename(dsts['a.mov'][1])]}
+    assert plan(replace=True) == first
@@ -0,0 +1,31 @@
+from fake_shotgun import FakeShotgun, FakeSGFS
+
+from mmedit.footage.utils import iter_render_work
+
+
+def test_sets_with_the_same_name_are_not_interleaved(tmpdir):
+
+    server = FakeShotgun()
+    project = server.add('Project', {'name': 'Test'})
+    sets = [server.add('CustomEntity27', {'code': 'A001', 'project': project}) for _ in range(2)]
+
+    # Alternate between the sets, so ordering by name alone interleaves them.
+    for i in range(6):
+        element_set = sets[i % 2]
+        server.add('Element', {
+            'code': 'clip%d' % i,
+            'sg_element_set': element_set,
+            'sg_path': '/footage/%d/clip%d.mov' % (element_set['id'], i),
+            'sg_relative_path': 'clip%d.mov' % i,
+            'sg_uuid': '%032x' % i,
+            'sg_type': 'footage',
+            'sg_checksum': None,
+        })
+
+    tmpdir.join('out').ensure(dir=True)
+    work = list(iter_render_work('Project:%d' % project['id'], str(tmpdir.join('out')), all=True, update=True,
+        sgfs=FakeSGFS(), check_dst=False, page_size=4))
+
+    set_ids = [element['sg_element_set']['id'] for element, _ in work]
+    assert len(set_ids) == 6
+    assert set_ids == sorted(set_ids)
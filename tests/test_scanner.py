@@ -0,0 +1,40 @@
+import errno
+import os
+
+import pytest
+
+from mmedit.footage import scanner
+
+
+def make_tree(root):
+    for rel_path in ('a/clip1.mov', 'b/clip2.mov', 'b/c/clip3.mov', 'clip0.mov'):
+        path = os.path.join(root, rel_path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, 'w').close()
+
+
+def test_unreadable_dir_is_skipped(tmpdir, monkeypatch):
+
+    root = str(tmpdir)
+    make_tree(root)
+
+    scandir = scanner.scandir
+    def flaky_scandir(path):
+        if os.path.basename(path) == 'b':
+            raise OSError(errno.EACCES, 'Permission denied', path)
+        return scandir(path)
+    monkeypatch.setattr(scanner, 'scandir', flaky_scandir)
+
+    dirs = {}
+    stats = {}
+    found = sorted(entry.rel_path for entry in scanner.scan(root, dirs=dirs, stats=stats))
+
+    assert found == ['a/clip1.mov', 'clip0.mov']
+    assert stats['errors'] == 1
+    assert sorted(dirs) == ['', 'a']
+
+
+def test_unreadable_root_raises(tmpdir):
+    with pytest.raises(OSError):
+        list(scanner.scan(str(tmpdir.join('missing'))))